@@ -339,7 +339,16 @@ export namespace apis {
         }
     };
 
-    export const queryStatus = async (simCode: string): Promise<'running' | 'stopped' | 'started'> => {
+    export type SimStatus =
+        | 'initializing'
+        | 'failed'
+        | 'started'
+        | 'running'
+        | 'hibernating'
+        | 'hibernated'
+        | 'terminated';
+
+    export const queryStatus = async (simCode: string): Promise<SimStatus> => {
         try {
             const response = await api.get(`/status`, { params: { sim_code: simCode } });
             return response.data.status;
@@ -349,6 +358,25 @@ export namespace apis {
         }
     }
 
+    // /start returns as soon as the simulation is queued for initialization,
+    // so wait for /status to leave "initializing" before using it.
+    export const waitForSim = async (simCode: string, intervalMs: number = 500): Promise<SimStatus> => {
+        for (;;) {
+            const response = await api.get(`/status`, { params: { sim_code: simCode } });
+            const { status, error } = response.data;
+            if (status === 'failed') {
+                throw new Error(error || "Simulation failed to initialize");
+            }
+            if (status === 'terminated') {
+                throw new Error("Simulation not found");
+            }
+            if (status !== 'initializing') {
+                return status;
+            }
+            await new Promise(resolve => setTimeout(resolve, intervalMs));
+        }
+    }
+
     export const messageSocket = (simCode: string) => {
         return new WebSocket(`ws://${apiBaseUrl}:${apiPort}/ws?sim_code=${simCode}`);
     }
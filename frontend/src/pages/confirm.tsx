@@ -24,6 +24,8 @@ export const ConfirmPage = () => {
     const ctx = useSimContext();
     const navigate = useNavigate();
     const [templateImage, setTemplateImage] = useState(stf);
+    const [starting, setStarting] = useState(false);
+    const [startError, setStartError] = useState<string | null>(null);
 
     if (!ctx || !ctx.data.currentTemplate) {
         return <div>Loading...</div>;
@@ -41,6 +43,8 @@ export const ConfirmPage = () => {
             return;
         }
 
+        setStarting(true);
+        setStartError(null);
         try {
             await apis.startSim(
                 ctx.data.currSimCode || '',
@@ -48,10 +52,13 @@ export const ConfirmPage = () => {
                 ctx.data.llmConfig,
                 ctx.data.initialRounds || 0
             );
+            await apis.waitForSim(ctx.data.currSimCode || '');
             navigate('/interact');
         } catch (error) {
             console.error("Failed to start simulation:", error);
-            // Handle error (e.g., show an error message to the user)
+            setStartError(error instanceof Error ? error.message : String(error));
+        } finally {
+            setStarting(false);
         }
     };
 
@@ -167,12 +174,14 @@ export const ConfirmPage = () => {
                         </CardContent>
                     </Card>
                 </div>
+                {starting && <p className="mt-8 text-gray-700">模拟初始化中...</p>}
+                {startError && <p className="mt-8 text-red-600">模拟启动失败: {startError}</p>}
                 <BottomNav
                     prevLink='/llmconfig'
                     nextLink=''
                     onClickNext={handleNextClick}
                     currStep={4}
-                    disabled={false}
+                    disabled={starting}
                     className='my-8'
                     variant="final"
                 />
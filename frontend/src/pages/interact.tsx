@@ -707,9 +707,11 @@ export const InteractPage: React.FC = () => {
 
     useEffect(() => {
         if (messageSocket) {
-            messageSocket.onmessage = (event) => {
-                const d = JSON.parse(event.data);
-                if (d.type == "log") {
+            const handleMessage = (d: any) => {
+                if (d.type == "batch") {
+                    // The server coalesces queued messages into one frame.
+                    d.message.forEach(handleMessage);
+                } else if (d.type == "log") {
                     const e: LogEntry = d.message;
                     const level = e.level;
                     const message = e.message;
@@ -723,6 +725,9 @@ export const InteractPage: React.FC = () => {
                     }
                 }
             };
+            messageSocket.onmessage = (event) => {
+                handleMessage(JSON.parse(event.data));
+            };
         }
     }, [messageSocket]);
 
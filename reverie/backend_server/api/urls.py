@@ -41,12 +41,22 @@ urlpatterns = [
         views.demo,
         name="demo",
     ),
+    re_path(
+        r"^replay_chunk/(?P<sim_code>[\w-]+)/(?P<first>\d+)/$",
+        views.replay_chunk,
+        name="replay_chunk",
+    ),
     re_path(r"^replay/(?P<sim_code>[\w-]+)/(?P<step>[\w-]+)/$", views.replay, name="replay"),
     re_path(
         r"^replay_persona_state/(?P<sim_code>[\w-]+)/(?P<step>[\w-]+)/(?P<persona_name>[\w-]+)/$",
         views.replay_persona_state,
         name="replay_persona_state",
     ),
+    re_path(
+        r"^persona_memory/(?P<sim_code>[\w-]+)/(?P<persona_name>[\w-]+)/$",
+        views.persona_memory,
+        name="persona_memory",
+    ),
     path("process_environment/", views.process_environment, name="process_environment"),
     path("update_environment/", views.update_environment, name="update_environment"),
     path("path_tester/", views.path_tester, name="path_tester"),
@@ -11,11 +11,13 @@ import string
 from os import listdir
 
 import yaml
-from django.http import HttpResponse, JsonResponse
+from django.http import FileResponse, HttpResponse, JsonResponse
 from django.shortcuts import HttpResponseRedirect, redirect, render
 from django.templatetags.static import static
 from utils import *
 from utils.config import *
+from utils.replay import chunk_file, convert_master_movement, decode_step, read_index
+from utils.sim_store import JsonSimStore, open_sim_store
 
 
 def landing(request):
@@ -26,6 +28,7 @@ def landing(request):
 
 def demo(request, sim_code, step, play_speed="2"):
     move_file = f"{compressed_storage_path}/{sim_code}/master_movement.json"
+    replay_folder = f"{compressed_storage_path}/{sim_code}/replay"
     meta_file = f"{compressed_storage_path}/{sim_code}/meta.json"
     step = int(step)
     play_speed_opt = {"1": 1, "2": 2, "3": 4, "4": 8, "5": 16, "6": 32}
@@ -47,16 +50,17 @@ def demo(request, sim_code, step, play_speed="2"):
         start_datetime += datetime.timedelta(seconds=sec_per_step)
     start_datetime = start_datetime.strftime("%Y-%m-%dT%H:%M:%S")
 
-    # Loading the movement file
-    raw_all_movement = dict()
-    with open(move_file) as json_file:
-        raw_all_movement = json.load(json_file)
+    # Loading the replay index. Simulations compressed before the replay
+    # format existed only have a master_movement.json, which we convert once.
+    if not check_if_file_exists(f"{replay_folder}/index.json"):
+        convert_master_movement(move_file, replay_folder)
+    replay_index = read_index(replay_folder)
 
     # Loading all names of the personas
     persona_names = dict()
     persona_names = []
     persona_names_set = set()
-    for p in list(raw_all_movement["0"].keys()):
+    for p in replay_index["persona_names"]:
         persona_names += [
             {
                 "original": p,
@@ -67,36 +71,31 @@ def demo(request, sim_code, step, play_speed="2"):
         persona_names_set.add(p)
 
     # <all_movement> is the main movement variable that we are passing to the
-    # frontend. Whereas we use ajax scheme to communicate steps to the frontend
-    # during the simulation stage, for this demo, we send all movement
-    # information in one step.
+    # frontend. It starts with the initial step only; the frontend fetches the
+    # following steps chunk by chunk (see replay_chunk) as playback advances.
     all_movement = dict()
 
     # Preparing the initial step.
     # <init_prep> sets the locations and descriptions of all agents at the
-    # beginning of the demo determined by <step>.
+    # beginning of the demo determined by <step>, decoded from the nearest
+    # keyframe.
     init_prep = dict()
-    for int_key in range(step + 1):
-        key = str(int_key)
-        val = raw_all_movement[key]
-        for p in persona_names_set:
-            if p in val:
-                init_prep[p] = val[p]
+    if replay_index["last_step"] is not None:
+        init_prep = decode_step(replay_folder, replay_index, step)
     persona_init_pos = dict()
     for p in persona_names_set:
         persona_init_pos[p.replace(" ", "_")] = init_prep[p]["movement"]
     all_movement[step] = init_prep
 
-    # Finish loading <all_movement>
-    for int_key in range(step + 1, len(raw_all_movement.keys())):
-        all_movement[int_key] = raw_all_movement[str(int_key)]
-
     context = {
         "sim_code": sim_code,
         "step": step,
         "persona_names": persona_names,
         "persona_init_pos": json.dumps(persona_init_pos),
         "all_movement": json.dumps(all_movement),
+        "keyframe_steps": replay_index["keyframe_steps"],
+        # -1 for an empty replay, so the template renders a number.
+        "last_step": -1 if replay_index["last_step"] is None else replay_index["last_step"],
         "start_datetime": start_datetime,
         "sec_per_step": sec_per_step,
         "play_speed": play_speed,
@@ -107,6 +106,22 @@ def demo(request, sim_code, step, play_speed="2"):
     return render(request, template, context)
 
 
+def replay_chunk(request, sim_code, first):
+    """
+    Returns the chunk of the replay of a compressed simulation starting at step
+    <first> (see utils/replay.py). The demo fetches them as playback advances.
+
+    ARGS:
+      request: Django request
+    RETURNS:
+      HttpResponse: the chunk as JSON.
+    """
+    chunk = chunk_file(f"{compressed_storage_path}/{sim_code}/replay", first)
+    if not check_if_file_exists(chunk):
+        return JsonResponse({"error": "No such chunk"}, status=404)
+    return FileResponse(open(chunk, "rb"), content_type="application/json")
+
+
 def UIST_Demo(request):
     return demo(request, "March20_the_ville_n25_UIST_RUN-step-1-141", 2160, play_speed="3")
 
@@ -141,17 +156,13 @@ def home(request):
             persona_names_set.add(x)
 
     persona_init_pos = []
-    file_count = []
-    for i in find_filenames(f"{storage_path}/{sim_code}/environment", ".json"):
-        x = i.split("/")[-1].strip()
-        if x[0] != ".":
-            file_count += [int(x.split(".")[0])]
-    curr_json = f"{storage_path}/{sim_code}/environment/{str(max(file_count))}.json"
-    with open(curr_json) as json_file:
-        persona_init_pos_dict = json.load(json_file)
-        for key, val in persona_init_pos_dict.items():
-            if key in persona_names_set:
-                persona_init_pos += [[key, val["x"], val["y"]]]
+    store = open_sim_store()
+    persona_init_pos_dict = store.read_step(
+        sim_code, "environment", store.last_step(sim_code, "environment")
+    )
+    for key, val in persona_init_pos_dict.items():
+        if key in persona_names_set:
+            persona_init_pos += [[key, val["x"], val["y"]]]
 
     context = {
         "sim_code": sim_code,
@@ -178,17 +189,13 @@ def replay(request, sim_code, step):
             persona_names_set.add(x)
 
     persona_init_pos = []
-    file_count = []
-    for i in find_filenames(f"{storage_path}/{sim_code}/environment", ".json"):
-        x = i.split("/")[-1].strip()
-        if x[0] != ".":
-            file_count += [int(x.split(".")[0])]
-    curr_json = f"{storage_path}/{sim_code}/environment/{str(max(file_count))}.json"
-    with open(curr_json) as json_file:
-        persona_init_pos_dict = json.load(json_file)
-        for key, val in persona_init_pos_dict.items():
-            if key in persona_names_set:
-                persona_init_pos += [[key, val["x"], val["y"]]]
+    store = open_sim_store()
+    persona_init_pos_dict = store.read_step(
+        sim_code, "environment", store.last_step(sim_code, "environment")
+    )
+    for key, val in persona_init_pos_dict.items():
+        if key in persona_names_set:
+            persona_init_pos += [[key, val["x"], val["y"]]]
 
     context = {
         "sim_code": sim_code,
@@ -207,51 +214,86 @@ def replay_persona_state(request, sim_code, step, persona_name):
 
     persona_name_underscore = persona_name
     persona_name = " ".join(persona_name.split("_"))
-    memory = f"{storage_path}/{sim_code}/personas/{persona_name}/bootstrap_memory"
-    if not os.path.exists(memory):
-        memory = f"{compressed_storage_path}/{sim_code}/personas/{persona_name}/bootstrap_memory"
-
-    with open(memory + "/scratch.json") as json_file:
-        scratch = json.load(json_file)
-
-    with open(memory + "/spatial_memory.json") as json_file:
-        spatial = json.load(json_file)
-
-    with open(memory + "/associative_memory/nodes.json") as json_file:
-        associative = json.load(json_file)
-
-    a_mem_event = []
-    a_mem_chat = []
-    a_mem_thought = []
-
-    for count in range(len(associative.keys()), 0, -1):
-        node_id = f"node_{str(count)}"
-        node_details = associative[node_id]
-
-        if node_details["type"] == "event":
-            a_mem_event += [node_details]
-
-        elif node_details["type"] == "chat":
-            a_mem_chat += [node_details]
-
-        elif node_details["type"] == "thought":
-            a_mem_thought += [node_details]
+    store, scratch = persona_store(sim_code, persona_name)
+    if store is None:
+        return JsonResponse({"error": "No such persona"}, status=404)
 
+    # Each kind of memory is shown a page at a time, newest first. The page
+    # is picked by the <type>_cursor parameter (see persona_memory).
     context = {
         "sim_code": sim_code,
         "step": step,
         "persona_name": persona_name,
         "persona_name_underscore": persona_name_underscore,
         "scratch": scratch,
-        "spatial": spatial,
-        "a_mem_event": a_mem_event,
-        "a_mem_chat": a_mem_chat,
-        "a_mem_thought": a_mem_thought,
     }
+    for node_type in ["event", "chat", "thought"]:
+        nodes, cursor = store.query_memory(
+            sim_code,
+            persona_name,
+            node_type=node_type,
+            cursor=request.GET.get(f"{node_type}_cursor"),
+        )
+        context[f"a_mem_{node_type}"] = nodes
+        context[f"a_mem_{node_type}_cursor"] = cursor
     template = "persona_state/persona_state.html"
     return render(request, template, context)
 
 
+def persona_store(sim_code, persona_name):
+    """
+    Finds the memory of a persona, among the running simulations and then the
+    compressed ones.
+
+    RETURNS:
+      A tuple of (the SimStore holding it, the persona's scratch), or (None,
+      None) if there is no such persona.
+    """
+    for store in [open_sim_store(), JsonSimStore(compressed_storage_path)]:
+        scratch = store.read_persona(sim_code, persona_name, ["scratch"]).get("scratch")
+        if scratch is not None:
+            return store, scratch
+    return None, None
+
+
+def persona_memory(request, sim_code, persona_name):
+    """
+    Queries the associative memory of a persona a page at a time, newest
+    first (see persona/memory_structures/memory_index.py).
+    The GET parameters are all optional: type ("event", "chat" or "thought"),
+    since and until ("%Y-%m-%d %H:%M:%S"), keyword, cursor (from the previous
+    page) and limit (from 1 to 1000).
+
+    ARGS:
+      request: Django request
+    RETURNS:
+      JsonResponse: {"nodes": [...], "cursor": <cursor of the next page>}
+    """
+    try:
+        limit = min(max(int(request.GET.get("limit", memory_page_size)), 1), 1000)
+        cursor = request.GET.get("cursor")
+        cursor = int(cursor) if cursor else None
+    except ValueError:
+        return JsonResponse({"error": "limit and cursor must be integers"}, status=400)
+
+    persona_name = " ".join(persona_name.split("_"))
+    store, _ = persona_store(sim_code, persona_name)
+    if store is None:
+        return JsonResponse({"error": "No such persona"}, status=404)
+
+    nodes, cursor = store.query_memory(
+        sim_code,
+        persona_name,
+        node_type=request.GET.get("type"),
+        since=request.GET.get("since"),
+        until=request.GET.get("until"),
+        keyword=request.GET.get("keyword"),
+        cursor=cursor,
+        limit=limit,
+    )
+    return JsonResponse({"nodes": nodes, "cursor": cursor})
+
+
 def path_tester(request):
     context = {}
     template = "path_tester/path_tester.html"
@@ -279,8 +321,8 @@ def process_environment(request):
     sim_code = data["sim_code"]
     environment = data["environment"]
 
-    with open(f"{storage_path}/{sim_code}/environment/{step}.json", "w") as outfile:
-        outfile.write(json.dumps(environment, indent=2))
+    with open_sim_store().transaction() as tx:
+        tx.write_step(sim_code, "environment", step, environment)
 
     return HttpResponse("received")
 
@@ -307,10 +349,10 @@ def update_environment(request):
     sim_code = data["sim_code"]
 
     response_data = {"<step>": -1}
-    if check_if_file_exists(f"{storage_path}/{sim_code}/movement/{step}.json"):
-        with open(f"{storage_path}/{sim_code}/movement/{step}.json") as json_file:
-            response_data = json.load(json_file)
-            response_data["<step>"] = step
+    movements = open_sim_store().read_step(sim_code, "movement", step)
+    if movements is not None:
+        response_data = movements
+        response_data["<step>"] = step
 
     return JsonResponse(response_data)
 
@@ -86,16 +86,18 @@ class SocketConsumer(AsyncWebsocketConsumer):
         await self.send(text_data=message)
 
 
-def sock_send(message, message_type):
+def sock_send(message, message_type, key=None):
     """
     Send a message to a specific socket group.
+    For coalescing message types (e.g., "movement"), <key> identifies the
+    buffered message it replaces.
     """
     # sock_name is deprecated.
     if hasattr(thread_local, "reverie_instance"):
         reverie_instance = thread_local.reverie_instance
         if reverie_instance:
             message = json.dumps({"type": message_type, "message": message})
-            reverie_instance.reverie.message_queue.put(message)
+            reverie_instance.post_message(message_type, message, key)
 
 
 # Example usage of the socket_handler decorator
@@ -8,60 +8,37 @@ Description: Compresses a simulation for replay demos.
 import shutil
 import json
 from utils import *
+from utils.replay import ReplayWriter
+from utils.sim_store import JsonSimStore, open_sim_store, transfer_simulation
 
 
 def compress(sim_code):
-    sim_storage = f"../environment/frontend_server/storage/{sim_code}"
+    storage = "../environment/frontend_server/storage"
+    sim_storage = f"{storage}/{sim_code}"
     compressed_storage = f"../environment/frontend_server/compressed_storage/{sim_code}"
     persona_folder = sim_storage + "/personas"
-    move_folder = sim_storage + "/movement"
     meta_file = sim_storage + "/reverie/meta.json"
 
+    # The folder of the simulation may be behind its store (see sim_store in
+    # utils/config.py), so it is refreshed first.
+    store = open_sim_store(storage)
+    if store.incremental:
+        transfer_simulation(store, JsonSimStore(storage), sim_code, steps=False)
+
     persona_names = []
     for i in find_filenames(persona_folder, ""):
         x = i.split("/")[-1].strip()
         if x[0] != ".":
             persona_names += [x]
 
-    max_move_count = max(
-        [int(i.split("/")[-1].split(".")[0]) for i in find_filenames(move_folder, "json")]
-    )
-
-    persona_last_move = dict()
-    master_move = dict()
-    for i in range(max_move_count + 1):
-        master_move[i] = dict()
-        with open(f"{move_folder}/{str(i)}.json") as json_file:
-            i_move_dict = json.load(json_file)["persona"]
-            for p in persona_names:
-                move = False
-                if i == 0:
-                    move = True
-                elif (
-                    i_move_dict[p]["movement"] != persona_last_move[p]["movement"]
-                    or i_move_dict[p]["pronunciatio"] != persona_last_move[p]["pronunciatio"]
-                    or i_move_dict[p]["description"] != persona_last_move[p]["description"]
-                    or i_move_dict[p]["chat"] != persona_last_move[p]["chat"]
-                ):
-                    move = True
-
-                if move:
-                    persona_last_move[p] = {
-                        "movement": i_move_dict[p]["movement"],
-                        "pronunciatio": i_move_dict[p]["pronunciatio"],
-                        "description": i_move_dict[p]["description"],
-                        "chat": i_move_dict[p]["chat"],
-                    }
-                    master_move[i][p] = {
-                        "movement": i_move_dict[p]["movement"],
-                        "pronunciatio": i_move_dict[p]["pronunciatio"],
-                        "description": i_move_dict[p]["description"],
-                        "chat": i_move_dict[p]["chat"],
-                    }
-
+    # The movements are stored delta-encoded, in chunks that start with a
+    # keyframe (see utils/replay.py), so that the demo can stream them.
     create_folder_if_not_there(compressed_storage)
-    with open(f"{compressed_storage}/master_movement.json", "w") as outfile:
-        outfile.write(json.dumps(master_move, indent=2))
+    replay = ReplayWriter(f"{compressed_storage}/replay")
+    for i in range(store.last_step(sim_code, "movement") + 1):
+        i_move_dict = store.read_step(sim_code, "movement", i)["persona"]
+        replay.add(i, {p: i_move_dict[p] for p in persona_names})
+    replay.close()
 
     shutil.copyfile(meta_file, f"{compressed_storage}/meta.json")
     shutil.copytree(persona_folder, f"{compressed_storage}/personas/")
@@ -6,6 +6,7 @@ Description: Defines the Maze class, which represents the map of the simulated
 world in a 2-dimensional matrix. 
 """
 
+import copy
 import datetime
 import json
 import math
@@ -23,6 +24,24 @@ class Maze:
     def __init__(self):
         pass
 
+    def branch(self):
+        """
+        Returns a copy of this maze for a branched simulation (see
+        Reverie.fork). The static layers are shared; subclasses copy the
+        state that changes as the simulation runs.
+        """
+        return copy.copy(self)
+
+    def checkpoint_state(self):
+        """
+        Returns the state of this maze that changes as the simulation runs, for
+        a checkpoint (see Reverie.write_checkpoint). It must be picklable.
+        """
+        return {}
+
+    def restore_checkpoint_state(self, state):
+        pass
+
 
 class OfflineMaze(Maze):
     def __init__(self, maze_name):
@@ -337,6 +356,30 @@ class OfflineMaze(Maze):
                 nearby_tiles += [(i, j)]
         return nearby_tiles
 
+    def branch(self):
+        # Only the events on the tiles change; the tile details are shared.
+        other = super().branch()
+        other.tiles = [
+            [dict(tile, events=set(tile["events"])) for tile in row] for row in self.tiles
+        ]
+        return other
+
+    def checkpoint_state(self):
+        # Only the tiles that have events are kept, as (x, y, events).
+        return [
+            (x, y, set(tile["events"]))
+            for y, row in enumerate(self.tiles)
+            for x, tile in enumerate(row)
+            if tile["events"]
+        ]
+
+    def restore_checkpoint_state(self, state):
+        for row in self.tiles:
+            for tile in row:
+                tile["events"] = set()
+        for x, y, events in state:
+            self.tiles[y][x]["events"] = set(events)
+
     def add_event_from_tile(self, curr_event, tile):
         """
         Add an event triple to a tile.
@@ -471,6 +514,35 @@ class OnlineMaze(Maze):
 
         self.user_count = new_user_count
 
+    def branch(self):
+        other = super().branch()
+        for name in [
+            "events",
+            "events_policy",
+            "web_search",
+            "relationship_matrix",
+            "relationship_matrix_chinese",
+        ]:
+            setattr(other, name, copy.deepcopy(getattr(self, name)))
+        return other
+
+    def checkpoint_state(self):
+        return {
+            name: getattr(self, name)
+            for name in [
+                "events",
+                "events_policy",
+                "web_search",
+                "relationship_matrix",
+                "relationship_matrix_chinese",
+                "user_count",
+            ]
+        }
+
+    def restore_checkpoint_state(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
     def add_event(self, event_id, access_list):
         if event_id not in self.events:
             self.events[event_id] = Event(event_id, access_list)
@@ -6,6 +6,7 @@ from persona.cognitive_modules.perceive import *
 from persona.cognitive_modules.plan import *
 from persona.cognitive_modules.reflect import *
 from persona.cognitive_modules.retrieve import *
+from utils.llm_scheduler import llm_priority
 
 
 class Action:
@@ -53,7 +54,9 @@ class GaReflect(Action):
         pass
 
     def action(self, persona):
-        reflect(persona)
+        # Reflection is background work; its LLM requests yield to the step's.
+        with llm_priority("batch"):
+            reflect(persona)
 
 
 class DaiPerceive(Action):
@@ -5,6 +5,7 @@ File: converse.py
 Description: An extra cognitive module for generating conversations. 
 """
 
+import copy
 import datetime
 import math
 import random
@@ -123,59 +124,72 @@ def generate_one_utterance(maze, init_persona, target_persona, retrieved, curr_c
     return x["utterance"], x["end"]
 
 
-def agent_chat_v2(maze, init_persona, target_persona):
-    curr_chat = []
-    print("July 23")
+class ConvoSession:
+    """
+    Per-conversation retrieval cache for agent_chat_v2.
 
-    for i in range(8):
-        focal_points = [f"{target_persona.scratch.name}"]
-        retrieved = new_retrieve(init_persona, focal_points, 50)
-        relationship = generate_summarize_agent_relationship(
-            init_persona, target_persona, retrieved
-        )
+    Within one conversation, neither the partner's name nor the partner's
+    current action changes, so the name-keyed retrieval, the relationship
+    summary and the retrieval for those two focal points are computed once per
+    side when the session opens (both sides concurrently). Each turn then only
+    retrieves on the sliding <last_chat> focal point.
+    """
+
+    def __init__(self, init_persona, target_persona):
+        self.init_persona = init_persona
+        self.target_persona = target_persona
+        # <sides> maps a speaker's name to the retrieval that does not change
+        # during the conversation:
+        # e.g., sides["Isabella Rodriguez"] = {"relationship": "...",
+        #                                      "retrieved": {focal_pt: [nodes]}}
+        self.sides = dict()
+
+        pairs = [(init_persona, target_persona), (target_persona, init_persona)]
+        for (speaker, _), side in zip(pairs, parallel_map(self._open_side, pairs)):
+            self.sides[speaker.name] = side
+
+    @staticmethod
+    def _open_side(pair):
+        speaker, listener = pair
+        focal_points = [f"{listener.scratch.name}"]
+        retrieved = new_retrieve(speaker, focal_points, 50)
+        relationship = generate_summarize_agent_relationship(speaker, listener, retrieved)
         print("-------- relationshopadsjfhkalsdjf", relationship)
+        focal_points = [
+            f"{relationship}",
+            f"{listener.scratch.name} is {listener.scratch.act_description}",
+        ]
+        return {"relationship": relationship, "retrieved": new_retrieve(speaker, focal_points, 15)}
+
+    def retrieve(self, speaker, curr_chat):
+        """
+        Returns the retrieved nodes for <speaker>'s next utterance: the cached
+        relationship / activity retrieval plus a fresh retrieval on the last
+        four lines of the conversation.
+        """
+        retrieved = dict(self.sides[speaker.name]["retrieved"])
         last_chat = ""
         for i in curr_chat[-4:]:
             last_chat += ": ".join(i) + "\n"
         if last_chat:
-            focal_points = [
-                f"{relationship}",
-                f"{target_persona.scratch.name} is {target_persona.scratch.act_description}",
-                last_chat,
-            ]
-        else:
-            focal_points = [
-                f"{relationship}",
-                f"{target_persona.scratch.name} is {target_persona.scratch.act_description}",
-            ]
-        retrieved = new_retrieve(init_persona, focal_points, 15)
+            retrieved.update(new_retrieve(speaker, [last_chat], 15))
+        return retrieved
+
+
+def agent_chat_v2(maze, init_persona, target_persona):
+    curr_chat = []
+    print("July 23")
+
+    session = ConvoSession(init_persona, target_persona)
+    for i in range(8):
+        retrieved = session.retrieve(init_persona, curr_chat)
         utt, end = generate_one_utterance(maze, init_persona, target_persona, retrieved, curr_chat)
 
         curr_chat += [[init_persona.scratch.name, utt]]
         if end:
             break
 
-        focal_points = [f"{init_persona.scratch.name}"]
-        retrieved = new_retrieve(target_persona, focal_points, 50)
-        relationship = generate_summarize_agent_relationship(
-            target_persona, init_persona, retrieved
-        )
-        print("-------- relationshopadsjfhkalsdjf", relationship)
-        last_chat = ""
-        for i in curr_chat[-4:]:
-            last_chat += ": ".join(i) + "\n"
-        if last_chat:
-            focal_points = [
-                f"{relationship}",
-                f"{init_persona.scratch.name} is {init_persona.scratch.act_description}",
-                last_chat,
-            ]
-        else:
-            focal_points = [
-                f"{relationship}",
-                f"{init_persona.scratch.name} is {init_persona.scratch.act_description}",
-            ]
-        retrieved = new_retrieve(target_persona, focal_points, 15)
+        retrieved = session.retrieve(target_persona, curr_chat)
         utt, end = generate_one_utterance(maze, target_persona, init_persona, retrieved, curr_chat)
 
         curr_chat += [[target_persona.scratch.name, utt]]
@@ -323,6 +337,42 @@ import re
 
 
 
+class InterviewView:
+    """
+    Stands in for a persona in an interview that is answered outside the
+    simulation thread, while a run may be going on. Attribute access falls
+    through to the persona, except for scratch and a_mem, which are copies
+    taken when the view is created: the scratch is a Scratch.schedule_copy and
+    the associative memory has its own node lists, indices (down to the node
+    lists of each keyword) and embeddings (the nodes themselves are shared).
+    The run can keep adding memories without the interview seeing them
+    half-way.
+    Each container is first copied with list() or dict(), which the run
+    cannot change halfway, before we iterate over it.
+    """
+
+    memory_lists = ["seq_event", "seq_thought", "seq_chat"]
+    keyword_dicts = ["kw_to_event", "kw_to_thought", "kw_to_chat"]
+
+    def __init__(self, persona):
+        self.persona = persona
+        self.scratch = persona.scratch.schedule_copy()
+        a_mem = persona.a_mem
+        self.a_mem = copy.copy(a_mem)
+        for name in self.memory_lists:
+            setattr(self.a_mem, name, list(getattr(a_mem, name)))
+        # add_event, add_thought and add_chat insert into the node list of a
+        # keyword in place, so those are copied too.
+        for name in self.keyword_dicts:
+            kw_to_nodes = dict(getattr(a_mem, name))
+            setattr(self.a_mem, name, {kw: list(nodes) for kw, nodes in kw_to_nodes.items()})
+        self.a_mem.id_to_node = dict(a_mem.id_to_node)
+        self.a_mem.embeddings = a_mem.embeddings.copy()
+
+    def __getattr__(self, name):
+        return getattr(self.persona, name)
+
+
 def chat_to_persona(persona, convo_mode, vbase, prev_messages, message):
     # The prev_messages is a list of tuples of (speaker, message)
     # vbase is currently not necessary
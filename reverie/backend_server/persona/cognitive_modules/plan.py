@@ -10,8 +10,16 @@ import math
 import random
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from utils import *
+from utils.config import (
+    next_day_planning_hour,
+    plan_next_day_in_background,
+    prefetch_next_action,
+)
+from utils.llm_scheduler import llm_priority
+from utils.logs import L
 from persona.cognitive_modules.converse import *
 from persona.cognitive_modules.retrieve import *
 from persona.prompt_template.run_gpt_prompt import *
@@ -551,6 +559,11 @@ def _long_term_planning(persona, new_day, maze):
                "New day", or False (for neither). This is important because we
                create the personas' long term planning on the new day.
     """
+    # If the new day was already planned in the background last evening, we
+    # just commit that plan.
+    if new_day == "New day" and _commit_next_day_plan(persona):
+        return
+
     # We start by creating the wake up hour for the persona.
     wake_up_hour = generate_wake_up_hour(persona)
 
@@ -587,16 +600,37 @@ def _long_term_planning(persona, new_day, maze):
     persona.scratch.f_daily_schedule_hourly_org = persona.scratch.f_daily_schedule[:]
 
     # Added March 4 -- adding plan to the memory.
+    thought = _daily_plan_thought(persona)
+    _add_daily_plan_thought(persona, (thought, get_embedding(thought)))
+
+    # print("Sleeping for 20 seconds...")
+    # time.sleep(10)
+    # print("Done sleeping!")
+
+
+def _daily_plan_thought(persona):
+    """
+    Returns the thought that records the persona's plan for the day of
+    persona.scratch.curr_time.
+    """
     thought = f"This is {persona.scratch.name}'s plan for {persona.scratch.curr_time.strftime('%A %B %d')}:"
     for i in persona.scratch.daily_req:
         thought += f" {i},"
     thought = thought[:-1] + "."
+    return thought
+
+
+def _add_daily_plan_thought(persona, thought_embedding_pair):
+    """
+    Adds the daily plan thought (see _daily_plan_thought) to the persona's
+    associative memory.
+    """
+    thought = thought_embedding_pair[0]
     created = persona.scratch.curr_time
     expiration = persona.scratch.curr_time + datetime.timedelta(days=30)
     s, p, o = (persona.scratch.name, "plan", persona.scratch.curr_time.strftime("%A %B %d"))
     keywords = set(["plan"])
     thought_poignancy = 5
-    thought_embedding_pair = (thought, get_embedding(thought))
     persona.a_mem.add_thought(
         created,
         expiration,
@@ -610,114 +644,215 @@ def _long_term_planning(persona, new_day, maze):
         None,
     )
 
-    # print("Sleeping for 20 seconds...")
-    # time.sleep(10)
-    # print("Done sleeping!")
 
+class _NextDayView:
+    """
+    Stands in for a persona while we plan its next day ahead of time. Attribute
+    access falls through to the persona, except for scratch, which is a
+    Scratch.schedule_copy with curr_time moved to the start of the next day,
+    and a_mem, which is a branch of the associative memory. Planning assigns
+    to scratch rather than mutating it in place, and retrieval stamps the
+    last_accessed of the branch's nodes, so today's state is not touched.
+    Create it on the simulation thread, as it copies the persona's state.
+    """
+
+    def __init__(self, persona, day_start):
+        self.persona = persona
+        self.scratch = persona.scratch.schedule_copy()
+        self.scratch.curr_time = day_start
+        self.a_mem = persona.a_mem.branch()
 
-def _determine_action(persona, maze):
+    def __getattr__(self, name):
+        return getattr(self.persona, name)
+
+
+def _plan_next_day(persona, view):
     """
-    Creates the next action sequence for the persona.
-    The main goal of this function is to run "add_new_action" on the persona's
-    scratch space, which sets up all the action related variables for the next
-    action.
-    As a part of this, the persona may need to decompose its hourly schedule as
-    needed.
+    Runs the "New day" branch of _long_term_planning for the day starting at
+    view.scratch.curr_time and stages the result in
+    persona.scratch.staged_day_plan.
     INPUT
-      persona: Current <Persona> instance whose action we are determining.
-      maze: Current <Maze> instance.
+      persona: Current <Persona> instance.
+      view: the _NextDayView of the persona for the day we are planning.
+    """
+    day_start = view.scratch.curr_time
+    wake_up_hour = generate_wake_up_hour(view)
+    revise_identity(view)
+    f_daily_schedule = generate_hourly_schedule(view, wake_up_hour)
+    thought = _daily_plan_thought(view)
+
+    persona.scratch.staged_day_plan = {
+        "date": day_start.date(),
+        "currently": view.scratch.currently,
+        "daily_plan_req": view.scratch.daily_plan_req,
+        "f_daily_schedule": f_daily_schedule,
+        "thought_embedding_pair": (thought, get_embedding(thought)),
+    }
+
+
+def _start_next_day_planning(persona):
+    """
+    Starts planning the persona's next day in the background once we are in
+    the quiet late-evening hours (see next_day_planning_hour in
+    utils/config.py). The result is committed by _commit_next_day_plan at the
+    day boundary.
+    INPUT
+      persona: Current <Persona> instance.
+    """
+    curr_time = persona.scratch.curr_time
+    if curr_time.hour < next_day_planning_hour or persona.scratch.chatting_with:
+        return
+    if persona.next_day_planning or persona.scratch.staged_day_plan:
+        return
+
+    day_start = (curr_time + datetime.timedelta(days=1)).replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
+    # Planning ahead is background work; its LLM requests yield to the step's.
+    with llm_priority("batch"):
+        persona.next_day_planning = _prefetch_executor.submit(
+            bind_thread_local(_plan_next_day), persona, _NextDayView(persona, day_start)
+        )
+
+
+def _commit_next_day_plan(persona):
     """
+    Commits the plan staged by _start_next_day_planning if it was made for the
+    current day. Waits for it if it is still running.
+    INPUT
+      persona: Current <Persona> instance.
+    OUTPUT
+      True if the staged plan was committed, False otherwise.
+    """
+    if persona.next_day_planning:
+        future = persona.next_day_planning
+        persona.next_day_planning = None
+        try:
+            future.result()
+        except Exception as e:
+            L.warning(f"Discarding next-day plan for {persona.name}: {e}")
+
+    staged = persona.scratch.staged_day_plan
+    persona.scratch.staged_day_plan = None
+    if not staged or staged["date"] != persona.scratch.curr_time.date():
+        return False
 
-    def determine_decomp(act_desp, act_dura):
-        """
-        Given an action description and its duration, we determine whether we need
-        to decompose it. If the action is about the agent sleeping, we generally
-        do not want to decompose it, so that's what we catch here.
-
-        INPUT:
-          act_desp: the description of the action (e.g., "sleeping")
-          act_dura: the duration of the action in minutes.
-        OUTPUT:
-          a boolean. True if we need to decompose, False otherwise.
-        """
-        if "sleep" not in act_desp and "bed" not in act_desp:
-            return True
-        elif "sleeping" in act_desp or "asleep" in act_desp or "in bed" in act_desp:
-            return False
-        elif "sleep" in act_desp or "bed" in act_desp:
-            if act_dura > 60:
-                return False
+    persona.scratch.currently = staged["currently"]
+    persona.scratch.daily_plan_req = staged["daily_plan_req"]
+    persona.scratch.f_daily_schedule = staged["f_daily_schedule"]
+    persona.scratch.f_daily_schedule_hourly_org = persona.scratch.f_daily_schedule[:]
+    _add_daily_plan_thought(persona, staged["thought_embedding_pair"])
+    return True
+
+
+def _determine_decomp(act_desp, act_dura):
+    """
+    Given an action description and its duration, we determine whether we need
+    to decompose it. If the action is about the agent sleeping, we generally
+    do not want to decompose it, so that's what we catch here.
+
+    INPUT:
+      act_desp: the description of the action (e.g., "sleeping")
+      act_dura: the duration of the action in minutes.
+    OUTPUT:
+      a boolean. True if we need to decompose, False otherwise.
+    """
+    if "sleep" not in act_desp and "bed" not in act_desp:
         return True
+    elif "sleeping" in act_desp or "asleep" in act_desp or "in bed" in act_desp:
+        return False
+    elif "sleep" in act_desp or "bed" in act_desp:
+        if act_dura > 60:
+            return False
+    return True
+
+
+def _decompose_schedule(persona, scratch, today_min_elapsed):
+    """
+    Decomposes the hour-long blocks of scratch.f_daily_schedule around
+    today_min_elapsed in place and returns the index of the action that starts
+    at that minute.
+    INPUT
+      persona: Current <Persona> instance whose schedule we are decomposing.
+      scratch: The persona's <Scratch> (or a Scratch.schedule_copy of it).
+      today_min_elapsed: The minute of the day we are decomposing for.
+    OUTPUT
+      The index of the current action in scratch.f_daily_schedule.
+    """
+    schedule = scratch.f_daily_schedule
 
     # The goal of this function is to get us the action associated with
     # <curr_index>. As a part of this, we may need to decompose some large
     # chunk actions.
     # Importantly, we try to decompose at least two hours worth of schedule at
     # any given point.
-    curr_index = persona.scratch.get_f_daily_schedule_index()
-    curr_index_60 = persona.scratch.get_f_daily_schedule_index(advance=60)
+    curr_index = scratch.get_f_daily_schedule_index_at(today_min_elapsed)
+    curr_index_60 = scratch.get_f_daily_schedule_index_at(today_min_elapsed + 60)
 
     # * Decompose *
     # During the first hour of the day, we need to decompose two hours
     # sequence. We do that here.
     if curr_index == 0:
         # This portion is invoked if it is the first hour of the day.
-        act_desp, act_dura = persona.scratch.f_daily_schedule[curr_index]
+        act_desp, act_dura = schedule[curr_index]
         if act_dura >= 60:
             # We decompose if the next action is longer than an hour, and fits the
-            # criteria described in determine_decomp.
-            if determine_decomp(act_desp, act_dura):
-                persona.scratch.f_daily_schedule[curr_index : curr_index + 1] = (
-                    generate_task_decomp(persona, act_desp, act_dura)
+            # criteria described in _determine_decomp.
+            if _determine_decomp(act_desp, act_dura):
+                scratch.splice_f_daily_schedule(
+                    curr_index, curr_index + 1, generate_task_decomp(persona, act_desp, act_dura)
                 )
-        if curr_index_60 + 1 < len(persona.scratch.f_daily_schedule):
-            act_desp, act_dura = persona.scratch.f_daily_schedule[curr_index_60 + 1]
+        if curr_index_60 + 1 < len(schedule):
+            act_desp, act_dura = schedule[curr_index_60 + 1]
             if act_dura >= 60:
-                if determine_decomp(act_desp, act_dura):
-                    persona.scratch.f_daily_schedule[curr_index_60 + 1 : curr_index_60 + 2] = (
-                        generate_task_decomp(persona, act_desp, act_dura)
+                if _determine_decomp(act_desp, act_dura):
+                    scratch.splice_f_daily_schedule(
+                        curr_index_60 + 1,
+                        curr_index_60 + 2,
+                        generate_task_decomp(persona, act_desp, act_dura),
                     )
 
-    if curr_index_60 < len(persona.scratch.f_daily_schedule):
+    if curr_index_60 < len(schedule):
         # If it is not the first hour of the day, this is always invoked (it is
         # also invoked during the first hour of the day -- to double up so we can
         # decompose two hours in one go). Of course, we need to have something to
         # decompose as well, so we check for that too.
-        if persona.scratch.curr_time.hour < 23:
+        if today_min_elapsed < 23 * 60:
             # And we don't want to decompose after 11 pm.
-            act_desp, act_dura = persona.scratch.f_daily_schedule[curr_index_60]
+            act_desp, act_dura = schedule[curr_index_60]
             if act_dura >= 60:
-                if determine_decomp(act_desp, act_dura):
-                    persona.scratch.f_daily_schedule[curr_index_60 : curr_index_60 + 1] = (
-                        generate_task_decomp(persona, act_desp, act_dura)
+                if _determine_decomp(act_desp, act_dura):
+                    scratch.splice_f_daily_schedule(
+                        curr_index_60,
+                        curr_index_60 + 1,
+                        generate_task_decomp(persona, act_desp, act_dura),
                     )
     # * End of Decompose *
 
-    # Generate an <Action> instance from the action description and duration. By
-    # this point, we assume that all the relevant actions are decomposed and
-    # ready in f_daily_schedule.
-    print("DEBUG LJSDLFSKJF")
-    for i in persona.scratch.f_daily_schedule:
-        print(i)
-    print(curr_index)
-    print(len(persona.scratch.f_daily_schedule))
-    print(persona.scratch.name)
-    print("------")
-
-    # 1440
-    x_emergency = 0
-    for i in persona.scratch.f_daily_schedule:
-        x_emergency += i[1]
-    # print ("x_emergency", x_emergency)
-
+    # If the decomposition left the day short of 1440 minutes, we fill the
+    # rest with sleeping. We only do this when there is a gap, so the filler
+    # is not appended again every time an action is determined.
+    x_emergency = scratch.get_f_daily_schedule_total()
     if 1440 - x_emergency > 0:
         print("x_emergency__AAA", x_emergency)
-    persona.scratch.f_daily_schedule += [["sleeping", 1440 - x_emergency]]
+        n = len(schedule)
+        scratch.splice_f_daily_schedule(n, n, [["sleeping", 1440 - x_emergency]])
+
+    return curr_index
 
-    act_desp, act_dura = persona.scratch.f_daily_schedule[curr_index]
 
-    # Finding the target location of the action and creating action-related
-    # variables.
+def _resolve_action(persona, maze, act_desp, act_dura):
+    """
+    Finds the target location of the action and creates the action-related
+    variables for it.
+    INPUT
+      persona: Current <Persona> instance whose action we are resolving.
+      maze: Current <Maze> instance.
+      act_desp: the description of the action.
+      act_dura: the duration of the action in minutes.
+    OUTPUT
+      A tuple of the positional arguments for scratch.add_new_action.
+    """
     act_world = maze.access_tile(persona.scratch.curr_tile)["world"]
     # act_sector = maze.access_tile(persona.scratch.curr_tile)["sector"]
     act_sector = generate_action_sector(act_desp, persona, maze)
@@ -732,8 +867,7 @@ def _determine_action(persona, maze):
     act_obj_pron = generate_action_pronunciatio(act_obj_desp, persona)
     act_obj_event = generate_act_obj_event_triple(act_game_object, act_obj_desp, persona)
 
-    # Adding the action to persona's queue.
-    persona.scratch.add_new_action(
+    return (
         new_address,
         int(act_dura),
         act_desp,
@@ -749,6 +883,185 @@ def _determine_action(persona, maze):
     )
 
 
+def _determine_action(persona, maze):
+    """
+    Creates the next action sequence for the persona.
+    The main goal of this function is to run "add_new_action" on the persona's
+    scratch space, which sets up all the action related variables for the next
+    action.
+    As a part of this, the persona may need to decompose its hourly schedule as
+    needed.
+    INPUT
+      persona: Current <Persona> instance whose action we are determining.
+      maze: Current <Maze> instance.
+    """
+    today_min_elapsed = persona.scratch.curr_time.hour * 60 + persona.scratch.curr_time.minute
+    curr_index = _decompose_schedule(persona, persona.scratch, today_min_elapsed)
+
+    # Generate an <Action> instance from the action description and duration. By
+    # this point, we assume that all the relevant actions are decomposed and
+    # ready in f_daily_schedule.
+    L.debug(
+        f"{persona.scratch.name} at index {curr_index} of "
+        f"{len(persona.scratch.f_daily_schedule)}: {persona.scratch.f_daily_schedule}"
+    )
+
+    act_desp, act_dura = persona.scratch.f_daily_schedule[curr_index]
+
+    # Adding the action to persona's queue.
+    persona.scratch.add_new_action(*_resolve_action(persona, maze, act_desp, act_dura))
+
+
+class _PrefetchView:
+    """
+    Stands in for a persona while we prefetch its next action. Attribute access
+    falls through to the persona, except for scratch and s_mem, which are
+    copies taken when the prefetch starts, so the worker never reads the
+    persona's state while the simulation thread changes it.
+    """
+
+    def __init__(self, persona, scratch, s_mem):
+        self.persona = persona
+        self.scratch = scratch
+        self.s_mem = s_mem
+
+    def __getattr__(self, name):
+        return getattr(self.persona, name)
+
+
+class ActionPrefetch:
+    """
+    A speculative, background run of _determine_action for the action that
+    follows the persona's current one. It works on a copy of f_daily_schedule,
+    of the current tile and of the spatial memory, so nothing is touched until
+    the result is committed at the action boundary.
+    """
+
+    def __init__(self, persona, maze, date, start_min):
+        # <date> and <start_min> identify the boundary (the end of the current
+        # action) the prefetch was computed for.
+        self.date = date
+        self.start_min = start_min
+        # <base_schedule>, <curr_tile> and <s_mem> are the state the prefetch
+        # started from. If the live state no longer matches it at commit time,
+        # something (e.g., a reaction, or a newly perceived object) changed it
+        # and the prefetch is stale.
+        self.base_schedule = [row[:] for row in persona.scratch.f_daily_schedule]
+        self.curr_tile = persona.scratch.curr_tile
+        self.s_mem = persona.s_mem.branch()
+        self.scratch = persona.scratch.schedule_copy()
+        # A future that is already running cannot be cancelled, so _run checks
+        # <cancelled> between its stages to stop making LLM requests.
+        self.cancelled = False
+        view = _PrefetchView(persona, self.scratch, self.s_mem)
+        # Speculation is background work; its LLM requests yield to the step's.
+        with llm_priority("batch"):
+            self.future = _prefetch_executor.submit(bind_thread_local(self._run), view, maze)
+
+    def _run(self, view, maze):
+        if self.cancelled:
+            return None
+        curr_index = _decompose_schedule(view, self.scratch, self.start_min)
+        if self.cancelled:
+            return None
+        act_desp, act_dura = self.scratch.f_daily_schedule[curr_index]
+        return _resolve_action(view, maze, act_desp, act_dura)
+
+    def matches(self, persona):
+        curr_time = persona.scratch.curr_time
+        return (
+            self.date == curr_time.date()
+            and self.start_min == curr_time.hour * 60 + curr_time.minute
+            and self.curr_tile == persona.scratch.curr_tile
+            and self.base_schedule == persona.scratch.f_daily_schedule
+            and self.s_mem.tree == persona.s_mem.tree
+        )
+
+    def cancel(self):
+        self.cancelled = True
+        self.future.cancel()
+
+
+_prefetch_executor = ThreadPoolExecutor(max_workers=max_parallel_llm_requests)
+
+
+def _start_action_prefetch(persona, maze):
+    """
+    Starts prefetching the persona's next action if there is not one in flight
+    already. We only speculate on plain scheduled actions that end later today,
+    and only once the hourly block the action ends in is the current one, so
+    that the task decomposition prompt sees the same context it would at the
+    boundary.
+    INPUT
+      persona: Current <Persona> instance.
+      maze: Current <Maze> instance.
+    """
+    if persona.action_prefetch or not persona.scratch.act_address:
+        return
+    if persona.scratch.chatting_with or "<waiting>" in persona.scratch.act_address:
+        return
+    # The action is resolved from the tile the persona is on, so we wait for
+    # it to reach the place of its current action, where it will be at the
+    # boundary.
+    if persona.scratch.planned_path:
+        return
+
+    x = persona.scratch.act_start_time
+    if x.second != 0:
+        x = x.replace(second=0)
+        x = x + datetime.timedelta(minutes=1)
+    end_time = x + datetime.timedelta(minutes=persona.scratch.act_duration)
+    curr_time = persona.scratch.curr_time
+    if end_time <= curr_time or end_time.date() != curr_time.date():
+        return
+
+    start_min = end_time.hour * 60 + end_time.minute
+    advance = start_min - (curr_time.hour * 60 + curr_time.minute)
+    if persona.scratch.get_f_daily_schedule_hourly_org_index(
+        advance
+    ) != persona.scratch.get_f_daily_schedule_hourly_org_index():
+        return
+
+    persona.action_prefetch = ActionPrefetch(persona, maze, end_time.date(), start_min)
+
+
+def _commit_action_prefetch(persona):
+    """
+    Commits the prefetched action if it was computed for the current boundary
+    and the schedule has not changed since. Waits for it if it is still running.
+    INPUT
+      persona: Current <Persona> instance.
+    OUTPUT
+      True if the prefetched action was committed, False otherwise.
+    """
+    prefetch = persona.action_prefetch
+    persona.action_prefetch = None
+    if not prefetch or not prefetch.matches(persona):
+        if prefetch:
+            prefetch.cancel()
+        return False
+
+    try:
+        action = prefetch.future.result()
+    except Exception as e:
+        L.warning(f"Discarding prefetched action for {persona.name}: {e}")
+        return False
+
+    persona.scratch.f_daily_schedule = prefetch.scratch.f_daily_schedule
+    persona.scratch.add_new_action(*action)
+    return True
+
+
+def _discard_action_prefetch(persona):
+    """
+    Drops any in-flight prefetch, e.g., when the schedule is about to be
+    rewritten.
+    """
+    if persona.action_prefetch:
+        persona.action_prefetch.cancel()
+        persona.action_prefetch = None
+
+
 def _choose_retrieved(persona, retrieved):
     """
     Retrieved elements have multiple core "curr_events". We need to choose one
@@ -924,6 +1237,8 @@ def _create_react(
     act_start_time=None,
 ):
     p = persona
+    # The reaction rewrites the schedule, so any prefetched action is stale.
+    _discard_action_prefetch(p)
 
     min_sum = 0
     for i in range(p.scratch.get_f_daily_schedule_hourly_org_index()):
@@ -964,20 +1279,11 @@ def _create_react(
         end_hour = start_hour + 2
     end_hour = int(end_hour)
 
-    dur_sum = 0
-    count = 0
-    start_index = None
-    end_index = None
-    for act, dur in p.scratch.f_daily_schedule:
-        if dur_sum >= start_hour * 60 and start_index == None:
-            start_index = count
-        if dur_sum >= end_hour * 60 and end_index == None:
-            end_index = count
-        dur_sum += dur
-        count += 1
+    start_index = p.scratch.get_f_daily_schedule_start_index(start_hour * 60)
+    end_index = p.scratch.get_f_daily_schedule_start_index(end_hour * 60)
 
     ret = generate_new_decomp_schedule(p, inserted_act, inserted_act_dur, start_hour, end_hour)
-    p.scratch.f_daily_schedule[start_index:end_index] = ret
+    p.scratch.splice_f_daily_schedule(start_index, end_index, ret)
     p.scratch.add_new_action(
         act_address,
         inserted_act_dur,
@@ -1171,6 +1477,7 @@ def plan(persona, maze, personas, new_day, retrieved):
 
     # PART 1: Generate the hourly schedule.
     if new_day:
+        _discard_action_prefetch(persona)
         _long_term_planning(persona, new_day, maze)
         # lg: generate_wake_up_hour()
         # lg: run_gpt_prompt_wake_up_hour()
@@ -1184,8 +1491,11 @@ def plan(persona, maze, personas, new_day, retrieved):
         # lg: get_embedding()
 
     # PART 2: If the current action has expired, we want to create a new plan.
+    # If the next action was already prefetched in the background, we commit it
+    # instead of determining it from scratch.
     if persona.scratch.act_check_finished():
-        _determine_action(persona, maze)
+        if not _commit_action_prefetch(persona):
+            _determine_action(persona, maze)
         # lg: generate_task_decomp()
         # lg: run_gpt_prompt_task_decomp()
         # lg: generate_action_sector()
@@ -1252,7 +1562,13 @@ def plan(persona, maze, personas, new_day, retrieved):
             # elif reaction_mode == "do other things":
             #   _chat_react(persona, focused_event, reaction_mode, personas)
 
-    # Step 3: Chat-related state clean up.
+    # Step 3: Start resolving the next action while the current one runs.
+    if prefetch_next_action:
+        _start_action_prefetch(persona, maze)
+    if plan_next_day_in_background:
+        _start_next_day_planning(persona)
+
+    # Step 4: Chat-related state clean up.
     # If the persona is not chatting with anyone, we clean up any of the
     # chat-related states here.
     if persona.scratch.act_event[1] != "chat with":
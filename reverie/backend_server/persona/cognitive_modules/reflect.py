@@ -137,50 +137,102 @@ def generate_memo_on_convo(persona, all_utt):
     return run_gpt_prompt_memo_on_convo(persona, all_utt)[0]
 
 
-def run_reflect(persona):
+def resolve_thoughts(persona, thoughts, triple_fn):
     """
-    Run the actual reflection. We generate the focal points, retrieve any
-    relevant nodes, and generate thoughts and insights.
+    Generates the event triple, poignancy score and embedding of every thought.
+    None of these calls depend on each other, so all of them are sent
+    concurrently and gathered before the thoughts are added to memory.
 
     INPUT:
       persona: Current Persona object
+      thoughts: A list of thought strings.
+      triple_fn: A function that takes a thought and returns its (s, p, o).
+    Output:
+      A list of (triple, poignancy, embedding) tuples, in the order of
+      <thoughts>.
+    """
+    calls = []
+    for thought in thoughts:
+        calls += [
+            lambda thought=thought: triple_fn(thought),
+            lambda thought=thought: generate_poig_score(persona, "thought", thought),
+            lambda thought=thought: get_embedding(thought),
+        ]
+    results = parallel_map(lambda call: call(), calls)
+    return [tuple(results[i : i + 3]) for i in range(0, len(results), 3)]
+
+
+def run_reflect_pipeline(persona, focal_points, triple_fn):
+    """
+    The reflection pipeline shared by run_reflect and run_reflect_new.
+
+    The stages run in dependency order: the focal point retrieval (with its
+    embeddings requested concurrently), then the insights of every focal point
+    in parallel, then the triple / poignancy / embedding of every thought in
+    parallel. The thoughts are added to the agent's memory last, in focal point
+    order, so the resulting node ids do not depend on which request finished
+    first.
+
+    INPUT:
+      persona: Current Persona object
+      focal_points: A list of focal point strings.
+      triple_fn: A function that takes a thought and returns its (s, p, o).
     Output:
       None
     """
-    # Reflection requires certain focal points. Generate that first.
-    focal_points = generate_focal_points(persona, 3)
     # Retrieve the relevant Nodes object for each of the focal points.
     # <retrieved> has keys of focal points, and values of the associated Nodes.
     retrieved = new_retrieve(persona, focal_points)
 
-    # For each of the focal points, generate thoughts and save it in the
-    # agent's memory.
     for focal_pt, nodes in retrieved.items():
-        xx = [i.embedding_key for i in nodes]
-        for xxx in xx:
-            print(xxx)
+        L.debug(f"{persona.name} reflecting on {focal_pt}: {[i.embedding_key for i in nodes]}")
+
+    # For each of the focal points, generate thoughts.
+    all_thoughts = parallel_map(
+        lambda nodes: generate_insights_and_evidence(persona, nodes, 5), retrieved.values()
+    )
+    pending = [
+        (thought, evidence) for thoughts in all_thoughts for thought, evidence in thoughts.items()
+    ]
+    resolved = resolve_thoughts(persona, [thought for thought, _ in pending], triple_fn)
+
+    # Save the thoughts in the agent's memory.
+    created = persona.scratch.curr_time
+    expiration = persona.scratch.curr_time + datetime.timedelta(days=30)
+    for (thought, evidence), ((s, p, o), thought_poignancy, embedding) in zip(pending, resolved):
+        keywords = set([s, p, o])
+        thought_embedding_pair = (thought, embedding)
+
+        L.debug(f"{persona.name} adding thought: s={s} p={p} o={o}")
+        persona.a_mem.add_thought(
+            created,
+            expiration,
+            s,
+            p,
+            o,
+            thought,
+            keywords,
+            thought_poignancy,
+            thought_embedding_pair,
+            evidence,
+        )
 
-        thoughts = generate_insights_and_evidence(persona, nodes, 5)
-        for thought, evidence in thoughts.items():
-            created = persona.scratch.curr_time
-            expiration = persona.scratch.curr_time + datetime.timedelta(days=30)
-            s, p, o = generate_action_event_triple(thought, persona)
-            keywords = set([s, p, o])
-            thought_poignancy = generate_poig_score(persona, "thought", thought)
-            thought_embedding_pair = (thought, get_embedding(thought))
 
-            persona.a_mem.add_thought(
-                created,
-                expiration,
-                s,
-                p,
-                o,
-                thought,
-                keywords,
-                thought_poignancy,
-                thought_embedding_pair,
-                evidence,
-            )
+def run_reflect(persona):
+    """
+    Run the actual reflection. We generate the focal points, retrieve any
+    relevant nodes, and generate thoughts and insights.
+
+    INPUT:
+      persona: Current Persona object
+    Output:
+      None
+    """
+    # Reflection requires certain focal points. Generate that first.
+    focal_points = generate_focal_points(persona, 3)
+    run_reflect_pipeline(
+        persona, focal_points, lambda thought: generate_action_event_triple(thought, persona)
+    )
 
 
 # tyn
@@ -196,39 +248,7 @@ def run_reflect_new(persona):
     """
     # Reflection requires certain focal points. Generate that first.
     focal_points = generate_focal_points_new(persona, 3)
-    # Retrieve the relevant Nodes object for each of the focal points.
-    # <retrieved> has keys of focal points, and values of the associated Nodes.
-    retrieved = new_retrieve(persona, focal_points)
-
-    # For each of the focal points, generate thoughts and save it in the
-    # agent's memory.
-    for focal_pt, nodes in retrieved.items():
-        xx = [i.embedding_key for i in nodes]
-        for xxx in xx:
-            print(xxx)
-
-        thoughts = generate_insights_and_evidence(persona, nodes, 5)
-        for thought, evidence in thoughts.items():
-            created = persona.scratch.curr_time
-            expiration = persona.scratch.curr_time + datetime.timedelta(days=30)
-            s, p, o = generate_action_event_triple_new(thought)
-            keywords = set([s, p, o])
-            thought_poignancy = generate_poig_score(persona, "thought", thought)
-            thought_embedding_pair = (thought, get_embedding(thought))
-
-            L.debug(f"{persona.name} adding thought: s={s} p={p} o={o}")
-            persona.a_mem.add_thought(
-                created,
-                expiration,
-                s,
-                p,
-                o,
-                thought,
-                keywords,
-                thought_poignancy,
-                thought_embedding_pair,
-                evidence,
-            )
+    run_reflect_pipeline(persona, focal_points, generate_action_event_triple_new)
 
 
 def reflection_trigger(persona):
@@ -171,7 +171,7 @@ def extract_importance(persona, nodes):
     return importance_out
 
 
-def extract_relevance(persona, nodes, focal_pt):
+def extract_relevance(persona, nodes, focal_pt, focal_embedding=None):
     """
     Gets the current Persona object, a list of nodes that are in a
     chronological order, and the focal_pt string and outputs a dictionary
@@ -181,11 +181,13 @@ def extract_relevance(persona, nodes, focal_pt):
       persona: Current persona whose memory we are retrieving.
       nodes: A list of Node object in a chronological order.
       focal_pt: A string describing the current thought of revent of focus.
+      focal_embedding: (Optional) the precomputed embedding of focal_pt.
     OUTPUT:
       relevance_out: A dictionary whose keys are the node.node_id and whose values
                    are the float that represents the relevance score.
     """
-    focal_embedding = get_embedding(focal_pt)
+    if focal_embedding is None:
+        focal_embedding = get_embedding(focal_pt)
 
     relevance_out = dict()
     for count, node in enumerate(nodes):
@@ -216,7 +218,11 @@ def new_retrieve(persona, focal_points, n_count=30):
     """
     # <retrieved> is the main dictionary that we are returning
     retrieved = dict()
-    for focal_pt in focal_points:
+    # The focal point embeddings do not depend on each other, so we request them
+    # all at once. Scoring below stays sequential because it updates
+    # last_accessed, which the next focal point's recency ordering depends on.
+    focal_embeddings = parallel_map(get_embedding, focal_points)
+    for focal_pt, focal_embedding in zip(focal_points, focal_embeddings):
         # Getting all nodes from the agent's memory (both thoughts and events) and
         # sorting them by the datetime of creation.
         # You could also imagine getting the raw conversation, but for now.
@@ -240,7 +246,7 @@ def new_retrieve(persona, focal_points, n_count=30):
         recency_out = normalize_dict_floats(recency_out, 0, 1)
         importance_out = extract_importance(persona, nodes)
         importance_out = normalize_dict_floats(importance_out, 0, 1)
-        relevance_out = extract_relevance(persona, nodes, focal_pt)
+        relevance_out = extract_relevance(persona, nodes, focal_pt, focal_embedding)
         # lg: cos_sim()
         relevance_out = normalize_dict_floats(relevance_out, 0, 1)
 
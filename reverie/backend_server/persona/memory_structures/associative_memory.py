@@ -8,6 +8,7 @@ Note (May 1, 2023) -- this class is the Memory Stream module in the generative
 agents paper. 
 """
 
+import copy
 import sys
 
 
@@ -15,8 +16,12 @@ import json
 import datetime
 
 from utils import *
+from utils.atomic_write import atomic_writes
+from utils.embedding_store import EmbeddingMap
 
 from persona.memory_structures.memory import *
+from persona.memory_structures.memory_index import INDEX_FILE, NODE_LOG, MemoryIndex
+from utils.step_log import step_log
 
 
 class ConceptNode:
@@ -84,7 +89,13 @@ class AssociativeMemory(Memory):
         self.kw_strength_event = dict()
         self.kw_strength_thought = dict()
 
-        self.embeddings = json.load(open(f_saved + "/embeddings.json"))
+        # <revision> counts the changes to this memory. Nodes only change when
+        # they are added (last_accessed is not saved).
+        self.revision = 0
+
+        # The vectors are shared with every other memory embedding the same
+        # texts (see utils/embedding_store.py).
+        self.embeddings = EmbeddingMap.from_json(json.load(open(f_saved + "/embeddings.json")))
 
         nodes_load = json.load(open(f_saved + "/nodes.json"))
         for count in range(len(nodes_load.keys())):
@@ -162,44 +173,165 @@ class AssociativeMemory(Memory):
         if kw_strength_load["kw_strength_thought"]:
             self.kw_strength_thought = kw_strength_load["kw_strength_thought"]
 
-    def save(self, out_json):
+        # The files we loaded from are up to date, and so is the index if it
+        # covers every node.
+        for file in ["nodes.json", "kw_strength.json", "embeddings.json"]:
+            self.saved[f"{f_saved}/{file}"] = self.revision
+        if check_if_file_exists(f"{f_saved}/{INDEX_FILE}"):
+            with open(f"{f_saved}/{INDEX_FILE}") as infile:
+                if len(json.load(infile)["types"]) == len(self.id_to_node):
+                    self.saved[f"{f_saved}/{INDEX_FILE}"] = self.revision
+        # <saved> also holds how many nodes of the node log are up to date.
+        self.saved[f"{f_saved}/{NODE_LOG}"] = self.logged_nodes(f"{f_saved}/{NODE_LOG}")
+        # <index> caches the MemoryIndex of the memory at a revision.
+        self.index = (None, None)
+
+    def save(self, out_json, batch=None):
+        """
+        Saves the memory into the out_json folder. Its files are only written
+        if the memory changed since they were last saved or loaded. Along
+        with them, we save the index used to query the memory without loading
+        it (see memory_index.py), and append the new nodes to the node log.
+        """
+        with atomic_writes(batch) as batch:
+            # Nodes never change once added, so only the new ones are logged,
+            # once the files that hold them are committed. A folder we know
+            # nothing about (e.g., after a rename, or for a branch) may hold a
+            # log already: we go on from its last node.
+            log_key = f"{out_json}/{NODE_LOG}"
+            start = self.saved.get(log_key)
+            if start is None:
+                start = self.logged_nodes(log_key)
+            node_count = len(self.id_to_node)
+            records = [
+                (count, self.node_record(self.id_to_node[f"node_{count}"]))
+                for count in range(start + 1, node_count + 1)
+            ]
+
+            def append_nodes():
+                step_log(log_key).extend(records)
+                self.saved[log_key] = node_count
+
+            batch.on_commit.append(append_nodes)
+
+            self.save_file(
+                f"{out_json}/{INDEX_FILE}",
+                self.revision,
+                lambda: self.get_index().to_json(),
+                batch,
+            )
+            self.save_file(out_json + "/nodes.json", self.revision, self.dump_nodes, batch)
+            self.save_file(
+                out_json + "/kw_strength.json", self.revision, self.dump_kw_strength, batch
+            )
+            self.save_file(
+                out_json + "/embeddings.json",
+                self.revision,
+                lambda: json.dumps(self.embeddings.to_json()),
+                batch,
+            )
+
+    def logged_nodes(self, log_key):
+        """
+        Returns how many of our nodes the node log log_key holds, i.e., the
+        count of the last node it holds if we have it.
+        """
+        logged = step_log(log_key).steps()
+        return min(len(self.id_to_node), len(logged) and logged[-1])
+
+    def dump_nodes(self):
         r = dict()
         for count in range(len(self.id_to_node.keys()), 0, -1):
             node_id = f"node_{str(count)}"
-            node = self.id_to_node[node_id]
-
-            r[node_id] = dict()
-            r[node_id]["node_count"] = node.node_count
-            r[node_id]["type_count"] = node.type_count
-            r[node_id]["type"] = node.type
-            r[node_id]["depth"] = node.depth
+            r[node_id] = self.node_record(self.id_to_node[node_id])
 
-            r[node_id]["created"] = node.created.strftime("%Y-%m-%d %H:%M:%S")
-            r[node_id]["expiration"] = None
-            if node.expiration:
-                r[node_id]["expiration"] = node.expiration.strftime("%Y-%m-%d %H:%M:%S")
-
-            r[node_id]["subject"] = node.subject
-            r[node_id]["predicate"] = node.predicate
-            r[node_id]["object"] = node.object
-
-            r[node_id]["description"] = node.description
-            r[node_id]["embedding_key"] = node.embedding_key
-            r[node_id]["poignancy"] = node.poignancy
-            r[node_id]["keywords"] = list(node.keywords)
-            r[node_id]["filling"] = node.filling
-
-        with open(out_json + "/nodes.json", "w") as outfile:
-            json.dump(r, outfile)
+        return json.dumps(r)
 
+    @staticmethod
+    def node_record(node):
+        """
+        Returns the record of a node, as saved in nodes.json.
+        """
+        r = dict()
+        r["node_count"] = node.node_count
+        r["type_count"] = node.type_count
+        r["type"] = node.type
+        r["depth"] = node.depth
+
+        r["created"] = node.created.strftime("%Y-%m-%d %H:%M:%S")
+        r["expiration"] = None
+        if node.expiration:
+            r["expiration"] = node.expiration.strftime("%Y-%m-%d %H:%M:%S")
+
+        r["subject"] = node.subject
+        r["predicate"] = node.predicate
+        r["object"] = node.object
+
+        r["description"] = node.description
+        r["embedding_key"] = node.embedding_key
+        r["poignancy"] = node.poignancy
+        r["keywords"] = list(node.keywords)
+        r["filling"] = node.filling
+        return r
+
+    def get_index(self):
+        revision, index = self.index
+        if revision != self.revision:
+            index = MemoryIndex.from_nodes(
+                self.id_to_node[f"node_{count}"] for count in range(1, len(self.id_to_node) + 1)
+            )
+            self.index = (self.revision, index)
+        return index
+
+    def query(self, **filters):
+        """
+        Finds a page of nodes by type, time range and keyword, newest first
+        (see MemoryIndex.query for the filters).
+
+        OUTPUT
+          A tuple of (the ConceptNodes of the page, the cursor of the next page
+          or None).
+        """
+        counts, cursor = self.get_index().query(**filters)
+        return [self.id_to_node[f"node_{count}"] for count in counts], cursor
+
+    def dump_kw_strength(self):
         r = dict()
         r["kw_strength_event"] = self.kw_strength_event
         r["kw_strength_thought"] = self.kw_strength_thought
-        with open(out_json + "/kw_strength.json", "w") as outfile:
-            json.dump(r, outfile)
-
-        with open(out_json + "/embeddings.json", "w") as outfile:
-            json.dump(self.embeddings, outfile)
+        return json.dumps(r)
+
+    def branch(self):
+        """
+        Returns a copy of this memory for a branched simulation (see
+        Reverie.fork). The nodes are copied, since retrieval updates their
+        last_accessed, but their contents and the embedding vectors are
+        shared, as those are never modified in place.
+        """
+        other = copy.copy(self)
+        nodes = {node_id: copy.copy(node) for node_id, node in self.id_to_node.items()}
+        other.id_to_node = nodes
+        other.seq_event = [nodes[node.node_id] for node in self.seq_event]
+        other.seq_thought = [nodes[node.node_id] for node in self.seq_thought]
+        other.seq_chat = [nodes[node.node_id] for node in self.seq_chat]
+        other.kw_to_event = {
+            kw: [nodes[node.node_id] for node in kw_nodes]
+            for kw, kw_nodes in self.kw_to_event.items()
+        }
+        other.kw_to_thought = {
+            kw: [nodes[node.node_id] for node in kw_nodes]
+            for kw, kw_nodes in self.kw_to_thought.items()
+        }
+        other.kw_to_chat = {
+            kw: [nodes[node.node_id] for node in kw_nodes]
+            for kw, kw_nodes in self.kw_to_chat.items()
+        }
+        other.kw_strength_event = dict(self.kw_strength_event)
+        other.kw_strength_thought = dict(self.kw_strength_thought)
+        other.embeddings = self.embeddings.copy()
+        other.saved = dict()
+        other.index = (None, None)
+        return other
 
     def add_event(
         self,
@@ -263,6 +395,7 @@ class AssociativeMemory(Memory):
                     self.kw_strength_event[kw] = 1
 
         self.embeddings[embedding_pair[0]] = embedding_pair[1]
+        self.revision += 1
 
         return node
 
@@ -329,6 +462,7 @@ class AssociativeMemory(Memory):
                     self.kw_strength_thought[kw] = 1
 
         self.embeddings[embedding_pair[0]] = embedding_pair[1]
+        self.revision += 1
 
         return node
 
@@ -382,6 +516,7 @@ class AssociativeMemory(Memory):
         self.id_to_node[node_id] = node
 
         self.embeddings[embedding_pair[0]] = embedding_pair[1]
+        self.revision += 1
 
         return node
 
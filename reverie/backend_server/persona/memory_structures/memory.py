@@ -1,6 +1,30 @@
 import sys
 
+from utils.atomic_write import atomic_writes
+
 
 class Memory:
     def __init__(self):
-        pass
+        # <saved> maps each file this memory was last written to (or read from)
+        # to a stamp of what it holds there (e.g., a revision or a digest), so
+        # that save can skip the files that are up to date.
+        self.saved = dict()
+
+    def save_file(self, path, stamp, dump, batch=None):
+        """
+        Writes the text returned by dump into path (atomically, through batch;
+        see utils/atomic_write.py), unless path already holds the content
+        stamped with stamp.
+
+        INPUT
+          path: The file to write.
+          stamp: A value that changes whenever the content changes.
+          dump: A callable returning the content.
+          batch: The AtomicWriteBatch to join, or None to write right away.
+        OUTPUT
+          None
+        """
+        if self.saved.get(path) == stamp:
+            return
+        with atomic_writes(batch) as batch:
+            batch.write(path, dump(), on_commit=lambda: self.saved.__setitem__(path, stamp))
@@ -0,0 +1,172 @@
+"""
+File: memory_index.py
+Description: An index of a persona's associative memory, written next to its
+nodes.json at save time, for paginated queries by type, time range and
+keyword that do not load every node.
+"""
+
+import bisect
+import json
+import os
+import threading
+
+from utils.config import memory_page_size
+from utils.step_log import step_log
+
+# The files the index is made of, in the associative_memory folder. The node
+# log holds the record of each node (as in nodes.json) keyed by its count.
+INDEX_FILE = "index.json"
+NODE_LOG = "node_log"
+
+
+class MemoryIndex:
+    """
+    <types>[i] and <created>[i] are the type and the creation time of
+    node_<i+1>. Times are "%Y-%m-%d %H:%M:%S" strings, so they compare in
+    order. <keywords> maps each lowercased keyword to the counts of its nodes,
+    in increasing order.
+    """
+
+    def __init__(self, types, created, keywords):
+        self.types = types
+        self.created = created
+        self.keywords = keywords
+
+    @classmethod
+    def from_nodes(cls, nodes):
+        """
+        ARGS:
+          nodes: the nodes (ConceptNode or their records in nodes.json), in
+            order of their counts.
+        """
+        types, created, keywords = [], [], dict()
+        for count, node in enumerate(nodes, 1):
+            if isinstance(node, dict):
+                node_type, node_created, node_keywords = (
+                    node["type"],
+                    node["created"],
+                    node["keywords"],
+                )
+            else:
+                node_type = node.type
+                node_created = node.created.strftime("%Y-%m-%d %H:%M:%S")
+                node_keywords = node.keywords
+            types.append(node_type)
+            created.append(node_created)
+            for kw in {kw.lower() for kw in node_keywords}:
+                keywords.setdefault(kw, []).append(count)
+        return cls(types, created, keywords)
+
+    def to_json(self):
+        return json.dumps(
+            {"types": self.types, "created": self.created, "keywords": self.keywords}
+        )
+
+    def __len__(self):
+        return len(self.types)
+
+    def query(
+        self,
+        node_type=None,
+        since=None,
+        until=None,
+        keyword=None,
+        cursor=None,
+        limit=memory_page_size,
+    ):
+        """
+        Finds a page of the nodes matching every given filter, newest first.
+
+        INPUT
+          node_type: "event", "chat" or "thought".
+          since, until: the range of creation times ("%Y-%m-%d %H:%M:%S"
+            strings or datetimes), both included.
+          keyword: a keyword of the nodes.
+          cursor: the cursor returned with the previous page, if any.
+          limit: the maximum number of nodes in the page (at least 1).
+        OUTPUT
+          A tuple of (the counts of the nodes of the page, the cursor of the
+          next page or None if this is the last one).
+        """
+        since, until = [
+            t.strftime("%Y-%m-%d %H:%M:%S") if hasattr(t, "strftime") else t
+            for t in (since, until)
+        ]
+        limit = max(int(limit), 1)
+        end = len(self) if cursor is None else min(int(cursor) - 1, len(self))
+        if keyword is not None:
+            counts = self.keywords.get(keyword.lower(), [])
+            candidates = reversed(counts[: bisect.bisect_right(counts, end)])
+        else:
+            candidates = range(end, 0, -1)
+
+        page = []
+        for count in candidates:
+            i = count - 1
+            if node_type and self.types[i] != node_type:
+                continue
+            if since and self.created[i] < since:
+                continue
+            if until and self.created[i] > until:
+                continue
+            if len(page) == limit:
+                return page, page[-1]
+            page.append(count)
+        return page, None
+
+
+indexes = dict()
+indexes_lock = threading.Lock()
+
+
+def load_index(folder):
+    """
+    Returns the MemoryIndex of the associative memory saved in folder, cached
+    until its files change. Memories saved before the index existed are
+    indexed from their nodes.json.
+    """
+    index_file = f"{folder}/{INDEX_FILE}"
+    nodes_file = f"{folder}/nodes.json"
+    path = index_file if os.path.exists(index_file) else nodes_file
+    mtime = os.stat(path).st_mtime_ns
+    with indexes_lock:
+        cached = indexes.get(folder)
+    if cached and cached[0] == (path, mtime):
+        return cached[1]
+
+    with open(path) as infile:
+        data = json.load(infile)
+    if path == index_file:
+        index = MemoryIndex(data["types"], data["created"], data["keywords"])
+    else:
+        index = MemoryIndex.from_nodes(data[f"node_{count}"] for count in range(1, len(data) + 1))
+    with indexes_lock:
+        indexes[folder] = ((path, mtime), index)
+    return index
+
+
+def read_nodes(folder, counts):
+    """
+    Returns the records (as in nodes.json) of the nodes with the given counts,
+    from the node log, or from nodes.json for the nodes that are not in it.
+    """
+    log = step_log(f"{folder}/{NODE_LOG}")
+    records = [log.read(count) for count in counts]
+    if None in records:
+        with open(f"{folder}/nodes.json") as infile:
+            nodes = json.load(infile)
+        records = [
+            record if record is not None else nodes[f"node_{count}"]
+            for count, record in zip(counts, records)
+        ]
+    return records
+
+
+def query_memory(folder, **filters):
+    """
+    Runs MemoryIndex.query on the associative memory saved in folder.
+    RETURNS:
+      A tuple of (the records of the nodes of the page, the next cursor).
+    """
+    counts, cursor = load_index(folder).query(**filters)
+    return read_nodes(folder, counts), cursor
@@ -5,7 +5,11 @@ File: scratch.py
 Description: Defines the short-term memory module for generative agents.
 """
 
+import bisect
+import copy
 import datetime
+import hashlib
+import itertools
 import json
 import sys
 
@@ -15,6 +19,84 @@ from utils import *
 from persona.memory_structures.memory import *
 
 
+def cumulative_minutes(schedule):
+    """
+    Returns the running total of the durations in a [task, duration] schedule,
+    i.e., the minute of the day at which each of its actions ends.
+
+    INPUT
+      schedule: A list of [task, duration] lists (e.g., f_daily_schedule).
+    OUTPUT
+      A list of integers of the same length as schedule.
+    """
+    return list(itertools.accumulate(duration for task, duration in schedule))
+
+
+def str_schedule_summary(schedule):
+    """
+    Returns a [task, duration] schedule as "HH:MM || task" lines, each with
+    the time at which its task ends.
+    """
+    ret = ""
+    curr_min_sum = 0
+    for row in schedule:
+        curr_min_sum += row[1]
+        hour = int(curr_min_sum / 60)
+        minute = curr_min_sum % 60
+        ret += f"{hour:02}:{minute:02} || {row[0]}\n"
+    return ret
+
+
+def str_scratch_summary(scratch):
+    """
+    Returns a comprehensive and well-formatted view of a persona's scratch.
+
+    INPUT
+      scratch: A Scratch, or any object with the ScratchData fields as
+        attributes (e.g., those of a PersonaSnapshot).
+    OUTPUT
+      A string.
+    """
+    ret_str = f"Scratch for {scratch.name}:\n"
+    ret_str += "=" * (len(ret_str) - 1) + "\n\n"
+
+    # Print core identity
+    ret_str += "Core Identity:\n"
+    ret_str += f"  Name: {scratch.name}\n"
+    ret_str += f"  Age: {scratch.age}\n"
+    ret_str += f"  Innate traits: {scratch.innate}\n"
+    ret_str += f"  Learned traits: {scratch.learned}\n"
+    ret_str += f"  Current state: {scratch.currently}\n"
+    ret_str += f"  Lifestyle: {scratch.lifestyle}\n"
+    ret_str += f"  Living area: {scratch.living_area}\n\n"
+
+    # Print current status
+    ret_str += "Current Status:\n"
+    ret_str += f"  Current time: {scratch.curr_time}\n"
+    ret_str += f"  Current tile: {scratch.curr_tile}\n"
+    ret_str += f"  Current action: {scratch.act_description}\n"
+    ret_str += f"  Action start time: {scratch.act_start_time}\n"
+    ret_str += f"  Action duration: {scratch.act_duration} minutes\n\n"
+
+    # Print planning information
+    ret_str += "Planning:\n"
+    ret_str += f"  Daily requirements: {scratch.daily_req}\n"
+    ret_str += "  Daily schedule:\n"
+    for item in scratch.f_daily_schedule:
+        ret_str += f"    - {item[0]} ({item[1]} minutes)\n"
+    ret_str += "  ...\n\n"
+
+    # Print reflection variables
+    ret_str += "Reflection Variables:\n"
+    ret_str += f"  Importance trigger current: {scratch.importance_trigger_curr}\n"
+    ret_str += f"  Importance trigger max: {scratch.importance_trigger_max}\n"
+    ret_str += f"  Recency weight: {scratch.recency_w}\n"
+    ret_str += f"  Relevance weight: {scratch.relevance_w}\n"
+    ret_str += f"  Importance weight: {scratch.importance_w}\n"
+
+    return ret_str
+
+
 class Scratch(Memory):
     def __init__(self, f_saved):
         super().__init__()
@@ -107,6 +189,21 @@ class Scratch(Memory):
         #        ['wakes up and starts her morning routine', 120],
         #        ['working on her painting', 240], ... ['going to bed', 60]]
         self.f_daily_schedule_hourly_org = []
+        # <staged_day_plan> holds the next day's plan when it was prepared in
+        # the background the evening before, until it is committed at the day
+        # boundary. It is not saved.
+        # e.g., {"date": date(2023, 2, 14), "currently": "...",
+        #        "daily_plan_req": "...", "f_daily_schedule": [...],
+        #        "thought_embedding_pair": ("This is ...", [...])}
+        self.staged_day_plan = None
+        # <_cum_minutes> caches cumulative_minutes of f_daily_schedule and
+        # f_daily_schedule_hourly_org so that index lookups are a bisect. Each
+        # entry holds the list it was built from (compared with "is", as ids
+        # are reused once a list is freed) and its length, so assigning a new
+        # schedule invalidates it. In-place edits of f_daily_schedule should go
+        # through splice_f_daily_schedule, and those of
+        # f_daily_schedule_hourly_org should assign a new list.
+        self._cum_minutes = dict()
 
         # CURR ACTION
         # <address> is literally the string address of where the action is taking
@@ -239,15 +336,23 @@ class Scratch(Memory):
             self.act_path_set = scratch_load["act_path_set"]
             self.planned_path = scratch_load["planned_path"]
 
-    def save(self, out_json):
+    def save(self, out_json, batch=None):
         """
-        Save persona's scratch.
+        Save persona's scratch. The file is only written if its content changed.
 
         INPUT:
           out_json: The file where we wil be saving our persona's state.
+          batch: The AtomicWriteBatch to write it through, if any.
         OUTPUT:
           None
         """
+        text = json.dumps(self.to_dict(), indent=2)
+        self.save_file(out_json, hashlib.sha1(text.encode()).hexdigest(), lambda: text, batch)
+
+    def to_dict(self):
+        """
+        Returns the persona's scratch as saved in scratch.json.
+        """
         scratch = dict()
         scratch["vision_r"] = self.vision_r
         scratch["att_bandwidth"] = self.att_bandwidth
@@ -308,9 +413,18 @@ class Scratch(Memory):
 
         scratch["act_path_set"] = self.act_path_set
         scratch["planned_path"] = self.planned_path
+        return scratch
 
-        with open(out_json, "w") as outfile:
-            json.dump(scratch, outfile, indent=2)
+    def _get_cum_minutes(self, attr):
+        """
+        Returns the (cached) cumulative_minutes of the schedule stored in attr.
+        """
+        schedule = getattr(self, attr)
+        cached = self._cum_minutes.get(attr)
+        if not cached or cached[0] is not schedule or cached[1] != len(schedule):
+            cached = (schedule, len(schedule), cumulative_minutes(schedule))
+            self._cum_minutes[attr] = cached
+        return cached[2]
 
     def get_f_daily_schedule_index(self, advance=0):
         """
@@ -319,9 +433,8 @@ class Scratch(Memory):
         Recall that self.f_daily_schedule stores the decomposed action sequences
         up until now, and the hourly sequences of the future action for the rest
         of today. Given that self.f_daily_schedule is a list of list where the
-        inner list is composed of [task, duration], we continue to add up the
-        duration until we reach "if elapsed > today_min_elapsed" condition. The
-        index where we stop is the index we will return.
+        inner list is composed of [task, duration], the current index is the
+        first one whose action ends after today_min_elapsed.
 
         INPUT
           advance: Integer value of the number minutes we want to look into the
@@ -334,24 +447,37 @@ class Scratch(Memory):
         today_min_elapsed += self.curr_time.hour * 60
         today_min_elapsed += self.curr_time.minute
         today_min_elapsed += advance
+        return self.get_f_daily_schedule_index_at(today_min_elapsed)
 
-        x = 0
-        for task, duration in self.f_daily_schedule:
-            x += duration
-        x = 0
-        for task, duration in self.f_daily_schedule_hourly_org:
-            x += duration
+    def get_f_daily_schedule_index_at(self, today_min_elapsed):
+        """
+        Same as get_f_daily_schedule_index, but for a given minute of the day.
 
-        # We then calculate the current index based on that.
-        curr_index = 0
-        elapsed = 0
-        for task, duration in self.f_daily_schedule:
-            elapsed += duration
-            if elapsed > today_min_elapsed:
-                return curr_index
-            curr_index += 1
+        INPUT
+          today_min_elapsed: Integer value of the minute of the day.
+        OUTPUT
+          an integer value for the index of f_daily_schedule at that minute.
+        """
+        cum = self._get_cum_minutes("f_daily_schedule")
+        return bisect.bisect_right(cum, today_min_elapsed)
+
+    def get_f_daily_schedule_start_index(self, today_min_elapsed):
+        """
+        Gets the index of the first action in self.f_daily_schedule that starts
+        at or after today_min_elapsed.
 
-        return curr_index
+        INPUT
+          today_min_elapsed: Integer value of the minute of the day.
+        OUTPUT
+          an integer index, or None if no action starts at or after that minute.
+        """
+        if today_min_elapsed <= 0:
+            return 0 if self.f_daily_schedule else None
+        cum = self._get_cum_minutes("f_daily_schedule")
+        index = bisect.bisect_left(cum, today_min_elapsed) + 1
+        if index < len(cum):
+            return index
+        return None
 
     def get_f_daily_schedule_hourly_org_index(self, advance=0):
         """
@@ -369,15 +495,66 @@ class Scratch(Memory):
         today_min_elapsed += self.curr_time.hour * 60
         today_min_elapsed += self.curr_time.minute
         today_min_elapsed += advance
-        # We then calculate the current index based on that.
-        curr_index = 0
-        elapsed = 0
-        for task, duration in self.f_daily_schedule_hourly_org:
-            elapsed += duration
-            if elapsed > today_min_elapsed:
-                return curr_index
-            curr_index += 1
-        return curr_index
+        cum = self._get_cum_minutes("f_daily_schedule_hourly_org")
+        return bisect.bisect_right(cum, today_min_elapsed)
+
+    def splice_f_daily_schedule(self, start, end, rows):
+        """
+        Replaces self.f_daily_schedule[start:end] with rows, and updates the
+        cumulative minutes of the schedule incrementally instead of rebuilding
+        them.
+
+        INPUT
+          start: The start index of the slice (None for 0).
+          end: The end index of the slice (None for the end of the schedule).
+          rows: A list of [task, duration] lists to put in place of the slice.
+        OUTPUT
+          None
+        """
+        cum = self._get_cum_minutes("f_daily_schedule")
+        n = len(cum)
+        start = 0 if start is None else min(start, n)
+        end = n if end is None else max(start, min(end, n))
+
+        base = cum[start - 1] if start > 0 else 0
+        removed = (cum[end - 1] if end > 0 else 0) - base
+        new_cum = list(itertools.accumulate((row[1] for row in rows), initial=base))[1:]
+        delta = (new_cum[-1] - base if new_cum else 0) - removed
+
+        self.f_daily_schedule[start:end] = rows
+        cum[start:] = new_cum + [i + delta for i in cum[end:]]
+        self._cum_minutes["f_daily_schedule"] = (
+            self.f_daily_schedule,
+            len(self.f_daily_schedule),
+            cum,
+        )
+
+    def get_f_daily_schedule_total(self):
+        """
+        Returns the total number of minutes covered by self.f_daily_schedule.
+        """
+        cum = self._get_cum_minutes("f_daily_schedule")
+        return cum[-1] if cum else 0
+
+    def schedule_copy(self):
+        """
+        Returns a shallow copy of this scratch with its own copy of
+        f_daily_schedule (and index), so the schedule can be edited
+        speculatively without touching this one.
+        """
+        other = copy.copy(self)
+        other.f_daily_schedule = [row[:] for row in self.f_daily_schedule]
+        other._cum_minutes = dict()
+        return other
+
+    def branch(self):
+        """
+        Returns a deep copy of this scratch for a branched simulation (see
+        Reverie.fork).
+        """
+        other = copy.deepcopy(self)
+        other._cum_minutes = dict()
+        return other
 
     def get_str_iss(self):
         """
@@ -578,64 +755,13 @@ class Scratch(Memory):
         return ret
 
     def get_str_daily_schedule_summary(self):
-        ret = ""
-        curr_min_sum = 0
-        for row in self.f_daily_schedule:
-            curr_min_sum += row[1]
-            hour = int(curr_min_sum / 60)
-            minute = curr_min_sum % 60
-            ret += f"{hour:02}:{minute:02} || {row[0]}\n"
-        return ret
+        return str_schedule_summary(self.f_daily_schedule)
 
     def get_str_daily_schedule_hourly_org_summary(self):
-        ret = ""
-        curr_min_sum = 0
-        for row in self.f_daily_schedule_hourly_org:
-            curr_min_sum += row[1]
-            hour = int(curr_min_sum / 60)
-            minute = curr_min_sum % 60
-            ret += f"{hour:02}:{minute:02} || {row[0]}\n"
-        return ret
+        return str_schedule_summary(self.f_daily_schedule_hourly_org)
 
     def get_str_summary(self):
         """
         Prints a comprehensive and well-formatted view of the persona's scratch.
         """
-        ret_str = f"Scratch for {self.name}:\n"
-        ret_str += "=" * (len(ret_str) - 1) + "\n\n"
-
-        # Print core identity
-        ret_str += "Core Identity:\n"
-        ret_str += f"  Name: {self.name}\n"
-        ret_str += f"  Age: {self.age}\n"
-        ret_str += f"  Innate traits: {self.innate}\n"
-        ret_str += f"  Learned traits: {self.learned}\n"
-        ret_str += f"  Current state: {self.currently}\n"
-        ret_str += f"  Lifestyle: {self.lifestyle}\n"
-        ret_str += f"  Living area: {self.living_area}\n\n"
-
-        # Print current status
-        ret_str += "Current Status:\n"
-        ret_str += f"  Current time: {self.curr_time}\n"
-        ret_str += f"  Current tile: {self.curr_tile}\n"
-        ret_str += f"  Current action: {self.act_description}\n"
-        ret_str += f"  Action start time: {self.act_start_time}\n"
-        ret_str += f"  Action duration: {self.act_duration} minutes\n\n"
-
-        # Print planning information
-        ret_str += "Planning:\n"
-        ret_str += f"  Daily requirements: {self.daily_req}\n"
-        ret_str += "  Daily schedule:\n"
-        for item in self.f_daily_schedule:
-            ret_str += f"    - {item[0]} ({item[1]} minutes)\n"
-        ret_str += "  ...\n\n"
-
-        # Print reflection variables
-        ret_str += "Reflection Variables:\n"
-        ret_str += f"  Importance trigger current: {self.importance_trigger_curr}\n"
-        ret_str += f"  Importance trigger max: {self.importance_trigger_max}\n"
-        ret_str += f"  Recency weight: {self.recency_w}\n"
-        ret_str += f"  Relevance weight: {self.relevance_w}\n"
-        ret_str += f"  Importance weight: {self.importance_w}\n"
-
-        return ret_str
+        return str_scratch_summary(self)
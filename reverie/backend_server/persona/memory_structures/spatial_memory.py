@@ -6,6 +6,8 @@ Description: Defines the MemoryTree class that serves as the agents' spatial
 memory that aids in grounding their behavior in the game world. 
 """
 
+import copy
+import hashlib
 import json
 import sys
 
@@ -38,9 +40,19 @@ class MemoryTree(Memory):
 
         _print_tree(self.tree, 0)
 
-    def save(self, out_json):
-        with open(out_json, "w") as outfile:
-            json.dump(self.tree, outfile)
+    def branch(self):
+        """
+        Returns a copy of this tree for a branched simulation (see
+        Reverie.fork).
+        """
+        other = copy.copy(self)
+        other.tree = copy.deepcopy(self.tree)
+        other.saved = dict()
+        return other
+
+    def save(self, out_json, batch=None):
+        text = json.dumps(self.tree)
+        self.save_file(out_json, hashlib.sha1(text.encode()).hexdigest(), lambda: text, batch)
 
     def get_str_accessible_sectors(self, curr_world):
         """
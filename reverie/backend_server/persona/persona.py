@@ -9,10 +9,13 @@ the term we used internally back in 2022, taking from our Social Simulacra
 paper.
 """
 
+import copy
 import datetime
 import math
+import os
 import random
 import sys
+import threading
 
 sys.path.append("../")
 
@@ -27,16 +30,119 @@ from persona.memory_structures.scratch import *
 from persona.memory_structures.spatial_memory import *
 from persona.workflow import *
 from utils import *
+from utils.atomic_write import atomic_writes
+from utils.config import lazy_persona_memories
 from utils.logs import L
 
 
 class Persona:
     def __init__(self):
         self.workflow = None
+        # The associative memory is loaded from <a_mem_folder> when first
+        # needed (see a_mem). <_a_mem> is None until then.
+        self.a_mem_folder = None
+        self._a_mem = None
+        self.a_mem_lock = threading.Lock()
 
     def single_workflow(self):
         pass
 
+    @property
+    def a_mem(self):
+        """
+        The persona's associative memory. Loading it parses every node and
+        loads every embedding, so with lazy_persona_memories (see
+        utils/config.py) it is loaded on first access, or in the background by
+        Reverie.load_memories, rather than when the persona is created.
+        """
+        a_mem = self._a_mem
+        if a_mem is None:
+            a_mem = self.load_memories()
+        return a_mem
+
+    @a_mem.setter
+    def a_mem(self, a_mem):
+        self._a_mem = a_mem
+
+    def load_memories(self):
+        """
+        Loads the associative memory, unless it is loaded already. May be
+        called from any thread; concurrent callers wait for the same load.
+
+        OUTPUT:
+          The AssociativeMemory.
+        """
+        with self.a_mem_lock:
+            if self._a_mem is None:
+                self._a_mem = AssociativeMemory(self.a_mem_folder)
+            return self._a_mem
+
+    def memories_loaded(self):
+        return self._a_mem is not None
+
+    def branch(self):
+        """
+        Returns a copy of this persona for a branched simulation (see
+        Reverie.fork), with memories of its own. Background work in flight is
+        not carried over.
+        """
+        other = copy.copy(self)
+        other.scratch = self.scratch.branch()
+        other.a_mem = self.a_mem.branch()
+        other.a_mem_lock = threading.Lock()
+        return other
+
+    def save(self, save_folder, batch=None):
+        """
+        Save persona's current state (i.e., memory). Only the files whose
+        content changed are written, atomically.
+
+        INPUT:
+          save_folder: The folder where we wil be saving our persona's state.
+          batch: The AtomicWriteBatch to write through; if None, the files are
+            committed together before returning.
+        OUTPUT:
+          None
+        """
+        with atomic_writes(batch) as batch:
+            self.save_memories(save_folder, batch)
+
+    def save_a_mem(self, folder, batch):
+        """
+        Saves the associative memory into folder (see save). A memory that was
+        never loaded has not changed since it was read, so it is only copied,
+        and only if folder is not the one it is read from.
+        """
+        if self.memories_loaded():
+            self.a_mem.save(folder, batch)
+        elif os.path.abspath(folder) != os.path.abspath(self.a_mem_folder):
+            for file in ["nodes.json", "kw_strength.json", "embeddings.json"]:
+                with open(f"{self.a_mem_folder}/{file}") as infile:
+                    batch.write(f"{folder}/{file}", infile.read())
+
+    def forget_saved(self, folder):
+        """
+        Drops what the memories recorded about the files they saved under
+        folder (see Memory.saved), e.g., a temporary folder the persona was
+        saved into once (see Reverie.write_checkpoint).
+        """
+        prefix = f"{folder}/"
+        for memory in [self.scratch, getattr(self, "s_mem", None), self._a_mem]:
+            saved = getattr(memory, "saved", None)
+            if saved:
+                for path in [path for path in saved if path.startswith(prefix)]:
+                    del saved[path]
+
+    def checkpoint_state(self):
+        """
+        Returns the state of this persona that save does not write, for a
+        checkpoint (see Reverie.write_checkpoint). It must be picklable.
+        """
+        return {}
+
+    def restore_checkpoint_state(self, state):
+        pass
+
 
 class GaPersona(Persona):
     def __init__(self, name, folder_mem_saved=False):
@@ -54,44 +160,52 @@ class GaPersona(Persona):
         # <s_mem> is the persona's spatial memory.
         f_s_mem_saved = f"{folder_mem_saved}/bootstrap_memory/spatial_memory.json"
         self.s_mem = MemoryTree(f_s_mem_saved)
-        # <s_mem> is the persona's associative memory.
-        f_a_mem_saved = f"{folder_mem_saved}/bootstrap_memory/associative_memory"
-        self.a_mem = AssociativeMemory(f_a_mem_saved)
+        # <a_mem> is the persona's associative memory.
+        self.a_mem_folder = f"{folder_mem_saved}/bootstrap_memory/associative_memory"
+        if not lazy_persona_memories:
+            self.load_memories()
         # <scratch> is the persona's scratch (short term memory) space.
         scratch_saved = f"{folder_mem_saved}/bootstrap_memory/scratch.json"
         self.scratch = Scratch(scratch_saved)
 
+        # <action_prefetch> is the in-flight <ActionPrefetch> of the persona's
+        # next action, if any. It is not saved.
+        self.action_prefetch = None
+        # <next_day_planning> is the in-flight background planning of the
+        # persona's next day, if any. Its result is staged in
+        # scratch.staged_day_plan.
+        self.next_day_planning = None
+
     def single_workflow(self, maze, personas, curr_tile, curr_time):
         return self.workflow.work(self, maze, personas, curr_tile, curr_time)
 
-    def save(self, save_folder):
-        """
-        Save persona's current state (i.e., memory).
+    def branch(self):
+        other = super().branch()
+        other.s_mem = self.s_mem.branch()
+        other.action_prefetch = None
+        other.next_day_planning = None
+        return other
 
-        INPUT:
-          save_folder: The folder where we wil be saving our persona's state.
-        OUTPUT:
-          None
-        """
+    def save_memories(self, save_folder, batch):
         # Spatial memory contains a tree in a json format.
         # e.g., {"double studio":
         #         {"double studio":
         #           {"bedroom 2":
         #             ["painting", "easel", "closet", "bed"]}}}
         f_s_mem = f"{save_folder}/spatial_memory.json"
-        self.s_mem.save(f_s_mem)
+        self.s_mem.save(f_s_mem, batch)
 
         # Associative memory contains a csv with the following rows:
         # [event.type, event.created, event.expiration, s, p, o]
         # e.g., event,2022-10-23 00:00:00,,Isabella Rodriguez,is,idle
         f_a_mem = f"{save_folder}/associative_memory"
-        self.a_mem.save(f_a_mem)
+        self.save_a_mem(f_a_mem, batch)
 
         # Scratch contains non-permanent data associated with the persona. When
         # it is saved, it takes a json form. When we load it, we move the values
         # to Python variables.
         f_scratch = f"{save_folder}/scratch.json"
-        self.scratch.save(f_scratch)
+        self.scratch.save(f_scratch, batch)
 
     def open_convo_session(self, convo_mode, vbase, input_queue):
         open_convo_session(self, convo_mode, vbase, input_queue)
@@ -115,9 +229,10 @@ class DaiPersona(Persona):
         # If there is already memory in folder_mem_saved, we load that. Otherwise,
         # we create new memory instances.
 
-        # <s_mem> is the persona's associative memory.
-        f_a_mem_saved = f"{folder_mem_saved}/bootstrap_memory/associative_memory"
-        self.a_mem = AssociativeMemory(f_a_mem_saved)
+        # <a_mem> is the persona's associative memory.
+        self.a_mem_folder = f"{folder_mem_saved}/bootstrap_memory/associative_memory"
+        if not lazy_persona_memories:
+            self.load_memories()
         # <scratch> is the persona's scratch (short term memory) space.
         scratch_saved = f"{folder_mem_saved}/bootstrap_memory/scratch.json"
         self.scratch = Scratch(scratch_saved)
@@ -125,26 +240,29 @@ class DaiPersona(Persona):
     def single_workflow(self, maze, curr_time):
         self.workflow.work(self, maze, curr_time)
 
-    def save(self, save_folder):
-        """
-        Save persona's current state (i.e., memory).
+    def branch(self):
+        other = super().branch()
+        other.read_positions = dict(self.read_positions)
+        return other
 
-        INPUT:
-          save_folder: The folder where we wil be saving our persona's state.
-        OUTPUT:
-          None
-        """
+    def checkpoint_state(self):
+        return {"read_positions": self.read_positions}
+
+    def restore_checkpoint_state(self, state):
+        self.read_positions = dict(state["read_positions"])
+
+    def save_memories(self, save_folder, batch):
         # Associative memory contains a csv with the following rows:
         # [event.type, event.created, event.expiration, s, p, o]
         # e.g., event,2022-10-23 00:00:00,,Isabella Rodriguez,is,idle
         f_a_mem = f"{save_folder}/associative_memory"
-        self.a_mem.save(f_a_mem)
+        self.save_a_mem(f_a_mem, batch)
 
         # Scratch contains non-permanent data associated with the persona. When
         # it is saved, it takes a json form. When we load it, we move the values
         # to Python variables.
         f_scratch = f"{save_folder}/scratch.json"
-        self.scratch.save(f_scratch)
+        self.scratch.save(f_scratch, batch)
 
     def chat_to_persona(self, mode, vbase, prev_msgs, msg):
         return chat_to_persona(self, mode, vbase, prev_msgs, msg)
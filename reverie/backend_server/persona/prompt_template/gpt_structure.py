@@ -14,6 +14,8 @@ from openai import OpenAI
 from utils.config import openai_api_base, openai_api_key, override_gpt_param, override_model
 from utils.logs import L, get_outer_caller
 from utils.llm_function import llm_request
+from utils.llm_scheduler import llm_scheduler
+from utils.embedding_store import embedding_digest, embedding_store
 
 client = OpenAI(api_key=openai_api_key, base_url=openai_api_base)
 
@@ -264,7 +266,17 @@ def get_embedding(text, model="text-embedding-ada-002"):
     text = text.replace("\n", " ")
     if not text:
         text = "this is blank"
-    return client.embeddings.create(input=[text], model=model).data[0].embedding
+    # Embeddings are kept in the shared store, so a text is only embedded
+    # once across personas, simulations and runs. The key covers the endpoint
+    # and the model as well as the text: another model embeds it differently.
+    store = embedding_store()
+    digest = embedding_digest(f"{openai_api_base}\n{model}\n{text}")
+    vector = store.get(digest)
+    if vector is None:
+        with llm_scheduler.slot():
+            vector = client.embeddings.create(input=[text], model=model).data[0].embedding
+        store.put(digest, vector)
+    return vector
 
 
 if __name__ == "__main__":
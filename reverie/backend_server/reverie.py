@@ -20,15 +20,18 @@ framework.
 """
 
 import asyncio
+import copy
 import datetime
 import json
 import math
 import os
 import pickle
 import shutil
+import tempfile
 import threading
 import time
 import traceback
+import types
 from dataclasses import asdict, dataclass, field, fields, replace
 from queue import Queue
 from typing import List, Optional, Tuple
@@ -46,8 +49,20 @@ from utils import config
 from utils.config import *
 from vector_db import *
 
+from api.websocket import sock_send
+from utils.async_writer import AsyncJsonWriter
+from utils.checkpoint import Checkpoint, write_checkpoint
+from utils.sim_store import JsonSimStore, open_sim_store, remove_simulation, transfer_simulation
+from utils.step_log import step_log
+from persona.memory_structures import memory_index
+from utils.llm_scheduler import llm_priority
+
 rs_lock = threading.Lock()
 
+# The options of the "print persona associative memory" command (see
+# MemoryIndex.query), with the type of their values.
+MEMORY_QUERY_OPTIONS = {"cursor": str, "keyword": str, "since": str, "until": str, "limit": int}
+
 
 
 ##############################################################################
@@ -160,6 +175,98 @@ class ReverieConfig:
     initial_rounds: int | None = 0  # The number of initial rounds
     sec_per_step: int | None = 3600
 
+class PersonaSnapshot:
+    """
+    A read-only view of the personas as of the end of one simulation step,
+    published by Reverie after every step. Read endpoints serve it without
+    touching the personas the simulation thread is mutating. <version> is the
+    step it was taken at. Nothing in it is modified after it is published.
+    """
+
+    summary_fields = [
+        "first_name",
+        "last_name",
+        "age",
+        "innate",
+        "learned",
+        "currently",
+        "lifestyle",
+        "living_area",
+        "act_event",
+    ]
+
+    def __init__(self, version, curr_time, personas):
+        self.version = version
+        self.curr_time = curr_time.strftime("%B %d, %Y, %H:%M:%S")
+        self.summaries = []
+        # <scratches> maps a persona name to a deep copy of the ScratchData
+        # fields of its scratch.
+        self.scratches = dict()
+        for persona_name, persona in personas.items():
+            scratch = vars(persona.scratch)
+            summary = {"name": persona_name}
+            summary.update({key: copy.deepcopy(scratch[key]) for key in self.summary_fields})
+            self.summaries.append(summary)
+            self.scratches[persona_name] = {
+                key: copy.deepcopy(scratch[key]) for key in ScratchData.__fields__ if key in scratch
+            }
+        # Validated ScratchData dicts, filled on first request.
+        self.details = dict()
+        self.lock = threading.Lock()
+
+    def detail(self, persona_name):
+        """
+        Returns the validated ScratchData dict of a persona, or None if there
+        is no such persona. Raises ValidationError if the scratch is invalid.
+        """
+        if persona_name not in self.scratches:
+            return None
+        with self.lock:
+            if persona_name not in self.details:
+                self.details[persona_name] = ScratchData(**self.scratches[persona_name]).dict()
+            return self.details[persona_name]
+
+    def query(self, sim_command, maze):
+        """
+        Answers the read-only REPL commands of open_server that only need the
+        personas' scratches ("print persona scratch", "print persona schedule",
+        "print all persona schedule", "print hourly org persona schedule" and
+        "print persona current tile") from the snapshot, so that they do not
+        wait behind a run in the command queue.
+
+        INPUT
+          sim_command: The command, as sent to the command queue.
+          maze: The Maze of the simulation, whose tile sectors do not change.
+        OUTPUT
+          The result of the command, or None if it is not one of them. Raises
+          KeyError if the persona of the command is not in the snapshot.
+        """
+        sim_command = sim_command.strip()
+        command = sim_command.lower()
+        scratches = {
+            persona_name: types.SimpleNamespace(**scratch)
+            for persona_name, scratch in self.scratches.items()
+        }
+        persona_name = " ".join(sim_command.split()[-2:])
+        if "print persona scratch" in command[:21]:
+            return f"importance_trigger_curr: {str_scratch_summary(scratches[persona_name])}"
+        if "print persona schedule" in command[:22]:
+            return str_schedule_summary(scratches[persona_name].f_daily_schedule)
+        if "print all persona schedule" in command[:26]:
+            ret_str = ""
+            for persona_name, scratch in scratches.items():
+                ret_str += f"{persona_name}\n"
+                ret_str += f"{str_schedule_summary(scratch.f_daily_schedule)}\n"
+                ret_str += f"---\n"
+            return ret_str
+        if "print hourly org persona schedule" in command:
+            return str_schedule_summary(scratches[persona_name].f_daily_schedule_hourly_org)
+        if "print persona current tile" in command[:26]:
+            curr_tile = scratches[persona_name].curr_tile
+            return str(curr_tile) + "\n" + repr(maze.access_tile(curr_tile)["sector"])
+        return None
+
+
 def load_config_from_files(path: str) -> ReverieConfig:
     meta_file_path = f"{path}/reverie/meta.json"
     event_file_path = f"{path}/reverie/events.json"
@@ -223,7 +330,7 @@ def bootstrap_persona(path: str, config: ScratchData):
                 scratch_data[field] = value
 
         # Save the updated scratch.json
-        with open(scratch_file_path, "w") as f:
+        with open_private(scratch_file_path, "w") as f:
             json.dump(scratch_data, f, indent=4)
 
     # Define the required directory structure
@@ -295,17 +402,38 @@ def bootstrap_persona(path: str, config: ScratchData):
 
 
 class Reverie:
-    def __init__(self, template_sim_code, sim_config: ReverieConfig, reverie_storage_path=""):
+    def __init__(
+        self, template_sim_code, sim_config: ReverieConfig, reverie_storage_path="", progress=None
+    ):
+        # <progress> is an optional callable taking (stage, done, total) that we
+        # call as the initialization goes along, e.g., to report it in /status.
+        if not progress:
+            progress = lambda stage, done, total: None
+
         # Check if all required fields in sim_config are populated
         missing_fields = []
 
         self.is_running = False
         self.command_queue = Queue()  # User command input queue
-        self.message_queue = Queue()
+        # Persists the movement files off the simulation thread (see
+        # persist_movement_files in utils/config.py). <sent_movements> holds the
+        # last movement streamed per persona, so only changes are streamed.
+        self.movement_writer = AsyncJsonWriter() if persist_movement_files else None
+        self.sent_movements = dict()
+        # The latest PersonaSnapshot, and an optional callable taking it that
+        # we call whenever a new one is published.
+        self.snapshot = None
+        self.on_snapshot = None
+        # An optional RunTicket that admits every step of a run (see
+        # max_active_runs in utils/config.py).
+        self.run_ticket = None
 
         if not reverie_storage_path:
             reverie_storage_path = storage_path
         self.storage_path = reverie_storage_path
+        # <store> persists the simulation (see sim_store in utils/config.py).
+        # The simulation folder is its working copy.
+        self.store = open_sim_store(self.storage_path)
 
         # L.info(f"Initializing Reverie with template {template_sim_code} and config {sim_config}")
 
@@ -326,53 +454,43 @@ class Reverie:
         self.sim_code = sim_config.sim_code
         sim_folder = f"{self.storage_path}/{self.sim_code}"
 
-        if check_if_dir_exists(sim_folder):
-            if self.sim_code in BASE_TEMPLATES:
-                L.error(
-                    f"Cannot overwrite base template {self.template_sim_code}. Operation aborted."
-                )
-            else:
-                L.warning(
-                    f"Simulation {sim_folder} exists. It will be overwritten by the new environment."
-                )
-                removeanything(sim_folder)
+        # If the template is the simulation itself, we resume the simulation from
+        # its own (saved) folder, e.g., after it was hibernated. Nothing is copied
+        # or bootstrapped, and the saved state is loaded as is.
+        resume = self.template_sim_code == self.sim_code
 
-        copyanything(template_folder, sim_folder)
+        if not resume:
+            if check_if_dir_exists(sim_folder):
+                if self.sim_code in BASE_TEMPLATES:
+                    L.error(
+                        f"Cannot overwrite base template {self.template_sim_code}. Operation aborted."
+                    )
+                else:
+                    L.warning(
+                        f"Simulation {sim_folder} exists. It will be overwritten by the new environment."
+                    )
+                    removeanything(sim_folder)
+
+            progress("copying template", 0, 1)
+            if fork_with_hardlinks:
+                linkanything(template_folder, sim_folder)
+            else:
+                copyanything(template_folder, sim_folder)
 
         try:
             self.sim_mode = sim_config.sim_mode
 
-            reverie_meta = {}
-            # reverie_meta is loaded from the meta.json file in the simulation folder. This is only for backward compatibility
-
-            with open(f"{sim_folder}/reverie/meta.json", "r") as infile:
-                reverie_meta = json.load(infile)
-            reverie_meta["curr_time"] = sim_config.curr_time
-            reverie_meta["step"] = sim_config.step
-            reverie_meta["persona_names"] = [
-                persona.name for persona in sim_config.persona_configs.values()
-            ]
-            reverie_meta["maze_name"] = sim_config.maze_name
-            reverie_meta["sim_mode"] = sim_config.sim_mode
-            reverie_meta["start_date"] = sim_config.start_date
-            reverie_meta["llm_config"] = asdict(sim_config.llm_config)
-
-            # This one should be called sim_code, but call it template_sim_code to maintain backward compatability
-            reverie_meta["template_sim_code"] = sim_config.sim_code
             self.storage_home = f"{self.storage_path}/{self.sim_code}"
-
-            # check fields for reverie_meta
-
-            if "sim_mode" not in reverie_meta:
-                reverie_meta["sim_mode"] = "offline"
-
-            with open(f"{sim_folder}/reverie/meta.json", "w") as outfile:
-                outfile.write(json.dumps(reverie_meta, indent=2))
-
-            # SAVING EVENTS INTO STORAGE
-            events = sim_config.public_events
-            with open(f"{sim_folder}/reverie/events.json", "w") as outfile:
-                outfile.write(json.dumps(events, indent=2))
+            if resume and self.store.incremental and self.store.exists(self.sim_code):
+                # The store holds the latest state; the folder is refreshed
+                # from it before we load it.
+                folders = JsonSimStore(self.storage_path)
+                transfer_simulation(self.store, folders, self.sim_code, steps=False)
+            if resume:
+                with open(f"{sim_folder}/reverie/meta.json", "r") as infile:
+                    reverie_meta = json.load(infile)
+            else:
+                reverie_meta = self.write_sim_meta(sim_folder, sim_config)
 
             # LOADING REVERIE'S GLOBAL VARIABLES
             # Whether the reverie runs in offline mode or online mode
@@ -399,6 +517,7 @@ class Reverie:
             # <maze> is the main Maze instance. Note that we pass in the maze_name
             # (e.g., "double_studio") to instantiate Maze.
             # e.g., Maze("double_studio")
+            progress("loading maze", 0, 1)
             self.is_offline_mode = reverie_meta["sim_mode"] == "offline"
             if self.is_offline_mode:
                 self.maze = OfflineMaze(reverie_meta["maze_name"])
@@ -440,12 +559,21 @@ class Reverie:
             # For each persona in the ScratchData:
             # 1. If it is a newly created persona, create the folder and files for it.
             # 2. If it is an existing persona, we should update the persona information accordingly.
-            for name, persona in sim_config.persona_configs.items():
-                bootstrap_persona(f"{self.storage_home}/personas/{name}", persona)
-
-            init_env_file = f"{sim_folder}/environment/{str(self.step)}.json"
-            init_env = json.load(open(init_env_file))
-            for persona_name in reverie_meta["persona_names"]:
+            if not resume:
+                for name, persona in sim_config.persona_configs.items():
+                    bootstrap_persona(f"{self.storage_home}/personas/{name}", persona)
+                if self.store.incremental:
+                    progress("importing simulation", 0, 1)
+                    transfer_simulation(JsonSimStore(self.storage_path), self.store, self.sim_code)
+
+            init_env = self.store.read_step(self.sim_code, "environment", self.step)
+            if resume and init_env is None:
+                # Only the initial environment is stored; a resumed simulation
+                # continues from the positions of its last step.
+                init_env = self.store.read_positions(self.sim_code)
+            persona_count = len(reverie_meta["persona_names"])
+            for persona_index, persona_name in enumerate(reverie_meta["persona_names"]):
+                progress("loading personas", persona_index, persona_count)
                 persona_folder = f"{sim_folder}/personas/{persona_name}"
                 if self.is_offline_mode:
                     p_x = init_env[persona_name]["x"]
@@ -499,15 +627,297 @@ class Reverie:
             )  # extend planning cycle
             self.maze.need_stagely_planning = True  # extend planning cycle
 
-            self.command_queue.put(f"run {sim_config.initial_rounds}")
+            if not resume:
+                self.command_queue.put(f"run {sim_config.initial_rounds}")
+
+            self.publish_snapshot()
 
             self.interested = False # Whether current run is interested. If calls to large language model is generated in current run ,then current run is 'interested'.
         except Exception as e:
             L.error(f"Error during reverie initialization: {e}")
-            if self.sim_code not in BASE_TEMPLATES:
-                removeanything(f"{self.storage_path}/{self.sim_code}")
+            if not resume and self.sim_code not in BASE_TEMPLATES:
+                remove_simulation(self.storage_path, self.sim_code)
             raise e
 
+    def write_sim_meta(self, sim_folder, sim_config: ReverieConfig):
+        """
+        Updates the simulation's meta.json from sim_config and saves its public
+        events into events.json.
+
+        INPUT
+          sim_folder: The simulation folder.
+          sim_config: The <ReverieConfig> of the simulation.
+        OUTPUT
+          The updated meta dictionary.
+        """
+        reverie_meta = {}
+        # reverie_meta is loaded from the meta.json file in the simulation folder. This is only for backward compatibility
+
+        with open(f"{sim_folder}/reverie/meta.json", "r") as infile:
+            reverie_meta = json.load(infile)
+        reverie_meta["curr_time"] = sim_config.curr_time
+        reverie_meta["step"] = sim_config.step
+        reverie_meta["persona_names"] = [
+            persona.name for persona in sim_config.persona_configs.values()
+        ]
+        reverie_meta["maze_name"] = sim_config.maze_name
+        reverie_meta["sim_mode"] = sim_config.sim_mode
+        reverie_meta["start_date"] = sim_config.start_date
+        reverie_meta["llm_config"] = asdict(sim_config.llm_config)
+
+        # This one should be called sim_code, but call it template_sim_code to maintain backward compatability
+        reverie_meta["template_sim_code"] = sim_config.sim_code
+
+        # check fields for reverie_meta
+
+        if "sim_mode" not in reverie_meta:
+            reverie_meta["sim_mode"] = "offline"
+
+        with open_private(f"{sim_folder}/reverie/meta.json", "w") as outfile:
+            outfile.write(json.dumps(reverie_meta, indent=2))
+
+        # SAVING EVENTS INTO STORAGE
+        events = sim_config.public_events
+        with open_private(f"{sim_folder}/reverie/events.json", "w") as outfile:
+            outfile.write(json.dumps(events, indent=2))
+
+        return reverie_meta
+
+    def adopt(self, sim_config: ReverieConfig):
+        """
+        Turns this already loaded (warm) simulation into the simulation
+        described by sim_config: the simulation folder is renamed to
+        sim_config.sim_code and the persona overrides, LLM config and events of
+        sim_config are applied. Only the scratch of the personas whose config
+        differs is reloaded; the maze and the associative memories are kept.
+
+        INPUT
+          sim_config: The <ReverieConfig> of the new simulation.
+        OUTPUT
+          True if the simulation was adopted. False if sim_config needs a
+          different maze, mode, step or set of personas, in which case nothing
+          is changed.
+        """
+        if (
+            sim_config.sim_mode != self.sim_mode
+            or sim_config.maze_name != self.sim_config.maze_name
+            or sim_config.step != self.step
+            or set(sim_config.persona_configs) != set(self.personas)
+        ):
+            return False
+
+        # The memories of warm simulations are loaded before they are adopted
+        # (see WarmPool in server.py), as they would be read from old_folder.
+        old_sim_code = self.sim_code
+        old_folder = f"{self.storage_path}/{self.sim_code}"
+        sim_folder = f"{self.storage_path}/{sim_config.sim_code}"
+        os.rename(old_folder, sim_folder)
+        self.sim_code = sim_config.sim_code
+        self.storage_home = sim_folder
+        self.sim_config = sim_config
+
+        self.write_sim_meta(sim_folder, sim_config)
+        self.start_time = datetime.datetime.strptime(
+            f"{sim_config.start_date}, 00:00:00", "%B %d, %Y, %H:%M:%S"
+        )
+        self.curr_time = datetime.datetime.strptime(sim_config.curr_time, "%B %d, %Y, %H:%M:%S")
+        self.maze.last_planning_day = self.curr_time + datetime.timedelta(days=-1)
+
+        for name, persona_config in sim_config.persona_configs.items():
+            persona_folder = f"{sim_folder}/personas/{name}"
+            scratch_file = f"{persona_folder}/bootstrap_memory/scratch.json"
+            with open(scratch_file) as f:
+                old_scratch = f.read()
+            bootstrap_persona(persona_folder, persona_config)
+            with open(scratch_file) as f:
+                if f.read() == old_scratch:
+                    continue
+
+            persona = self.personas[name]
+            if self.is_offline_mode:
+                p_x, p_y = self.personas_tile[name]
+                self.maze.tiles[p_y][p_x]["events"].discard(
+                    persona.scratch.get_curr_event_and_desc()
+                )
+            persona.scratch = Scratch(scratch_file)
+            if self.is_offline_mode:
+                self.maze.tiles[p_y][p_x]["events"].add(persona.scratch.get_curr_event_and_desc())
+
+        if self.store.incremental:
+            self.store.delete_simulation(old_sim_code)
+            transfer_simulation(JsonSimStore(self.storage_path), self.store, self.sim_code)
+
+        curr_sim_code = dict()
+        curr_sim_code["sim_code"] = self.sim_code
+        with open(f"{temp_storage_path}/curr_sim_code.json", "w") as outfile:
+            outfile.write(json.dumps(curr_sim_code, indent=2))
+
+        self.command_queue = Queue()
+        self.command_queue.put(f"run {sim_config.initial_rounds}")
+        self.publish_snapshot()
+        return True
+
+    def send_movements(self, movements):
+        """
+        Streams a step's movements to the websocket clients through the
+        "movement" channel. Only the personas whose movement changed since the
+        last step are sent; the channel keeps the latest one per persona, so a
+        client that falls behind catches up with the current positions.
+        INPUT
+          movements: {"persona": {<name>: <movement>}, "meta": {"curr_time"}}
+        OUTPUT
+          None
+        """
+        for persona_name, movement in movements["persona"].items():
+            if self.sent_movements.get(persona_name) == movement:
+                continue
+            self.sent_movements[persona_name] = movement
+            sock_send(
+                {"step": self.step, "persona": persona_name, **movement},
+                "movement",
+                key=persona_name,
+            )
+        sock_send({"step": self.step, **movements["meta"]}, "movement", key="<meta>")
+
+    def chat_to_persona(self, persona, mode, prev_msgs, msg):
+        retval = persona.chat_to_persona(
+            mode, None if self.sim_mode == "online" else self.maze.vbase, prev_msgs, msg
+        )
+        event_trigger("chat_to_persona", {"mode": mode, "persona": persona.name, "reply": retval})
+
+    def interview(self, reverie_instance, persona_name, payload):
+        """
+        Answers a chat that does not change the persona (see
+        interactive_chat_modes in utils/config.py) on a worker thread, instead
+        of queueing it behind the runs in <command_queue>. It works on an
+        InterviewView of the persona and its LLM requests are served first.
+        INPUT
+          reverie_instance: the ReverieInstance the reply is sent through.
+          persona_name: the persona to chat with.
+          payload: {"mode", "prev_msgs", "msg"}, as for "call -- chat to persona".
+        OUTPUT
+          None
+        """
+        thread_local.reverie_instance = reverie_instance
+        thread_local.reverie_local = self
+        try:
+            with llm_priority("interactive"):
+                self.chat_to_persona(
+                    InterviewView(self.personas[persona_name]),
+                    payload.get("mode", "interview"),
+                    payload.get("prev_msgs", []),
+                    payload.get("msg", ""),
+                )
+        finally:
+            # The worker goes on to serve other simulations; it must not keep
+            # this one alive or send its messages to it.
+            thread_local.reverie_instance = None
+            thread_local.reverie_local = None
+
+    def print_memory_page(self, persona_name, node_type, **filters):
+        """
+        Returns a page of the associative memory of a persona as text (see
+        AssociativeMemory.query for the filters).
+        """
+        persona = self.personas[persona_name]
+        nodes, cursor = persona.a_mem.query(node_type=node_type, **filters)
+        lines = [f"{persona}"]
+        for node in nodes:
+            if node_type == "chat":
+                lines.append(f"with {node.object} ({node.description})")
+                lines.append(node.created.strftime("%B %d, %Y, %H:%M:%S"))
+                lines += [f"{row[0]}: {row[1]}" for row in node.filling]
+            else:
+                lines.append(
+                    f"{node_type.capitalize()} {node.type_count}: "
+                    f"{node.spo_summary()} -- {node.description}"
+                )
+        if cursor:
+            lines.append(f"(more: -- cursor={cursor})")
+        return "\n".join(lines) + "\n"
+
+    def load_memories(self, progress=None):
+        """
+        Loads the associative memories of the personas that are not loaded yet
+        (see Persona.a_mem and lazy_persona_memories in utils/config.py), one
+        persona at a time. Meant to run in the background once the simulation
+        is ready; a step that needs a memory before then loads it, or waits
+        for its load to finish.
+
+        INPUT
+          progress: An optional callable taking (done, total).
+        OUTPUT
+          None
+        """
+        personas = list(self.personas.values())
+        for done, persona in enumerate(personas):
+            if progress:
+                progress(done, len(personas))
+            persona.load_memories()
+        if progress:
+            progress(len(personas), len(personas))
+
+    def schedule_checkpoint(self):
+        # Writes a checkpoint every <checkpoint_every_steps> steps, if enabled.
+        if checkpoint_every_steps and self.step % checkpoint_every_steps == 0:
+            try:
+                self.write_checkpoint()
+            except Exception as e:
+                L.error(f"Error writing checkpoint of {self.sim_code}: {e}")
+
+    def publish_snapshot(self):
+        """
+        Publishes a PersonaSnapshot of the current step. Called from the
+        simulation thread between steps, when the personas are consistent.
+        """
+        self.snapshot = PersonaSnapshot(self.step, self.curr_time, self.personas)
+        if self.on_snapshot:
+            self.on_snapshot(self.snapshot)
+
+    def fork(self, sim_code):
+        """
+        Clones this simulation at the current step into a new simulation, in
+        memory. The child shares the static state (the maze layout, the
+        contents of the memory nodes and the embeddings) with us, and its
+        folder starts as hard links to ours (see linkanything), so only what
+        it changes takes up memory and disk.
+        Must be called from our command loop, between runs.
+        INPUT
+          sim_code: the code of the new simulation.
+        OUTPUT
+          The new Reverie. Its command loop is not started.
+        """
+        sim_folder = f"{self.storage_path}/{self.sim_code}"
+        child_folder = f"{self.storage_path}/{sim_code}"
+        if check_if_dir_exists(child_folder):
+            raise ValueError(f"Simulation {sim_code} already exists")
+        if self.movement_writer:
+            self.movement_writer.flush()
+        linkanything(sim_folder, child_folder)
+        if self.store.incremental:
+            self.store.copy_simulation(self.sim_code, sim_code)
+
+        child = copy.copy(self)
+        child.sim_code = sim_code
+        child.template_sim_code = self.sim_code
+        child.sim_config = replace(self.sim_config, sim_code=sim_code, initial_rounds=0)
+        child.storage_home = child_folder
+        child.command_queue = Queue()
+        child.is_running = False
+        child.maze = self.maze.branch()
+        child.personas = {name: persona.branch() for name, persona in self.personas.items()}
+        if self.is_offline_mode:
+            child.personas_tile = dict(self.personas_tile)
+        child.personas_positions = {
+            name: dict(position) for name, position in self.personas_positions.items()
+        }
+        child.movement_writer = AsyncJsonWriter() if persist_movement_files else None
+        child.sent_movements = dict(self.sent_movements)
+        child.on_snapshot = None
+        child.run_ticket = None
+        child.publish_snapshot()
+        return child
+
     def handle_command(self, payload):
         self.command_queue.put(payload)
 
@@ -522,11 +932,69 @@ class Reverie:
           None
           * Saves all relevant data to the designated memory directory
         """
-        # <sim_folder> points to the current simulation folder.
-        sim_folder = f"{self.storage_path}/{self.sim_code}"
+        # Save the positions the simulation continues from, after the queued
+        # movement files are written.
+        if self.movement_writer:
+            self.movement_writer.flush()
+        # Everything is written in one transaction of the store. With the
+        # SQLite store, the save as a whole is either committed or not. With
+        # the JSON files, it is one batch (see utils/atomic_write.py): each
+        # file is either fully written or left as it was, but a crash while
+        # the batch moves the files into place can leave some of them (e.g.,
+        # meta.json and the personas) from different saves.
+        with self.store.transaction() as tx:
+            if self.is_offline_mode:
+                tx.write_positions(self.sim_code, self.personas_positions)
+
+            # Save Reverie meta information.
+            tx.write_meta(self.sim_code, self.sim_meta())
+
+            # Save the personas. Each one only writes its memories that changed.
+            tx.write_personas(self.sim_code, self.personas)
+
+    def commit_step(self, movements=None):
+        """
+        Persists the step that just ended. With an incremental store (see
+        utils/sim_store.py), its movements, the positions, the meta and the
+        memories that changed are committed in one transaction, so the
+        simulation resumes from this step even after a crash. Otherwise only
+        the movements and positions are written, in the background (see
+        persist_movement_files in utils/config.py), and the rest waits for
+        save.
 
-        # Save Reverie meta information.
+        INPUT
+          movements: The movements of the step, in offline mode.
+        OUTPUT
+          None
+        """
+        step = self.step - 1
+        if self.store.incremental:
+            with self.store.transaction() as tx:
+                if movements is not None:
+                    if persist_movement_files:
+                        tx.write_step(self.sim_code, "movement", step, movements)
+                    tx.write_positions(self.sim_code, self.personas_positions)
+                tx.write_meta(self.sim_code, self.sim_meta())
+                tx.write_personas(self.sim_code, self.personas)
+        elif self.movement_writer and movements is not None:
+            self.movement_writer.append(
+                step_log(f"{self.storage_home}/movement"), step, movements
+            )
+            self.movement_writer.write(
+                f"{self.storage_home}/positions.json", dict(self.personas_positions)
+            )
+
+    def sim_meta(self):
+        """
+        Returns the content of meta.json for the current state. We start from
+        the existing meta so that fields we do not track here (e.g., sim_mode)
+        are kept.
+        """
+        reverie_meta_f = f"{self.storage_path}/{self.sim_code}/reverie/meta.json"
         reverie_meta = dict()
+        if check_if_file_exists(reverie_meta_f):
+            with open(reverie_meta_f) as infile:
+                reverie_meta = json.load(infile)
         reverie_meta["template_sim_code"] = self.template_sim_code
         reverie_meta["start_date"] = self.start_time.strftime("%B %d, %Y")
         reverie_meta["curr_time"] = self.curr_time.strftime("%B %d, %Y, %H:%M:%S")
@@ -534,14 +1002,149 @@ class Reverie:
         reverie_meta["maze_name"] = self.maze.maze_name
         reverie_meta["persona_names"] = list(self.personas.keys())
         reverie_meta["step"] = self.step
-        reverie_meta_f = f"{sim_folder}/reverie/meta.json"
-        with open(reverie_meta_f, "w") as outfile:
-            outfile.write(json.dumps(reverie_meta, indent=2))
+        return reverie_meta
+
+    def write_checkpoint(self):
+        """
+        Writes the whole state of the simulation into a single file,
+        checkpoints/<step>.zip in the simulation folder (see
+        utils/checkpoint.py): the files save writes, plus the state that has
+        no file of its own (e.g., the online maze's events and relationships).
+        Only the latest <checkpoint_keep> checkpoints are kept.
 
-        # Save the personas.
-        for persona_name, persona in self.personas.items():
-            save_folder = f"{sim_folder}/personas/{persona_name}/bootstrap_memory"
-            persona.save(save_folder)
+        INPUT
+          None
+        OUTPUT
+          The path of the checkpoint.
+        """
+        sim_folder = f"{self.storage_path}/{self.sim_code}"
+        checkpoint_folder = f"{sim_folder}/checkpoints"
+        path = f"{checkpoint_folder}/{self.step}.zip"
+        os.makedirs(checkpoint_folder, exist_ok=True)
+
+        with tempfile.TemporaryDirectory(dir=checkpoint_folder) as staging:
+            os.makedirs(f"{staging}/reverie")
+            with open(f"{staging}/reverie/meta.json", "w") as outfile:
+                outfile.write(json.dumps(self.sim_meta(), indent=2))
+            if check_if_file_exists(f"{sim_folder}/reverie/events.json"):
+                shutil.copy(f"{sim_folder}/reverie/events.json", f"{staging}/reverie")
+            if self.is_offline_mode:
+                with open(f"{staging}/positions.json", "w") as outfile:
+                    json.dump(self.personas_positions, outfile, indent=2)
+            for persona_name, persona in self.personas.items():
+                save_folder = f"{staging}/personas/{persona_name}/bootstrap_memory"
+                os.makedirs(f"{save_folder}/associative_memory")
+                persona.save(save_folder)
+                # The staging folder is gone once the checkpoint is written,
+                # so the memories need not remember saving into it.
+                persona.forget_saved(staging)
+
+            state = {
+                "maze": self.maze.checkpoint_state(),
+                "personas": {
+                    persona_name: persona.checkpoint_state()
+                    for persona_name, persona in self.personas.items()
+                },
+                "personas_positions": self.personas_positions,
+                "personas_tile": self.personas_tile if self.is_offline_mode else None,
+            }
+            write_checkpoint(
+                path,
+                staging,
+                state,
+                {
+                    "sim_code": self.sim_code,
+                    "step": self.step,
+                    "curr_time": self.curr_time.strftime("%B %d, %Y, %H:%M:%S"),
+                    "persona_names": list(self.personas.keys()),
+                },
+            )
+
+        steps = sorted(self.checkpoint_steps())
+        for step in steps[: max(0, len(steps) - checkpoint_keep)]:
+            os.remove(f"{checkpoint_folder}/{step}.zip")
+        return path
+
+    def checkpoint_steps(self):
+        checkpoint_folder = f"{self.storage_path}/{self.sim_code}/checkpoints"
+        if not check_if_dir_exists(checkpoint_folder):
+            return []
+        return [
+            int(file[: -len(".zip")])
+            for file in os.listdir(checkpoint_folder)
+            if file.endswith(".zip") and file[: -len(".zip")].isdigit()
+        ]
+
+    def restore_checkpoint(self, step=None, persona_names=None):
+        """
+        Restores the simulation from one of its checkpoints (see
+        write_checkpoint). If persona_names is given, only those personas are
+        restored, and only their sections of the checkpoint are read; the rest
+        of the simulation stays as it is.
+
+        INPUT
+          step: the step of the checkpoint; the latest one if None.
+          persona_names: the personas to restore, or None for everything.
+        OUTPUT
+          None
+        """
+        sim_folder = f"{self.storage_path}/{self.sim_code}"
+        if step is None:
+            steps = self.checkpoint_steps()
+            if not steps:
+                raise ValueError(f"Simulation {self.sim_code} has no checkpoints")
+            step = max(steps)
+
+        with Checkpoint(f"{sim_folder}/checkpoints/{step}.zip") as checkpoint:
+            if set(checkpoint.manifest["persona_names"]) != set(self.personas):
+                raise ValueError("The checkpoint has a different set of personas")
+            if persona_names is None:
+                persona_names = checkpoint.manifest["persona_names"]
+                full = True
+            else:
+                unknown = set(persona_names) - set(checkpoint.manifest["persona_names"])
+                if unknown:
+                    raise ValueError(f"No personas {sorted(unknown)} in the checkpoint")
+                full = False
+            for persona_name in persona_names:
+                # The index and the node log of the memory (see memory_index.py)
+                # may hold nodes from after the checkpoint. Those in the
+                # checkpoint, if any, are extracted in their place.
+                a_mem_folder = (
+                    f"{sim_folder}/personas/{persona_name}/bootstrap_memory/associative_memory"
+                )
+                removeanything(f"{a_mem_folder}/{memory_index.NODE_LOG}")
+                if check_if_file_exists(f"{a_mem_folder}/{memory_index.INDEX_FILE}"):
+                    os.remove(f"{a_mem_folder}/{memory_index.INDEX_FILE}")
+            checkpoint.extract(sim_folder, None if full else persona_names)
+            state = checkpoint.read_state()
+            manifest = checkpoint.manifest
+
+        if full:
+            self.step = manifest["step"]
+            self.curr_time = datetime.datetime.strptime(
+                manifest["curr_time"], "%B %d, %Y, %H:%M:%S"
+            )
+            self.maze.restore_checkpoint_state(state["maze"])
+            self.personas_positions = state["personas_positions"]
+            if self.is_offline_mode:
+                self.personas_tile = state["personas_tile"]
+            self.sent_movements = dict()
+
+        for persona_name in persona_names:
+            old_persona = self.personas[persona_name]
+            persona = type(old_persona)(persona_name, f"{sim_folder}/personas/{persona_name}")
+            persona.restore_checkpoint_state(state["personas"][persona_name])
+            if self.is_offline_mode and not full:
+                # The maze's events are only restored along with everything else.
+                p_x, p_y = self.personas_tile[persona_name]
+                self.maze.tiles[p_y][p_x]["events"].discard(
+                    old_persona.scratch.get_curr_event_and_desc()
+                )
+                self.maze.tiles[p_y][p_x]["events"].add(persona.scratch.get_curr_event_and_desc())
+            self.personas[persona_name] = persona
+
+        self.publish_snapshot()
 
     def start_path_tester_server(self):
         """
@@ -638,6 +1241,16 @@ class Reverie:
                 pass
 
 
+    def run(self, int_counter, do_skip=False):
+        """
+        Runs start_server and gives up the run slot when it is done.
+        """
+        try:
+            self.start_server(int_counter, do_skip)
+        finally:
+            if self.run_ticket:
+                self.run_ticket.release()
+
     def start_server(self, int_counter, do_skip = False):
         """
         The main backend server of Reverie.
@@ -674,6 +1287,10 @@ class Reverie:
             if int_counter == 0:
                 break
 
+            # Wait for our turn if too many simulations are running.
+            if self.run_ticket:
+                self.run_ticket.step()
+
             if self.is_offline_mode:
 
                 # This is where we go through <game_obj_cleanup> to clean up all
@@ -752,7 +1369,7 @@ class Reverie:
                     movements["persona"][persona_name]["movement"] = next_tile
                     movements["persona"][persona_name]["pronunciatio"] = pronunciatio
                     movements["persona"][persona_name]["description"] = description
-                    movements["persona"][persona_name]["chat"] = persona.scratch.chat
+                    movements["persona"][persona_name]["chat"] = copy.deepcopy(persona.scratch.chat)
 
                 # Include the meta information about the current stage in the
                 # movements dictionary.
@@ -760,30 +1377,23 @@ class Reverie:
                     "%B %d, %Y, %H:%M:%S"
                 )
 
-                # We then write the personas' movements to a file that will be sent
-                # to the frontend server.
-                # Example json output:
-                # {"persona": {"Maria Lopez": {"movement": [58, 9]}},
-                #  "persona": {"Klaus Mueller": {"movement": [38, 12]}},
-                #  "meta": {curr_time: <datetime>}}
-                ###---lg---###
-                exist_move_file = f"{sim_folder}/movement/"
-                if not os.path.exists(exist_move_file):
-                    os.makedirs(exist_move_file)
-                ###---lg---###
-                curr_move_file = f"{sim_folder}/movement/{self.step}.json"
-                with open(curr_move_file, "w") as outfile:
-                    outfile.write(json.dumps(movements, indent=2))
-
-                # Write positions to positions.json
-                positions_file = f"{self.storage_home}/positions.json"
-                with open(positions_file, 'w') as f:
-                    json.dump(self.personas_positions, f, indent=2)
+                # We then stream the personas' movements to the connected clients.
+                self.send_movements(movements)
 
                 # After this cycle, the world takes one step forward, and the
                 # current time moves by <sec_per_step> amount.
                 self.step += 1
                 self.curr_time += datetime.timedelta(seconds=self.sec_per_step)
+
+                # The movements are also persisted for the frontend server,
+                # along with the positions (see commit_step).
+                # Example json output:
+                # {"persona": {"Maria Lopez": {"movement": [58, 9]}},
+                #  "persona": {"Klaus Mueller": {"movement": [38, 12]}},
+                #  "meta": {curr_time: <datetime>}}
+                self.commit_step(movements)
+                self.publish_snapshot()
+                self.schedule_checkpoint()
                 if (not do_skip) or self.interested:
                     int_counter -= 1
 
@@ -805,6 +1415,9 @@ class Reverie:
                 n += 1
                 self.step += 1
                 self.curr_time += datetime.timedelta(seconds=self.sec_per_step)
+                self.commit_step()
+                self.publish_snapshot()
+                self.schedule_checkpoint()
                 print("❤ ❤ ❤ ❤ ❤ ❤ ❤ ❤ ❤ ❤ ❤ ❤ ❤ ❤ ❤ next step ❤ ❤ ❤ ❤ ❤ ❤ ❤ ❤ ❤ ❤ ❤ ❤ ❤ ❤")
                 if (not do_skip) or self.interested:
                     int_counter -= 1
@@ -902,13 +1515,13 @@ class Reverie:
                     # Runs the number of steps specified in the prompt.
                     # Example: run 1000
                     int_count = int(sim_command.split()[-1])
-                    self.start_server(int_count)
+                    self.run(int_count)
 
                 elif sim_command[:4].lower() == "skip":  # base_the_ville_n25
                     # Runs the number of steps specified in the prompt.
                     # Example: run 1000
                     int_count = int(sim_command.split()[-1])
-                    self.start_server(int_count, True)
+                    self.run(int_count, True)
                 
                 elif "print persona scratch" in sim_command[:21].lower():
                     ret_str = f"importance_trigger_curr: {self.personas[
@@ -958,34 +1571,27 @@ class Reverie:
                     for p_n, count in curr_persona.scratch.chatting_with_buffer.items():
                         ret_str += f"{p_n}: {count}"
 
-                elif "print persona associative memory (event)" in sim_command.lower():
-                    # Print the associative memory (event) of the persona specified in
-                    # the prompt
+                elif "print persona associative memory (" in sim_command.lower():
+                    # Print a page of the associative memory (event, thought or
+                    # chat) of the persona specified in the prompt, newest first.
+                    # The next page is printed by passing the cursor we print,
+                    # and the memories can be filtered by keyword.
                     # Ex: print persona associative memory (event) Isabella Rodriguez
-                    ret_str += f'{self.personas[" ".join(sim_command.split()[-2:])]}\n'
-                    ret_str += self.personas[
-                        " ".join(sim_command.split()[-2:])
-                    ].a_mem.get_str_seq_events()
-
-                elif "print persona associative memory (thought)" in sim_command.lower():
-                    # Print the associative memory (thought) of the persona specified in
-                    # the prompt
                     # Ex: print persona associative memory (thought) Isabella Rodriguez
-                    ret_str += f'{self.personas[" ".join(sim_command.split()[-2:])]}\n'
-                    thoughts = self.personas[
-                        " ".join(sim_command.split()[-2:])
-                    ].a_mem.get_thoughts()
-                    for count , event in enumerate(thoughts):
-                        ret_str += f"Thought {count}: {event.spo_summary()} -- {event.description}\n"
-
-                elif "print persona associative memory (chat)" in sim_command.lower():
-                    # Print the associative memory (chat) of the persona specified in
-                    # the prompt
-                    # Ex: print persona associative memory (chat) Isabella Rodriguez
-                    ret_str += f'{self.personas[" ".join(sim_command.split()[-2:])]}\n'
-                    ret_str += self.personas[
-                        " ".join(sim_command.split()[-2:])
-                    ].a_mem.get_str_seq_chats()
+                    #     -- cursor=120 keyword=cafe
+                    command, _, options = sim_command.partition("--")
+                    node_type = command.lower().split("(")[1].split(")")[0]
+                    persona_name = " ".join(command.split()[-2:])
+                    filters = dict()
+                    for option in options.split():
+                        key, _, value = option.partition("=")
+                        if key not in MEMORY_QUERY_OPTIONS:
+                            raise ValueError(
+                                f"Unknown option {key}; the options are "
+                                f"{', '.join(MEMORY_QUERY_OPTIONS)}"
+                            )
+                        filters[key] = MEMORY_QUERY_OPTIONS[key](value)
+                    ret_str += self.print_memory_page(persona_name, node_type, **filters)
 
                 elif "print persona spatial memory" in sim_command.lower():
                     # Print the spatial memory of the persona specified in the prompt
@@ -1027,6 +1633,37 @@ class Reverie:
                     )
                     # Do you want to run for mayor in the local election?
 
+                elif sim_command.lower() == "checkpoint":
+                    # Writes a checkpoint of the simulation (see write_checkpoint).
+                    # Example: checkpoint
+                    ret_str += self.write_checkpoint()
+
+                elif sim_command[:18].lower() == "restore checkpoint":
+                    # Restores the simulation from a checkpoint (the latest one if
+                    # no step is given), or only the listed personas.
+                    # Ex: restore checkpoint
+                    # Ex: restore checkpoint 120 -- Isabella Rodriguez, Klaus Mueller
+                    args, _, names = sim_command[18:].partition("--")
+                    self.restore_checkpoint(
+                        int(args) if args.strip() else None,
+                        [name.strip() for name in names.split(",")] if names.strip() else None,
+                    )
+
+                elif "call -- fork" in sim_command.lower():
+                    # Clones the simulation at the current step into new simulations
+                    # (see fork). The next line holds their codes as a JSON list.
+                    # Ex: call -- fork
+                    #     ["policy_a", "policy_b"]
+                    for child_code in json.loads(self.command_queue.get()):
+                        child, error = None, None
+                        try:
+                            child = self.fork(child_code)
+                        except Exception as e:
+                            L.error(f"Error forking {self.sim_code} into {child_code}: {e}")
+                            error = e
+                        if reverie_instance:
+                            reverie_instance.on_fork(child_code, child, error)
+
                 elif "call -- chat to persona" in sim_command.lower():
                     persona_name = sim_command[len("call -- chat to persona") :].strip()
                     payload = json.loads(self.command_queue.get())
@@ -1034,12 +1671,7 @@ class Reverie:
                     prev_msgs = payload.get("prev_msgs", [])
                     msg = payload.get("msg", "")
 
-                    retval = self.personas[persona_name].chat_to_persona(
-                        mode, None if self.sim_mode == "online" else self.maze.vbase, prev_msgs, msg
-                    )
-                    event_trigger(
-                        "chat_to_persona", {"mode": mode, "persona": persona_name, "reply": retval}
-                    )
+                    self.chat_to_persona(self.personas[persona_name], mode, prev_msgs, msg)
 
                 elif "call -- whisper" in sim_command.lower():
                     # Starts a stateless chat session with the agent. It does not save
@@ -3,20 +3,38 @@ import json
 import os
 import threading
 import time
+import uuid
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
 from datetime import datetime
 from queue import Queue
 from typing import Any, Dict, List, Optional, Tuple
 
-from fastapi import BackgroundTasks, Depends, FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi import (
+    BackgroundTasks,
+    Depends,
+    FastAPI,
+    HTTPException,
+    Request,
+    Response,
+    WebSocket,
+    WebSocketDisconnect,
+)
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel, ValidationError
 from utils import *
 from utils import config
 from utils.config import BASE_TEMPLATES
 from utils.logs import L
+from utils.llm_scheduler import llm_scheduler
+from utils.message_buffer import MessageBuffer
+from utils.run_scheduler import RunScheduler, RunTicket
+from utils.sim_store import open_sim_store, remove_simulation
+from utils.template_catalog import TemplateCatalog
 
-from reverie import LLMConfig, Reverie, ReverieConfig, ScratchData
+from reverie import LLMConfig, Reverie, ReverieConfig, ScratchData, load_config_from_files
 
 app = FastAPI()
 
@@ -89,57 +107,356 @@ def parse_public_events(
     ]
 
 
+# Rough in-memory sizes, in bytes, of a memory node (with its strings, keyword
+# set and datetimes) and of each element of an embedding vector (a list of
+# Python floats).
+NODE_BYTES = 2048
+VECTOR_ITEM_BYTES = 32
+
+
+def persona_memory_size(reverie: Reverie) -> int:
+    """
+    Estimates the memory a loaded simulation takes by the associative memories
+    its personas have loaded, which make up most of it: their nodes, and their
+    embedding vectors, each counted once however many personas share it.
+    Memories that are not loaded yet (see lazy_persona_memories in
+    utils/config.py) count for nothing.
+    Called from a worker thread while the simulation runs: the collections it
+    walks are first copied with list(), which does not let the simulation
+    thread change them halfway.
+    """
+    nodes = 0
+    vectors = dict()
+    for persona in list(reverie.personas.values()):
+        if not persona.memories_loaded():
+            continue
+        a_mem = persona.a_mem
+        nodes += len(a_mem.id_to_node)
+        shared = a_mem.embeddings.store.vectors
+        for digest in list(a_mem.embeddings.digests.values()):
+            if digest not in vectors:
+                vectors[digest] = len(shared.get(digest, ()))
+    return nodes * NODE_BYTES + sum(vectors.values()) * VECTOR_ITEM_BYTES
+
+
 class ReverieInstance:
-    def __init__(self, template_sim_code, sim_config: ReverieConfig):
+    def __init__(self, template_sim_code, sim_config: ReverieConfig, loop, tenant=None):
         self.initialized = False
         self.last_accessed = datetime.now()
         self.active_websockets = {}
-        self.ws_lock = threading.Lock()
-        self.reverie = Reverie(template_sim_code=template_sim_code, sim_config=sim_config)
+        # <reverie> is None until initialize has run. In the meantime the
+        # instance sits in the pool as a placeholder, with <status> and
+        # <init_progress> describing how far the initialization got.
+        self.reverie = None
+        self.status = "initializing"
+        self.init_progress = {"stage": "queued", "done": 0, "total": 0}
+        # How many personas have their memories loaded, once the simulation is
+        # ready (see preload_persona_memories in utils/config.py).
+        self.memory_progress = {"done": 0, "total": 0}
+        self.init_error = None
+        self.server_thread = None
+        self.rehydration = None
+        # The codes of the children a /fork queued that the command loop has not
+        # forked yet.
+        self.pending_forks = set()
+        # The latest PersonaSnapshot of the simulation. It outlives hibernation,
+        # so reads do not have to rehydrate the simulation. <snapshot_changed>
+        # is set (and replaced) whenever a new one is published.
+        self.snapshot = None
+        self.snapshot_changed = asyncio.Event()
+        # Every step of a run is admitted by <run_scheduler>. Runs of the same
+        # tenant (the simulation itself by default) queue behind each other.
+        self.tenant = tenant or sim_config.sim_code
+        self.run_ticket = RunTicket(run_scheduler, self.tenant, config.run_slot_steps)
+        # The estimate of persona_memory_size, refreshed at each hibernation
+        # check.
+        self.memory_estimate = 0
         self.template_sim_code = template_sim_code
         self.sim_config = sim_config
         # more code for ReverieInstance is omitted
 
-        self.message_sender_thread = threading.Thread(target=self.message_sender_loop, daemon=True)
-        self.message_sender_thread.start()
+        # Messages from the simulation thread are kept in a bounded buffer with
+        # one ring buffer per message class. Every websocket has its own sender
+        # coroutine and cursor into the buffer, so a slow or late client is
+        # replayed what is still buffered instead of holding messages back.
+        # <active_websockets> is only touched from the event loop.
+        self.loop = loop
+        self.messages = MessageBuffer(config.ws_message_channels, on_post=self._on_message_posted)
+        self.wake_pending = False
+
+    def report_progress(self, stage, done, total):
+        self.init_progress = {"stage": stage, "done": done, "total": total}
+
+    def report_memory_progress(self, done, total):
+        self.memory_progress = {"done": done, "total": total}
+
+    def preload_memories(self):
+        try:
+            self.reverie.load_memories(progress=self.report_memory_progress)
+        except Exception as e:
+            L.warning(f"Error loading the memories of {self.sim_config.sim_code}: {e}")
+
+    def initialize(self):
+        """
+        Builds the Reverie (copying the template and loading all personas) and
+        starts its command loop. Meant to run in ReveriePool's executor.
+        """
+        try:
+            # Take a pre-initialized simulation of the same template if there is
+            # one that fits, and build one from scratch otherwise.
+            self.reverie = warm_pool.take(self.template_sim_code, self.sim_config)
+            if not self.reverie:
+                self.reverie = Reverie(
+                    template_sim_code=self.template_sim_code,
+                    sim_config=self.sim_config,
+                    progress=self.report_progress,
+                )
+        except Exception as e:
+            L.error(f"Error initializing simulation {self.sim_config.sim_code}: {e}")
+            self.init_error = str(e)
+            self.status = "failed"
+            return
+        self.initialized = True
+        self.status = "started"
+        self.start_server()
+
+    def on_fork(self, child_code, child, error):
+        """
+        Called from the command loop when it forked the simulation into
+        child_code (see the /fork endpoint).
+        """
+        self.pending_forks.discard(child_code)
+        child_instance = reverie_pool.get(child_code)
+        if not child_instance:
+            return
+        if error:
+            child_instance.init_error = str(error)
+            child_instance.status = "failed"
+            return
+        child_instance.reverie = child
+        child_instance.initialized = True
+        child_instance.status = "started"
+        child_instance.start_server()
+
+    def start_server(self):
+        # Start a new thread to run the open_server method
+        self.reverie.on_snapshot = self._on_snapshot
+        self.reverie.run_ticket = self.run_ticket
+        self._on_snapshot(self.reverie.snapshot)
+        self.server_thread = threading.Thread(target=self.serve)
+        self.server_thread.start()
+        if config.lazy_persona_memories and config.preload_persona_memories:
+            threading.Thread(target=self.preload_memories, daemon=True).start()
+
+    def serve(self):
+        """
+        Runs the command loop of the simulation. The children of a fork still
+        queued when it ends are never forked, so they are marked as failed.
+        """
+        try:
+            self.reverie.open_server(self)
+        finally:
+            for child_code in list(self.pending_forks):
+                error = Exception(f"Simulation {self.sim_config.sim_code} ended before forking")
+                self.on_fork(child_code, None, error)
+
+    def can_hibernate(self):
+        """
+        Only idle offline simulations without connected clients are hibernated.
+        Online simulations re-create their public events through the LLM when
+        their command loop starts, so they are kept in memory.
+        """
+        return (
+            self.status == "started"
+            and self.reverie.sim_mode == "offline"
+            and not self.reverie.is_running
+            and self.reverie.command_queue.empty()
+            and not self.active_websockets
+        )
 
-    async def send_message_to_websockets(self, message):
-        with self.ws_lock:
-            if not self.active_websockets:
+    def hibernate(self):
+        """
+        Saves the simulation to its folder and drops it from memory. The next
+        request for it rehydrates it (see rehydrate). Meant to run in
+        ReveriePool's executor.
+        """
+        # Requests check the status under the pool lock (see
+        # get_reverie_instance), so none gets a simulation that is hibernating.
+        with reverie_pool.lock:
+            if not self.can_hibernate():
                 return False
-
-            disconnected_sockets = []
-            for ws_id, websocket in self.active_websockets.items():
-                try:
-                    await websocket.send_text(message)
-                except Exception:
-                    disconnected_sockets.append(ws_id)
-
-            # Remove disconnected WebSockets
-            for ws_id in disconnected_sockets:
+            self.status = "hibernating"
+            # "fin" saves the simulation and ends the command loop.
+            self.reverie.command_queue.put("fin")
+        self.server_thread.join()
+        with reverie_pool.lock:
+            if not self.reverie.command_queue.empty():
+                # A request that got the simulation just before it started
+                # hibernating enqueued commands after "fin". We keep it loaded
+                # and run them.
+                L.info(f"Not hibernating simulation {self.sim_config.sim_code}: commands queued")
+                self.status = "started"
+                self.start_server()
+                return False
+            self.reverie = None
+            self.server_thread = None
+            self.status = "hibernated"
+        L.info(f"Hibernated simulation {self.sim_config.sim_code}")
+        return True
+
+    def rehydrate(self):
+        """
+        Loads a hibernated simulation back from its folder and restarts its
+        command loop.
+        """
+        sim_code = self.sim_config.sim_code
+        try:
+            self.reverie = Reverie(template_sim_code=sim_code, sim_config=self.sim_config)
+        except Exception as e:
+            L.error(f"Error rehydrating simulation {sim_code}: {e}")
+            self.init_error = str(e)
+            self.status = "failed"
+            raise
+        self.status = "started"
+        self.start_server()
+        L.info(f"Rehydrated simulation {sim_code}")
+
+    async def ensure_loaded(self):
+        """
+        Waits until a hibernated (or hibernating) simulation is back in memory.
+        Concurrent requests share one rehydration.
+        """
+        loop = asyncio.get_running_loop()
+        while self.status == "hibernating":
+            await asyncio.sleep(0.1)
+        if self.status != "hibernated":
+            return
+        if not self.rehydration or self.rehydration.done():
+            self.rehydration = loop.run_in_executor(reverie_pool.executor, self.rehydrate)
+        await asyncio.shield(self.rehydration)
+
+    def _on_snapshot(self, snapshot):
+        # Called from the simulation thread.
+        self.snapshot = snapshot
+        try:
+            self.loop.call_soon_threadsafe(self._snapshot_published)
+        except RuntimeError:
+            # The event loop is closed; the server is shutting down.
+            pass
+
+    def _snapshot_published(self):
+        self.snapshot_changed.set()
+        self.snapshot_changed = asyncio.Event()
+
+    async def wait_for_snapshot(self, after, timeout):
+        """
+        Waits until a snapshot with a version greater than after is published,
+        or until timeout seconds passed, and returns the latest snapshot.
+        """
+        deadline = self.loop.time() + timeout
+        while self.snapshot is None or self.snapshot.version <= after:
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(self.snapshot_changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        return self.snapshot
+
+    def post_message(self, message_type, message, key=None):
+        """
+        Buffers a JSON encoded message for the websockets. Safe to call from
+        any thread.
+        """
+        self.messages.post(message_type, message, key)
+
+    def interview_done(self, persona_name, future):
+        """
+        Done callback of an interview (see Reverie.interview): if it failed,
+        logs the error and tells the websockets, whose chat would otherwise
+        never get a reply.
+        """
+        if future.cancelled() or not future.exception():
+            return
+        e = future.exception()
+        L.error(f"Error in interview of {persona_name}: {e}")
+        message = {
+            "sender": persona_name,
+            "role": "agent",
+            "type": "error",
+            "content": f"Failed to answer: {e}",
+            "timestamp": "",
+            "subject": "",
+        }
+        self.post_message("chat", json.dumps({"type": "chat", "message": message}))
+
+    def _on_message_posted(self):
+        # Wake the senders at most once per event loop iteration, no matter how
+        # many messages were posted in between.
+        if self.wake_pending:
+            return
+        self.wake_pending = True
+        try:
+            self.loop.call_soon_threadsafe(self._wake_senders)
+        except RuntimeError:
+            # The event loop is closed; the server is shutting down.
+            pass
+
+    def _wake_senders(self):
+        self.wake_pending = False
+        for client in self.active_websockets.values():
+            client["wake"].set()
+
+    def add_websocket(self, ws_id, websocket):
+        client = {"websocket": websocket, "wake": asyncio.Event(), "lagged": 0}
+        client["task"] = asyncio.create_task(self.message_sender(ws_id, client))
+        self.active_websockets[ws_id] = client
+
+    def remove_websocket(self, ws_id):
+        client = self.active_websockets.pop(ws_id, None)
+        if client:
+            client["task"].cancel()
+
+    async def message_sender(self, ws_id, client):
+        cursor = self.messages.new_cursor()
+        while True:
+            batch, missed = self.messages.read(cursor, config.ws_max_batch_size)
+            client["lagged"] += missed
+            if not batch:
+                await client["wake"].wait()
+                client["wake"].clear()
+                continue
+            # Coalesce whatever has queued up in the meantime into one frame.
+            if len(batch) == 1:
+                frame = batch[0]
+            else:
+                frame = '{"type": "batch", "message": [' + ", ".join(batch) + "]}"
+            try:
+                await client["websocket"].send_text(frame)
+            except Exception:
+                # Remove disconnected WebSockets
                 self.active_websockets.pop(ws_id, None)
+                return
 
-            return bool(self.active_websockets)
+    def message_stats(self):
+        return {
+            "channels": self.messages.stats(),
+            "lagged": {ws_id: client["lagged"] for ws_id, client in self.active_websockets.items()},
+        }
 
-    def message_sender_loop(self):
-        while True:
-            if not self.reverie.message_queue.empty() and self.active_websockets:
-                message = self.reverie.message_queue.get()
-                success = asyncio.run(self.send_message_to_websockets(message))
-                if not success:
-                    # If no active WebSockets, put the message back in the queue
-                    self.reverie.message_queue.put(message)
-            else:
-                # Sleep briefly to avoid busy-waiting
-                time.sleep(0.1)
+    async def close_websockets(self):
+        clients = list(self.active_websockets.values())
+        self.active_websockets.clear()
+        for client in clients:
+            client["task"].cancel()
+        await asyncio.gather(
+            *(client["websocket"].close() for client in clients), return_exceptions=True
+        )
 
     def shutdown(self):
-        with self.ws_lock:
-            self.message_sender_thread.join(timeout=5)  # Wait for the thread to finish
-            # Close all active WebSockets
-            for websocket in self.active_websockets.values():
-                asyncio.run(websocket.close())
-            self.active_websockets.clear()
+        # Close all active WebSockets
+        asyncio.run_coroutine_threadsafe(self.close_websockets(), self.loop)
 
 
 class ReveriePool:
@@ -147,21 +464,73 @@ class ReveriePool:
         self.max_instances = max_instances
         self.pool: OrderedDict[str, ReverieInstance] = OrderedDict()
         self.lock = threading.Lock()
+        # Simulations are initialized in this executor, outside of <lock>, so
+        # that creating one does not hold up the others or the event loop.
+        self.executor = ThreadPoolExecutor(max_workers=config.max_concurrent_sim_inits)
 
     def get_or_create(
-        self, session_id: str, template_sim_code: str, sim_config: ReverieConfig
+        self,
+        session_id: str,
+        template_sim_code: str,
+        sim_config: ReverieConfig,
+        loop: asyncio.AbstractEventLoop,
+        tenant: str | None = None,
     ) -> ReverieInstance:
+        """
+        Returns the instance for session_id. If there is none (or its
+        initialization failed), a placeholder is put in the pool right away and
+        initialized in the background; its status is "initializing" until then.
+        """
         with self.lock:
-            if session_id in self.pool:
+            if session_id in self.pool and self.pool[session_id].status != "failed":
                 reverie = self.pool.pop(session_id)
                 self.pool[session_id] = reverie
-            else:
-                if len(self.pool) >= self.max_instances:
-                    _, oldest_reverie = self.pool.popitem(last=False)
-                    oldest_reverie.shutdown()  # Shutdown the removed instance
-                reverie = ReverieInstance(template_sim_code, sim_config)
-                self.pool[session_id] = reverie
-            return reverie
+                return reverie
+
+            self.pool.pop(session_id, None)
+            if len(self.pool) >= self.max_instances:
+                _, oldest_reverie = self.pool.popitem(last=False)
+                oldest_reverie.shutdown()  # Shutdown the removed instance
+            reverie = ReverieInstance(template_sim_code, sim_config, loop, tenant)
+            self.pool[session_id] = reverie
+
+        self.executor.submit(reverie.initialize)
+        return reverie
+
+    def add_all(self, instances: Dict[str, ReverieInstance], keep: str | None = None) -> bool:
+        """
+        Puts every instance of instances (a dict of session ids to instances)
+        in the pool, or none of them if one of the session ids is taken or if
+        there is no room for all of them without evicting keep.
+        """
+        with self.lock:
+            for session_id in instances:
+                if session_id in self.pool and self.pool[session_id].status != "failed":
+                    return False
+            for session_id in instances:
+                self.pool.pop(session_id, None)
+            evictable = [session_id for session_id in self.pool if session_id != keep]
+            excess = len(self.pool) + len(instances) - self.max_instances
+            if excess > len(evictable):
+                return False
+            for session_id in evictable[: max(excess, 0)]:
+                self.pool.pop(session_id).shutdown()  # Shutdown the removed instance
+            self.pool.update(instances)
+            return True
+
+    def add(self, session_id: str, instance: ReverieInstance) -> bool:
+        """
+        Puts instance in the pool unless session_id is taken.
+        """
+        with self.lock:
+            if session_id in self.pool and self.pool[session_id].status != "failed":
+                return False
+            self.pool.pop(session_id, None)
+            if len(self.pool) >= self.max_instances:
+                _, oldest_reverie = self.pool.popitem(last=False)
+                oldest_reverie.shutdown()  # Shutdown the removed instance
+            self.pool[session_id] = instance
+            return True
 
     def remove(self, session_id: str) -> None:
         with self.lock:
@@ -175,15 +544,145 @@ class ReveriePool:
                 # Move accessed item to the end (most recently used)
                 reverie = self.pool.pop(session_id)
                 self.pool[session_id] = reverie
+                reverie.last_accessed = datetime.now()
                 return reverie
             return None
 
+    def hibernation_candidates(self) -> List[ReverieInstance]:
+        """
+        Returns the instances to hibernate, least recently used first: those
+        idle for longer than hibernate_idle_seconds, and then as many more as it
+        takes to bring the loaded simulations under sim_memory_budget_mb.
+        """
+        now = datetime.now()
+        with self.lock:
+            loaded = [
+                (instance, instance.reverie) for instance in self.pool.values() if instance.reverie
+            ]
+        for instance, reverie in loaded:
+            instance.memory_estimate = persona_memory_size(reverie)
+        loaded = [instance for instance, _ in loaded]
+        candidates = []
+        loaded_size = sum(instance.memory_estimate for instance in loaded)
+        budget = config.sim_memory_budget_mb * 1024 * 1024
+        for instance in loaded:
+            idle = (now - instance.last_accessed).total_seconds()
+            if idle < config.hibernate_idle_seconds and loaded_size <= budget:
+                continue
+            if instance.can_hibernate():
+                candidates.append(instance)
+                loaded_size -= instance.memory_estimate
+        return candidates
+
+    def hibernate_idle(self) -> None:
+        for instance in self.hibernation_candidates():
+            self.executor.submit(instance.hibernate)
+
     def __len__(self) -> int:
         with self.lock:
             return len(self.pool)
 
 
+class WarmPool:
+    """
+    Keeps a number of ready-to-go simulations per base template (see
+    warm_pool_size in utils/config.py), with the maze and persona memories
+    already loaded, so that /start does not have to copy and load the template.
+    A warm simulation lives in a "warm-sim-..." folder until it is adopted.
+    """
+
+    folder_prefix = "warm-sim-"
+
+    def __init__(self, sizes: Dict[str, int]):
+        self.sizes = sizes
+        self.ready: Dict[str, List[Reverie]] = {template: [] for template in sizes}
+        self.building: Dict[str, int] = {template: 0 for template in sizes}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def start(self):
+        # Warm simulations do not survive a restart.
+        sim_codes = set(os.listdir(STORAGE_PATH))
+        sim_codes |= set(open_sim_store(STORAGE_PATH).list_simulations())
+        for sim_code in sim_codes:
+            if sim_code.startswith(self.folder_prefix):
+                remove_simulation(STORAGE_PATH, sim_code)
+        self.fill()
+
+    def fill(self):
+        with self.lock:
+            for template, size in self.sizes.items():
+                while len(self.ready[template]) + self.building[template] < size:
+                    self.building[template] += 1
+                    self.executor.submit(self.build, template)
+
+    def build(self, template: str):
+        reverie = None
+        try:
+            sim_config = load_config_from_files(f"{STORAGE_PATH}/{template}")
+            sim_config.sim_code = f"{self.folder_prefix}{template}-{uuid.uuid4().hex[:8]}"
+            warm = Reverie(template_sim_code=template, sim_config=sim_config)
+            # A warm simulation is ready to go, memories included.
+            warm.load_memories()
+            reverie = warm
+        except Exception as e:
+            L.error(f"Error warming up template {template}: {e}")
+        with self.lock:
+            self.building[template] -= 1
+            if reverie:
+                self.ready[template].append(reverie)
+
+    def take(self, template: str, sim_config: ReverieConfig) -> Reverie | None:
+        """
+        Returns a warm simulation of template adopted as sim_config, or None if
+        there is none ready or sim_config does not fit it. The pool is refilled
+        in the background.
+        """
+        with self.lock:
+            if not self.ready.get(template):
+                return None
+            reverie = self.ready[template].pop(0)
+        self.fill()
+
+        try:
+            if reverie.adopt(sim_config):
+                return reverie
+        except Exception as e:
+            L.warning(f"Error adopting warm simulation of {template}: {e}")
+        remove_simulation(reverie.storage_path, reverie.sim_code)
+        return None
+
+
+run_scheduler = RunScheduler(config.max_active_runs)
+# Answers interviews (see interactive_chat_modes) outside the command loops.
+interactive_executor = ThreadPoolExecutor(max_workers=config.interactive_chat_workers)
 reverie_pool = ReveriePool()
+warm_pool = WarmPool(
+    {template: size for template, size in config.warm_pool_size.items() if template in BASE_TEMPLATES}
+)
+
+
+@app.on_event("startup")
+async def start_warm_pool():
+    # Filling the pool only submits work to its executor.
+    warm_pool.start()
+
+
+async def hibernate_idle_simulations():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(config.hibernate_check_interval)
+        try:
+            # Estimating the memory of the simulations walks their personas'
+            # memories, so it runs off the event loop.
+            await loop.run_in_executor(reverie_pool.executor, reverie_pool.hibernate_idle)
+        except Exception as e:
+            L.warning(f"Error hibernating idle simulations: {e}")
+
+
+@app.on_event("startup")
+async def start_hibernation():
+    asyncio.create_task(hibernate_idle_simulations())
 
 
 class StartReq(BaseModel):
@@ -191,6 +690,7 @@ class StartReq(BaseModel):
     template: Dict[str, Any]
     llmConfig: Dict[str, Any]
     initialRounds: Optional[int] = 0
+    tenant: Optional[str] = None
 
 
 class EventPublishReq(BaseModel):
@@ -200,6 +700,10 @@ class EventPublishReq(BaseModel):
     access_list: str
 
 
+class ForkReq(BaseModel):
+    simCodes: List[str]
+
+
 class ChatReq(BaseModel):
     agent_name: str
     type: str
@@ -207,11 +711,28 @@ class ChatReq(BaseModel):
     content: str
 
 
-def get_reverie_instance(sim_code: str):
+async def get_reverie_instance(sim_code: str):
     instance = reverie_pool.get(sim_code)
     if not instance:
         L.warning(f"Simulation with code {sim_code} not found")
         raise HTTPException(status_code=404, detail=f"Simulation with code {sim_code} not found")
+    # A hibernated simulation is loaded back from disk on first use, once it
+    # is done hibernating.
+    while True:
+        try:
+            await instance.ensure_loaded()
+        except Exception as e:
+            L.error(f"Error rehydrating simulation {sim_code}: {e}")
+            raise HTTPException(
+                status_code=500, detail=f"Error rehydrating simulation {sim_code}: {e}"
+            )
+        with reverie_pool.lock:
+            if instance.status not in ["hibernating", "hibernated"]:
+                break
+    if not instance.reverie:
+        raise HTTPException(
+            status_code=409, detail=f"Simulation with code {sim_code} is {instance.status}"
+        )
     return instance
 
 
@@ -252,17 +773,17 @@ async def start(sim_data: StartReq):
             direction=template.get("meta", {}).get("direction", ""),
             initial_rounds=initial_rounds or 0,
         )
-        reverie_instance = reverie_pool.get_or_create(
-            sim_code, template.get("simCode"), reverie_config
+        # The simulation is initialized (and its command loop started) in the
+        # background; /status reports "initializing" until it is ready.
+        reverie_pool.get_or_create(
+            sim_code,
+            template.get("simCode"),
+            reverie_config,
+            asyncio.get_running_loop(),
+            sim_data.tenant,
         )
 
-        # Start a new thread to run the open_server method
-        thread = threading.Thread(
-            target=reverie_instance.reverie.open_server, args=(reverie_instance,)
-        )
-        thread.start()
-
-        return {"status": "success", "message": "Simulation started"}
+        return {"status": "success", "message": "Simulation initializing"}
     except Exception as e:
         L.error(f"Error in start endpoint: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -270,7 +791,7 @@ async def start(sim_data: StartReq):
 
 @app.post("/publish_events")
 async def publish_event(event: EventPublishReq, sim_code: str):
-    reverie_instance = get_reverie_instance(sim_code)
+    reverie_instance = await get_reverie_instance(sim_code)
     if not reverie_instance:
         L.warning(f"Simulation with code {sim_code} not found")
         raise HTTPException(status_code=404, detail=f"Simulation with code {sim_code} not found")
@@ -296,28 +817,51 @@ async def query_status(sim_code: str):
     instance = reverie_pool.get(sim_code)
     if not instance:
         return {"status": "terminated"}
+    if instance.status == "initializing":
+        return {"status": "initializing", "progress": instance.init_progress}
+    if instance.status == "failed":
+        return {"status": "failed", "error": instance.init_error}
+    if instance.status in ["hibernating", "hibernated"]:
+        return {"status": instance.status}
     return {
         "status": "running" if instance.reverie.is_running else "started",
+        # The position of a run waiting for a slot, None if it is not waiting.
+        "queue_position": instance.run_ticket.position(),
+        "runs": run_scheduler.stats(),
+        "llm_requests": llm_scheduler.stats(),
         "connections": [ws for ws in instance.active_websockets],
+        "messages": instance.message_stats(),
+        "memories": instance.memory_progress,
     }
 
 
 @app.get("/command")
 async def add_command(sim_code: str, command: str):
-    reverie_instance = get_reverie_instance(sim_code)
+    reverie_instance = await get_reverie_instance(sim_code)
     if not command:
         L.warning("add_command: No command provided")
         raise HTTPException(status_code=400, detail="Missing command parameter")
     if not reverie_instance:
         L.warning(f"Simulation with code {sim_code} not found")
         raise HTTPException(status_code=404, detail=f"Simulation with code {sim_code} not found")
+    # Read-only queries of the personas are answered from the latest snapshot
+    # rather than after the runs already in the command queue.
+    snapshot = reverie_instance.snapshot
+    if snapshot:
+        try:
+            result = snapshot.query(command, reverie_instance.reverie.maze)
+        except KeyError as e:
+            raise HTTPException(status_code=404, detail=f"Persona {e} not found")
+        if result is not None:
+            L.info(f"Command result: {result}")
+            return {"status": "success", "version": snapshot.version, "result": result}
     reverie_instance.reverie.command_queue.put(command)
     return {"status": "success"}
 
 
 @app.get("/run")
 async def run(sim_code: str, count: int):
-    reverie_instance = get_reverie_instance(sim_code)
+    reverie_instance = await get_reverie_instance(sim_code)
     if not count:
         L.warning("run: No count provided")
         raise HTTPException(status_code=400, detail="Missing count parameter")
@@ -333,7 +877,7 @@ async def run(sim_code: str, count: int):
 # This is a legacy endpoint from the original project
 @app.get("/get_persona/{sim_code}")
 async def get_persona(sim_code: str):
-    reverie_instance = get_reverie_instance(sim_code)
+    reverie_instance = await get_reverie_instance(sim_code)
     if not reverie_instance:
         L.warning(f"Simulation with code {sim_code} not found")
         raise HTTPException(status_code=404, detail=f"Simulation with code {sim_code} not found")
@@ -347,74 +891,103 @@ async def get_persona(sim_code: str):
     return {"personas": list(persona_names)}
 
 
-@app.get("/personas_info")
-async def personas_info(sim_code: str):
-    reverie_instance = get_reverie_instance(sim_code)
-    r = reverie_instance.reverie
-    if not reverie_instance:
+async def get_persona_snapshot(sim_code: str, after: int, timeout: float):
+    """
+    Returns the latest PersonaSnapshot of a simulation. If after is given, waits
+    (for at most snapshot_poll_timeout seconds) for one newer than version after.
+    """
+    instance = reverie_pool.get(sim_code)
+    if not instance:
         L.warning(f"Simulation with code {sim_code} not found")
         raise HTTPException(status_code=404, detail=f"Simulation with code {sim_code} not found")
+    timeout = max(0, min(timeout, config.snapshot_poll_timeout))
+    snapshot = await instance.wait_for_snapshot(after, timeout)
+    if not snapshot:
+        raise HTTPException(
+            status_code=409, detail=f"Simulation with code {sim_code} is {instance.status}"
+        )
+    return snapshot
 
-    persona_info = []
 
-    try:
-        for persona_name, persona in r.personas.items():
-            scratch = persona.scratch
-            persona_info.append(
-                {
-                    "name": persona_name,
-                    "first_name": scratch.first_name,
-                    "last_name": scratch.last_name,
-                    "age": scratch.age,
-                    "innate": scratch.innate,
-                    "learned": scratch.learned,
-                    "currently": scratch.currently,
-                    "lifestyle": scratch.lifestyle,
-                    "living_area": scratch.living_area,
-                    "act_event": scratch.act_event,
-                }
-            )
-    # scratch_data = load_json_file(scratch_file)
-    # try:
-    # person = ScratchData(**scratch_data)
-    # persona_info.append(
-    #     {
-    #         "name": person.name,
-    #         "first_name": person.first_name,
-    #         "last_name": person.last_name,
-    #         "age": person.age,
-    #         "innate": person.innate,
-    #         "learned": person.learned,
-    #         "currently": person.currently,
-    #         "lifestyle": person.lifestyle,
-    #         "living_area": person.living_area,
-    #         "act_event": person.act_event,
-    #     }
-    # )
-    except ValidationError as e:
-        L.warning(f"Error parsing persona {persona}: {e}")
+@app.get("/personas_info")
+async def personas_info(
+    sim_code: str, after: int = -1, timeout: float = config.snapshot_poll_timeout
+):
+    snapshot = await get_persona_snapshot(sim_code, after, timeout)
+    return {
+        "version": snapshot.version,
+        "curr_time": snapshot.curr_time,
+        "personas": snapshot.summaries,
+    }
+
 
-    return {"personas": persona_info}
+@app.post("/fork")
+async def fork(fork_request: ForkReq, sim_code: str):
+    """
+    Clones a simulation at its current step into new simulations that run on
+    their own, e.g., to try different interventions from the same state. The
+    fork happens in the simulation's command loop once its current run is
+    over; until then the children's status is "initializing".
+    """
+    reverie_instance = await get_reverie_instance(sim_code)
+    child_codes = fork_request.simCodes
+    if len(set(child_codes)) != len(child_codes):
+        raise HTTPException(status_code=400, detail="Duplicate simulation codes")
+    for child_code in child_codes:
+        if child_code in BASE_TEMPLATES:
+            raise HTTPException(status_code=400, detail="Cannot overwrite base template")
+        if check_if_dir_exists(f"{STORAGE_PATH}/{child_code}") or reverie_pool.get(child_code):
+            raise HTTPException(status_code=400, detail=f"Simulation {child_code} already exists")
+
+    loop = asyncio.get_running_loop()
+    child_instances = dict()
+    for child_code in child_codes:
+        child_config = replace(reverie_instance.sim_config, sim_code=child_code, initial_rounds=0)
+        child_instance = ReverieInstance(sim_code, child_config, loop, reverie_instance.tenant)
+        child_instance.init_progress = {"stage": "forking", "done": 0, "total": 1}
+        child_instances[child_code] = child_instance
+    # The children are added all at once, and never at the expense of the
+    # simulation they are forked from.
+    if len(child_instances) + 1 > reverie_pool.max_instances:
+        raise HTTPException(status_code=503, detail="Too many simulations to fork")
+    if not reverie_pool.add_all(child_instances, keep=sim_code):
+        raise HTTPException(status_code=409, detail="A simulation code was taken while forking")
+    reverie_instance.pending_forks.update(child_codes)
+
+    q = reverie_instance.reverie.command_queue
+    q.put("call -- fork")
+    q.put(json.dumps(child_codes))
+    return {"status": "success", "message": "Simulations forking"}
 
 
 @app.post("/chat")
 async def chat(chat_request: ChatReq, sim_code: str):
-    reverie_instance = get_reverie_instance(sim_code)
+    reverie_instance = await get_reverie_instance(sim_code)
     if not reverie_instance:
         L.warning(f"Simulation with code {sim_code} not found")
         raise HTTPException(status_code=404, detail=f"Simulation with code {sim_code} not found")
     try:
-        q = reverie_instance.reverie.command_queue
-        q.put(f"call -- chat to persona {chat_request.agent_name}")
-        q.put(
-            json.dumps(
-                {
-                    "mode": chat_request.type,
-                    "prev_msgs": chat_request.history,
-                    "msg": chat_request.content,
-                }
+        r = reverie_instance.reverie
+        payload = {
+            "mode": chat_request.type,
+            "prev_msgs": chat_request.history,
+            "msg": chat_request.content,
+        }
+        if chat_request.type in config.interactive_chat_modes:
+            # Chats that do not change the persona are answered right away on an
+            # interactive worker, even while a run is going on.
+            if chat_request.agent_name not in r.personas:
+                raise KeyError(chat_request.agent_name)
+            future = interactive_executor.submit(
+                r.interview, reverie_instance, chat_request.agent_name, payload
             )
-        )
+            future.add_done_callback(
+                lambda future: reverie_instance.interview_done(chat_request.agent_name, future)
+            )
+        else:
+            q = r.command_queue
+            q.put(f"call -- chat to persona {chat_request.agent_name}")
+            q.put(json.dumps(payload))
         return {"status": "success"}
     except Exception as e:
         L.warning(f"Error processing chat request: {e}")
@@ -422,112 +995,94 @@ async def chat(chat_request: ChatReq, sim_code: str):
 
 
 @app.get("/persona_detail")
-async def persona_detail(sim_code: str, agent_name: str):
-    r = get_reverie_instance(sim_code)
-    if not r:
-        L.warning(f"Simulation with code {sim_code} not found")
-        raise HTTPException(status_code=404, detail=f"Simulation with code {sim_code} not found")
-    r = r.reverie
-    persona_path = os.path.join(STORAGE_PATH, r.template_sim_code, "personas", agent_name)
-    # scratch_file = os.path.join(persona_path, "bootstrap_memory", "scratch.json")
-    # Actually the scratch data should be loaded from ReverieInstance
-    # scratch_data = load_json_file(scratch_file)
-    scratch = r.personas[agent_name].scratch
-    scratch_data = vars(scratch)
-
+async def persona_detail(
+    sim_code: str, agent_name: str, after: int = -1, timeout: float = config.snapshot_poll_timeout
+):
+    snapshot = await get_persona_snapshot(sim_code, after, timeout)
     try:
-        person = ScratchData(**scratch_data)
-        persona_detail = person.dict()
+        persona_detail = snapshot.detail(agent_name)
     except ValidationError as e:
         L.warning(f"Error parsing persona {agent_name}: {e}")
         raise HTTPException(status_code=500, detail=f"Error parsing persona data for {agent_name}")
+    if persona_detail is None:
+        raise HTTPException(status_code=404, detail=f"Persona {agent_name} not found")
 
-    return {"scratch": persona_detail, "a_mem": {}, "s_mem": {}}
+    return {
+        "version": snapshot.version,
+        "scratch": persona_detail,
+        "a_mem": {},
+        "s_mem": {},
+    }
 
 
-@app.get("/fetch_templates")
-async def fetch_templates():
-    envs = [
-        dir for dir in os.listdir(STORAGE_PATH) if os.path.isdir(os.path.join(STORAGE_PATH, dir))
-    ]
-    filtered_envs = [
-        env for env in envs if "test" not in env and "sim" not in env and "July" not in env
-    ]
+def is_listed_template(dir: str) -> bool:
     # 暂时不显示这个
-    # if "base_the_ville_n25" in filtered_envs:
-        # filtered_envs.remove("base_the_ville_n25")
-    result_envs = []
-    for dir in filtered_envs:
-        template_meta_file = os.path.join(STORAGE_PATH, dir, "reverie", "meta.json")
-        template_meta = load_json_file(template_meta_file)
-        if template_meta:
-            hidden = template_meta.get("hidden", True)
-            L.debug(f"Hidden: {hidden}")
-            if not hidden:
-                result_envs.append(template_meta)
+    # if dir == "base_the_ville_n25":
+    #     return False
+    return "test" not in dir and "sim" not in dir and "July" not in dir
 
-    # Sort result_envs based on template_sim_code
-    def sort_key(env):
-        sim_code = env.get("template_sim_code", "")
-        return (0 if "online" in sim_code.lower() else 1, sim_code)
 
-    result_envs.sort(key=sort_key)
+template_catalog = TemplateCatalog(STORAGE_PATH, load_json_file, is_listed_template)
 
-    return {"envs": result_envs, "all_templates": envs}
 
+async def refresh_template_catalog():
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, template_catalog.refresh)
+        except Exception as e:
+            L.warning(f"Error refreshing the template catalog: {e}")
+        await asyncio.sleep(config.template_catalog_refresh_interval)
 
-@app.get("/fetch_template")
-async def fetch_template(sim_code: str):
-    if not sim_code:
-        raise HTTPException(status_code=400, detail="Missing sim_code parameter")
 
-    env_path = os.path.join(STORAGE_PATH, sim_code)
-    if not os.path.exists(env_path):
-        raise HTTPException(status_code=404, detail="Environment does not exist")
+@app.on_event("startup")
+async def start_template_catalog():
+    asyncio.create_task(refresh_template_catalog())
 
-    meta_file = os.path.join(env_path, "reverie", "meta.json")
-    env_meta = load_json_file(meta_file)
 
-    persona_names = env_meta.get("persona_names", [])
-    persona_info = {}
-    for persona in persona_names:
-        scratch_file = os.path.join(
-            env_path, "personas", persona, "bootstrap_memory", "scratch.json"
-        )
-        scratch_data = load_json_file(scratch_file)
-        persona_info[persona] = {
-            "name": scratch_data.get("name", ""),
-            "first_name": scratch_data.get("first_name", ""),
-            "last_name": scratch_data.get("last_name", ""),
-            "age": scratch_data.get("age", 0),
-            "daily_plan_req": scratch_data.get("daily_plan_req", ""),
-            "innate": scratch_data.get("innate", ""),
-            "learned": scratch_data.get("learned", ""),
-            "currently": scratch_data.get("currently", ""),
-            "lifestyle": scratch_data.get("lifestyle", ""),
-            "living_area": scratch_data.get("living_area", ""),
-            "bibliography": "",  # WIP
-        }
+def cached_response(request: Request, data: Dict[str, Any], etag: str) -> Response:
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(content=data, headers=headers)
+
 
-    events_file = os.path.join(env_path, "reverie", "events.json")
-    events = load_json_file(events_file)
+@app.get("/fetch_templates")
+async def fetch_templates(request: Request):
+    loop = asyncio.get_running_loop()
+    listing, etag = await loop.run_in_executor(None, template_catalog.get_listing)
+    return cached_response(request, listing, etag)
 
-    return {"meta": env_meta, "personas": persona_info, "events": events}
+
+@app.get("/fetch_template")
+async def fetch_template(sim_code: str, request: Request):
+    if not sim_code:
+        raise HTTPException(status_code=400, detail="Missing sim_code parameter")
+
+    loop = asyncio.get_running_loop()
+    template = await loop.run_in_executor(None, template_catalog.get_template, sim_code)
+    if not template:
+        raise HTTPException(status_code=404, detail="Environment does not exist")
+    return cached_response(request, *template)
 
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket, sim_code: str):
-    reverie_instance = get_reverie_instance(sim_code)
+    # Clients may connect while the simulation is still initializing.
+    reverie_instance = reverie_pool.get(sim_code)
     if not reverie_instance:
         L.warning(f"No reverie instance found for sim_code: {sim_code}")
         raise HTTPException(status_code=404, detail="No reverie instance found")
+    try:
+        await reverie_instance.ensure_loaded()
+    except Exception:
+        pass
     await websocket.accept()
 
     websocket_id = id(websocket)
 
     try:
-        with threading.Lock():
-            reverie_instance.active_websockets[websocket_id] = websocket
+        reverie_instance.add_websocket(websocket_id, websocket)
 
         while True:
             # Wait for messages (if needed)
@@ -537,8 +1092,7 @@ async def websocket_endpoint(websocket: WebSocket, sim_code: str):
     except WebSocketDisconnect:
         pass
     finally:
-        with threading.Lock():
-            reverie_instance.active_websockets.pop(websocket_id, None)
+        reverie_instance.remove_websocket(websocket_id)
 
 
 if __name__ == "__main__":
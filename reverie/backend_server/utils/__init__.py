@@ -12,10 +12,13 @@ import json
 import os
 import shutil
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from os import listdir
 
 import numpy
 
+from utils.config import max_parallel_llm_requests
+
 thread_local = threading.local()
 
 
@@ -26,6 +29,46 @@ def create_thread_local():
     return threading.local()
 
 
+def bind_thread_local(fn):
+    """
+    Wraps fn so that it runs with a copy of the calling thread's thread_local
+    attributes (e.g., reverie_local and reverie_instance). Worker threads do not
+    inherit thread_local, but llm_request and sock_send depend on it.
+    ARGS:
+      fn: the callable to wrap.
+    RETURNS:
+      A callable with the same signature as fn.
+    """
+    captured = dict(vars(thread_local))
+
+    def wrapper(*args, **kwargs):
+        for key, val in captured.items():
+            setattr(thread_local, key, val)
+        return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def parallel_map(fn, items, max_workers=max_parallel_llm_requests):
+    """
+    Applies fn to every element of items concurrently and returns the results
+    in the same order as items. Meant for independent, I/O bound calls such as
+    LLM requests and embeddings.
+    ARGS:
+      fn: a callable that takes a single element of items.
+      items: an iterable of inputs.
+      max_workers: the maximum number of concurrent calls.
+    RETURNS:
+      A list of fn(item) for each item, in order. Exceptions are re-raised.
+    """
+    items = list(items)
+    if len(items) <= 1 or max_workers <= 1:
+        return [fn(i) for i in items]
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(bind_thread_local(fn), items))
+
+
 def create_folder_if_not_there(curr_path):
     """
     Checks if a folder in the curr_path exists. If it does not exist, creates
@@ -69,7 +112,7 @@ def write_list_of_list_to_csv(curr_list_of_list, outfile):
       None
     """
     create_folder_if_not_there(outfile)
-    with open(outfile, "w") as f:
+    with open_private(outfile, "w") as f:
         writer = csv.writer(f)
         writer.writerows(curr_list_of_list)
 
@@ -91,7 +134,7 @@ def write_list_to_csv_line(line_list, outfile):
     create_folder_if_not_there(outfile)
 
     # Opening the file first so we can write incrementally as we progress
-    curr_file = open(outfile, "a")
+    curr_file = open_private(outfile, "a")
     csvfile_1 = csv.writer(curr_file)
     csvfile_1.writerow(line_list)
     curr_file.close()
@@ -247,6 +290,52 @@ def copyanything(src, dst):
             raise
 
 
+def linkanything(src, dst):
+    """
+    Copy-on-write copy of the src folder to dst: the files in dst are hard
+    links to the ones in src, so nothing is copied until it is written. Files
+    that cannot be linked (e.g., across file systems) are copied.
+    Every file under dst must be written through open_private.
+    ARGS:
+      src: address of the source folder
+      dst: address of the destination folder
+    RETURNS:
+      None
+    """
+
+    def link_or_copy(src_file, dst_file):
+        try:
+            os.link(src_file, dst_file)
+        except OSError:
+            shutil.copy2(src_file, dst_file)
+
+    shutil.copytree(src, dst, copy_function=link_or_copy)
+
+
+def open_private(path, mode="w"):
+    """
+    Opens a file for writing without touching the other hard links to it (see
+    linkanything). A shared file is replaced by a file of its own first: an
+    empty one if mode truncates it, and a copy otherwise.
+    ARGS:
+      path: path of the file.
+      mode: the mode to open it with, as for open.
+    RETURNS:
+      The open file.
+    """
+    try:
+        if os.stat(path).st_nlink > 1:
+            if "w" in mode:
+                os.unlink(path)
+            else:
+                private_path = f"{path}.private"
+                shutil.copy2(path, private_path)
+                os.replace(private_path, path)
+    except FileNotFoundError:
+        pass
+    return open(path, mode)
+
+
 def removeanything(src):
     """
     Remove everything in the src folder.
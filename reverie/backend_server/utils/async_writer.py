@@ -0,0 +1,81 @@
+"""
+File: async_writer.py
+Description: Writes JSON files from a background thread, so that persisting
+them is kept off the simulation's hot path.
+"""
+
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from utils.atomic_write import atomic_writes
+from utils.logs import L
+
+
+class AsyncJsonWriter:
+    """
+    Queues JSON files (or StepLog records, see utils/step_log.py) to be written
+    by a single background thread, in the order they were queued. A file
+    queued again before it was written is only written once, with the latest
+    data (e.g., positions.json).
+    The queued data must not be modified after it is handed over.
+    """
+
+    def __init__(self, indent=None):
+        self.indent = indent
+        # <pending> maps the target of a write (a file path, or a log and a
+        # step) to the callable doing it, oldest first.
+        self.pending = OrderedDict()
+        self.busy = False
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def write(self, path, data):
+        self.submit(path, lambda: self.dump(path, data))
+
+    def append(self, log, step, data):
+        """
+        Queues appending data to log (a StepLog) as the record of step.
+        """
+        self.submit((log.folder, step), lambda: log.append(step, data))
+
+    def dump(self, path, data):
+        # Written atomically, so that readers (e.g., the frontend polling
+        # positions.json) never see a truncated file.
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_writes() as batch:
+            batch.write(path, json.dumps(data, indent=self.indent))
+
+    def submit(self, target, fn):
+        with self.cond:
+            self.pending.pop(target, None)
+            self.pending[target] = fn
+            if not self.thread:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                target, fn = self.pending.popitem(last=False)
+                self.busy = True
+            try:
+                fn()
+            except Exception as e:
+                L.warning(f"Error writing {target}: {e}")
+            finally:
+                with self.cond:
+                    self.busy = False
+                    self.cond.notify_all()
+
+    def flush(self):
+        """
+        Blocks until every queued file is written.
+        """
+        with self.cond:
+            while self.pending or self.busy:
+                self.cond.wait()
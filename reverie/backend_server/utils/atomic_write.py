@@ -0,0 +1,104 @@
+"""
+File: atomic_write.py
+Description: Atomic file writes, batched so that a save of many files pays for
+its fsyncs once instead of file by file.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from utils.config import max_parallel_saves
+
+
+class AtomicWriteBatch:
+    """
+    Collects file writes and commits them together. Every file is written to a
+    temporary file next to it; commit fsyncs them all, moves them into place
+    and then fsyncs each folder once. A crash leaves every file either as it
+    was or fully written, never half-written.
+    Moving a file into place gives it a new inode, so the other hard links to
+    the old one (see linkanything) are not touched.
+    write may be called from several threads.
+    """
+
+    def __init__(self):
+        # <files> holds (temporary path, path, on_commit) for every write.
+        self.files = []
+        # Callables to call once the batch is committed, after the on_commit
+        # of its files, e.g., to append to a log what the files now hold.
+        self.on_commit = []
+        self.lock = threading.Lock()
+
+    def write(self, path, text, on_commit=None):
+        """
+        ARGS:
+          path: the file to write. Its folder must exist.
+          text: the new content of the file.
+          on_commit: an optional callable, called once the file is in place.
+        RETURNS:
+          None
+        """
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as outfile:
+            outfile.write(text)
+        with self.lock:
+            self.files.append((tmp_path, path, on_commit))
+
+    def commit(self):
+        with self.lock:
+            files, self.files = self.files, []
+            callbacks, self.on_commit = self.on_commit, []
+        if files:
+            self.commit_files(files)
+        for on_commit in callbacks:
+            on_commit()
+
+    def commit_files(self, files):
+        def fsync(path):
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        with ThreadPoolExecutor(max_workers=min(max_parallel_saves, len(files))) as executor:
+            list(executor.map(fsync, [tmp_path for tmp_path, _, _ in files]))
+            for tmp_path, path, _ in files:
+                os.replace(tmp_path, path)
+            folders = {os.path.dirname(os.path.abspath(path)) for _, path, _ in files}
+            list(executor.map(fsync, folders))
+
+        for _, _, on_commit in files:
+            if on_commit:
+                on_commit()
+
+    def abort(self):
+        with self.lock:
+            files, self.files = self.files, []
+            self.on_commit = []
+        for tmp_path, _, _ in files:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+@contextmanager
+def atomic_writes(batch=None):
+    """
+    Yields batch, or, if it is None, a new AtomicWriteBatch that is committed
+    when the block ends (and aborted if it raises). Lets a save join the batch
+    of its caller or, on its own, write atomically anyway.
+    """
+    if batch is not None:
+        yield batch
+        return
+    batch = AtomicWriteBatch()
+    try:
+        yield batch
+    except BaseException:
+        batch.abort()
+        raise
+    batch.commit()
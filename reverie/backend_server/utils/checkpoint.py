@@ -0,0 +1,111 @@
+"""
+File: checkpoint.py
+Description: A single-file checkpoint of a simulation: a zip archive holding
+the simulation's files as sections, the in-memory state that is not saved to
+those files, and a manifest describing them.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import zipfile
+
+from utils import open_private
+
+# Bump whenever the layout of the sections changes.
+CHECKPOINT_VERSION = 1
+
+
+def write_checkpoint(path, staging_folder, state, manifest):
+    """
+    Writes a checkpoint atomically: it is written next to path and moved into
+    place once complete, so a crash never leaves a half-written checkpoint.
+    ARGS:
+      path: the file to write.
+      staging_folder: a folder whose files become the sections, named by their
+        path relative to the folder (e.g., "personas/<name>/scratch.json").
+      state: a picklable object with the state that has no file of its own.
+      manifest: a dict of additional manifest fields (e.g., step).
+    RETURNS:
+      None
+    """
+    manifest = dict(manifest, version=CHECKPOINT_VERSION, sections=dict())
+    partial_path = f"{path}.partial"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with zipfile.ZipFile(partial_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+
+        def add_section(name, data):
+            archive.writestr(name, data)
+            manifest["sections"][name] = {
+                "size": len(data),
+                "sha1": hashlib.sha1(data).hexdigest(),
+            }
+
+        for root, _, files in os.walk(staging_folder):
+            for file in sorted(files):
+                file_path = os.path.join(root, file)
+                with open(file_path, "rb") as f:
+                    add_section(os.path.relpath(file_path, staging_folder), f.read())
+        add_section("state.pickle", pickle.dumps(state))
+        archive.writestr("manifest.json", json.dumps(manifest, indent=2))
+    os.replace(partial_path, path)
+
+
+class Checkpoint:
+    """
+    Reads a checkpoint written by write_checkpoint. Sections are read on
+    demand, so restoring some personas only reads (and decompresses) theirs.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.archive = zipfile.ZipFile(path)
+        self.manifest = json.loads(self.archive.read("manifest.json"))
+        if self.manifest.get("version") != CHECKPOINT_VERSION:
+            raise ValueError(
+                f"Unsupported checkpoint version {self.manifest.get('version')} in {path}"
+            )
+
+    def close(self):
+        self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, name):
+        """
+        Returns the bytes of a section, checked against the manifest.
+        """
+        data = self.archive.read(name)
+        if hashlib.sha1(data).hexdigest() != self.manifest["sections"][name]["sha1"]:
+            raise ValueError(f"Section {name} of {self.path} is corrupt")
+        return data
+
+    def read_state(self):
+        return pickle.loads(self.read("state.pickle"))
+
+    def section_names(self, persona_names=None):
+        """
+        Returns the names of the file sections: all of them, or (if
+        persona_names is given) only those of the given personas.
+        """
+        names = [name for name in self.manifest["sections"] if name != "state.pickle"]
+        if persona_names is None:
+            return names
+        prefixes = tuple(f"personas/{persona_name}/" for persona_name in persona_names)
+        return [name for name in names if name.startswith(prefixes)]
+
+    def extract(self, folder, persona_names=None):
+        """
+        Writes the file sections (see section_names) into folder, replacing the
+        files there.
+        """
+        for name in self.section_names(persona_names):
+            file_path = os.path.join(folder, name)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open_private(file_path, "wb") as f:
+                f.write(self.read(name))
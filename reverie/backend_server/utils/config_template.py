@@ -31,6 +31,142 @@ collision_block_id = "32125"
 # Verbose
 debug = True
 
+# Maximum number of LLM / embedding requests a single persona step may have in
+# flight at once (e.g., the fan-out during reflection).
+max_parallel_llm_requests = 8
+
+# Maximum number of personas saved (and files fsynced) at once by a save.
+max_parallel_saves = 8
+
+# Resolve each persona's next action in the background while the current one is
+# still running, so the action boundary does not wait on the LLM. Off by
+# default: a prefetch that turns out stale (e.g., the persona reacted to an
+# event) still spends the LLM requests it already made.
+prefetch_next_action = False
+
+# Plan each persona's next day in the background from next_day_planning_hour on,
+# instead of planning every persona at once in the first step of the new day.
+# The plan then works from the persona's memories as of that hour: whatever
+# happens between next_day_planning_hour and midnight is left out of it.
+plan_next_day_in_background = False
+next_day_planning_hour = 23
+
+# Maximum number of simulation messages coalesced into one websocket frame.
+ws_max_batch_size = 64
+
+# Buffering of the messages sent to websocket clients, per message type. Each
+# type keeps at most <capacity> messages and drops the oldest beyond that, while
+# a "coalesce" type only keeps the latest message per key (e.g., per persona
+# for "movement"). Clients that join late are replayed what is still buffered.
+# Other types use the "log" settings.
+ws_message_channels = {
+    "chat": {"capacity": 500, "coalesce": False},
+    "log": {"capacity": 200, "coalesce": False},
+    "movement": {"capacity": 200, "coalesce": True},
+}
+
+# Maximum number of simulations the server initializes at the same time.
+max_concurrent_sim_inits = 4
+
+# Number of pre-initialized simulations the server keeps ready per base
+# template, e.g., {"base_the_ville_isabella_maria_klaus": 2}. /start adopts one
+# of them when the requested template, maze, mode and personas match.
+warm_pool_size = {}
+
+# Idle offline simulations are saved to disk and dropped from memory after
+# <hibernate_idle_seconds>, or earlier (least recently used first) when the
+# loaded simulations exceed <sim_memory_budget_mb>. They are loaded back on the
+# next request. The server checks every <hibernate_check_interval> seconds.
+# The memory a simulation takes is estimated from the persona memories it has
+# loaded (see persona_memory_size in server.py). Online simulations are never
+# hibernated (see ReverieInstance.can_hibernate): they count toward the budget,
+# but it is only enforced by hibernating offline ones, so a server running only
+# online simulations may exceed it.
+hibernate_idle_seconds = 1800
+hibernate_check_interval = 60
+sim_memory_budget_mb = 4096
+
+# Seconds between two rescans of the storage folder for the template catalog
+# behind /fetch_templates and /fetch_template. A rescan only re-reads the
+# meta.json files whose mtime changed.
+template_catalog_refresh_interval = 10
+
+# Maximum number of seconds /personas_info and /persona_detail wait for a
+# snapshot newer than the requested version ("after") before answering with
+# the current one.
+snapshot_poll_timeout = 30
+
+# Whether each offline step's movements are also written to the movement log
+# and positions.json for the Django frontend. Movements are always streamed
+# through the websocket "movement" channel; the files are written in the
+# background.
+persist_movement_files = True
+
+# Number of steps per segment of the movement and environment logs (see
+# utils/step_log.py). Only used when a log is created.
+step_log_segment_steps = 1000
+
+# Number of steps per chunk of a compressed simulation's replay. Every chunk
+# starts with a keyframe, so seeking decodes at most this many steps.
+replay_keyframe_steps = 200
+
+# Number of memories per page of a persona memory query (see
+# persona/memory_structures/memory_index.py).
+memory_page_size = 50
+
+# Where simulations are persisted (see utils/sim_store.py): "json", the
+# folders of JSON files in storage_path, or "sqlite", one database shared by
+# every simulation, to which each step is committed as a transaction. With
+# "sqlite", the folder of a simulation is its working copy, exported from
+# and imported into the database.
+sim_store = "json"
+sim_store_db = f"{storage_path}/simulations.db"
+
+# Whether the personas' associative memories are loaded on first use rather
+# than when a simulation starts, so that its first step does not wait for
+# every memory to be parsed. With <preload_persona_memories>, they are then
+# loaded in the background once the simulation is ready (see "memories" in
+# /status).
+lazy_persona_memories = True
+preload_persona_memories = True
+
+# Where the embedding vectors are stored, keyed by a hash of their text, for
+# every persona, simulation and run (see utils/embedding_store.py). With
+# <shared_embeddings>, the embeddings.json of a memory only holds the hashes:
+# its simulation folder, checkpoints and compressed copies then need this store
+# (which is never compacted) to be read, so they are no longer self-contained.
+embedding_store_path = f"{storage_path}/embeddings"
+shared_embeddings = False
+
+# Maximum number of simulations that run steps at the same time. Runs beyond
+# that wait for a slot, round-robin across tenants (see "tenant" in /start).
+# A running simulation gives up its slot every <run_slot_steps> steps if
+# others are waiting.
+max_active_runs = 4
+run_slot_steps = 1
+
+# Maximum number of LLM requests (including embeddings) in flight across all
+# simulations. Waiting requests are served by priority class: interactive
+# (interviews), then step, then batch (reflection, planning ahead).
+max_concurrent_llm_requests = 16
+
+# Chat modes of /chat that do not change the persona. They are answered by one
+# of <interactive_chat_workers> workers on a copy of the persona's memory
+# instead of waiting in the simulation's command queue.
+interactive_chat_modes = ["interview", "interview_old"]
+interactive_chat_workers = 4
+
+# Whether a new simulation hard-links the files of its template instead of
+# copying them. Files are only copied (or rewritten) when the simulation
+# writes them, so forking a big template costs almost nothing.
+fork_with_hardlinks = True
+
+# Every <checkpoint_every_steps> steps, a running simulation writes its whole
+# state into checkpoints/<step>.zip (0 disables it; the "checkpoint" command
+# always works). Only the latest <checkpoint_keep> checkpoints are kept.
+checkpoint_every_steps = 0
+checkpoint_keep = 3
+
 BASE_TEMPLATES = [
     # "base_the_villie_isabella_maria_klaus",
     "base_the_villie_isabella_maria_klaus_online",
@@ -0,0 +1,306 @@
+"""
+File: embedding_store.py
+Description: Embedding vectors keyed by a hash of the text they embed, in a
+store shared by every persona and simulation of the process and persisted
+under storage/ (see embedding_store_path in utils/config.py), so that a text
+is embedded, stored and held in memory once.
+"""
+
+import array
+import fcntl
+import hashlib
+import os
+import struct
+import threading
+import weakref
+from collections import deque
+from collections.abc import MutableMapping
+
+from utils.config import embedding_store_path, shared_embeddings
+
+# A record of the log is the digest of the text and the number of dimensions,
+# followed by the vector as doubles.
+RECORD_HEADER = struct.Struct("<20sI")
+ITEM_SIZE = array.array("d").itemsize
+
+
+def embedding_digest(text):
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+class EmbeddingStore:
+    """
+    The vectors are appended to <folder>/vectors.log and found through an
+    index of the log, built as it is read. In memory, a vector is kept as
+    long as it is referenced (see acquire and release), and every reference
+    shares it.
+    Several processes may append to the log: appends hold an exclusive lock on
+    it, and a digest that is not in the index makes us read what was appended
+    since.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.log_file = f"{folder}/vectors.log"
+        self.lock = threading.Lock()
+        # <offsets> maps each digest in the log to the offset and length of its
+        # vector. <indexed> is the end of the part of the log we read.
+        self.offsets = dict()
+        self.indexed = 0
+        # <vectors> holds the referenced vectors, and <refs> their reference
+        # counts.
+        self.vectors = dict()
+        self.refs = dict()
+        # <pending> holds the digests whose references were dropped by garbage
+        # collected maps (see release_later), until the next acquire or
+        # release drops them under <lock>.
+        self.pending = deque()
+
+    # scan, refresh, read, append, drop and drop_pending expect the caller to
+    # hold <lock>.
+
+    def scan(self, log):
+        size = log.seek(0, os.SEEK_END)
+        offset = self.indexed
+        while offset + RECORD_HEADER.size <= size:
+            log.seek(offset)
+            raw_digest, dims = RECORD_HEADER.unpack(log.read(RECORD_HEADER.size))
+            end = offset + RECORD_HEADER.size + dims * ITEM_SIZE
+            if end > size:
+                break
+            self.offsets[raw_digest.hex()] = (offset + RECORD_HEADER.size, dims)
+            offset = end
+        self.indexed = offset
+        return size
+
+    def refresh(self):
+        if not os.path.exists(self.log_file):
+            return
+        with open(self.log_file, "rb") as log:
+            fcntl.flock(log, fcntl.LOCK_SH)
+            self.scan(log)
+
+    def read(self, digest):
+        offset, dims = self.offsets[digest]
+        with open(self.log_file, "rb") as log:
+            log.seek(offset)
+            vector = array.array("d")
+            vector.frombytes(log.read(dims * ITEM_SIZE))
+        return vector.tolist()
+
+    def append(self, records):
+        os.makedirs(self.folder, exist_ok=True)
+        with open(self.log_file, "a+b") as log:
+            fcntl.flock(log, fcntl.LOCK_EX)
+            if self.scan(log) != self.indexed:
+                # A record cut short by a crash. No one else is writing, so
+                # we drop it.
+                log.truncate(self.indexed)
+            for digest, vector in records:
+                if digest in self.offsets:
+                    continue
+                data = array.array("d", vector).tobytes()
+                log.write(RECORD_HEADER.pack(bytes.fromhex(digest), len(vector)) + data)
+                self.offsets[digest] = (self.indexed + RECORD_HEADER.size, len(vector))
+                self.indexed += RECORD_HEADER.size + len(data)
+
+    def drop(self, digests):
+        for digest in digests:
+            self.refs[digest] -= 1
+            if not self.refs[digest]:
+                del self.refs[digest]
+                del self.vectors[digest]
+
+    def drop_pending(self):
+        while self.pending:
+            self.drop([self.pending.popleft()])
+
+    def get(self, digest):
+        """
+        RETURNS:
+          The vector of digest, or None if the store does not have it. It is
+          not referenced.
+        """
+        with self.lock:
+            if digest in self.vectors:
+                return self.vectors[digest]
+            if digest not in self.offsets:
+                self.refresh()
+            if digest not in self.offsets:
+                return None
+            return self.read(digest)
+
+    def put(self, digest, vector):
+        """
+        Stores vector as the vector of digest, unless the store has it already.
+        """
+        with self.lock:
+            if digest not in self.vectors and digest not in self.offsets:
+                self.append([(digest, vector)])
+
+    def acquire(self, records):
+        """
+        References the vectors of a list of (digest, vector) records, storing
+        the vectors that the store does not have. The vector of a record may
+        be None if the store has it.
+        RETURNS:
+          The shared vectors, in order.
+        """
+        with self.lock:
+            self.drop_pending()
+            missing = [
+                (digest, vector)
+                for digest, vector in records
+                if vector is not None and digest not in self.vectors and digest not in self.offsets
+            ]
+            if missing:
+                self.append(missing)
+            shared = []
+            for digest, vector in records:
+                if digest not in self.vectors:
+                    if vector is None:
+                        if digest not in self.offsets:
+                            self.refresh()
+                        if digest not in self.offsets:
+                            raise KeyError(f"No embedding {digest} in {self.log_file}")
+                        vector = self.read(digest)
+                    self.vectors[digest] = vector
+                self.refs[digest] = self.refs.get(digest, 0) + 1
+                shared.append(self.vectors[digest])
+            return shared
+
+    def release(self, digests):
+        """
+        Drops a reference to the vector of each digest. A vector that is no
+        longer referenced leaves memory (it stays in the log).
+        """
+        with self.lock:
+            self.drop_pending()
+            self.drop(digests)
+
+    def release_later(self, digests):
+        """
+        Like release, but without taking <lock>, so it is safe to call from a
+        finalizer: the garbage collector may run one in a thread that holds
+        the lock already.
+        """
+        self.pending.extend(list(digests))
+
+
+embedding_stores = dict()
+embedding_stores_lock = threading.Lock()
+
+
+def embedding_store(folder=embedding_store_path):
+    """
+    Returns the EmbeddingStore of folder, shared by every caller in this
+    process.
+    """
+    key = os.path.abspath(folder)
+    with embedding_stores_lock:
+        if key not in embedding_stores:
+            embedding_stores[key] = EmbeddingStore(folder)
+        return embedding_stores[key]
+
+
+class EmbeddingMap(MutableMapping):
+    """
+    The embeddings of an associative memory: a dict of texts to vectors,
+    where the vectors are referenced in an EmbeddingStore rather than held.
+    <digests> maps each text to the digest of its vector. Copies reference the
+    same vectors, and the references are dropped when the map is garbage
+    collected.
+    """
+
+    def __init__(self, store=None):
+        self.store = store or embedding_store()
+        self.digests = dict()
+        weakref.finalize(self, self.store.release_later, self.digests.values())
+
+    @classmethod
+    def from_json(cls, data, store=None):
+        """
+        ARGS:
+          data: the content of an embeddings.json, mapping texts to either
+            their vectors or their digests (see to_json).
+        """
+        embeddings = cls(store)
+        records = [
+            (embedding_digest(text), value) if isinstance(value, list) else (value, None)
+            for text, value in data.items()
+        ]
+        embeddings.store.acquire(records)
+        for text, (digest, _) in zip(data, records):
+            embeddings.digests[text] = digest
+        return embeddings
+
+    def to_json(self, shared=shared_embeddings):
+        """
+        Returns the content of embeddings.json: the digests of the vectors if
+        shared, so the vectors are only in the store, and else the vectors.
+        """
+        if shared:
+            return dict(self.digests)
+        return {text: self[text] for text in self.digests}
+
+    def copy(self):
+        # dict() copies <digests> at once, even while another thread adds to
+        # it (see InterviewView).
+        digests = dict(self.digests)
+        other = EmbeddingMap(self.store)
+        self.store.acquire([(digest, None) for digest in digests.values()])
+        other.digests.update(digests)
+        return other
+
+    def __getitem__(self, text):
+        return self.store.vectors[self.digests[text]]
+
+    def __setitem__(self, text, vector):
+        # The vector of a text never changes.
+        if text not in self.digests:
+            digest = embedding_digest(text)
+            self.store.acquire([(digest, vector)])
+            self.digests[text] = digest
+
+    def __delitem__(self, text):
+        self.store.release([self.digests.pop(text)])
+
+    def __contains__(self, text):
+        return text in self.digests
+
+    def __iter__(self):
+        return iter(self.digests)
+
+    def __len__(self):
+        return len(self.digests)
+
+
+def load_embeddings(data, store=None):
+    """
+    Returns the content of an embeddings.json (see EmbeddingMap.to_json) as a
+    dict of texts to vectors.
+    """
+    store = store or embedding_store()
+    embeddings = dict()
+    for text, value in data.items():
+        if not isinstance(value, list):
+            digest, value = value, store.get(value)
+            if value is None:
+                raise KeyError(f"No embedding {digest} in {store.log_file}")
+        embeddings[text] = value
+    return embeddings
+
+
+def dump_embeddings(embeddings, shared=shared_embeddings, store=None):
+    """
+    Returns the content of embeddings.json for a dict of texts to vectors,
+    storing the vectors if shared.
+    """
+    if not shared:
+        return dict(embeddings)
+    store = store or embedding_store()
+    data = dict()
+    for text, vector in embeddings.items():
+        data[text] = embedding_digest(text)
+        store.put(data[text], vector)
+    return data
@@ -10,6 +10,7 @@ from utils.config import openai_api_base, openai_api_key, override_gpt_param, ov
 from utils.logs import L
 from jinja2 import Template
 from utils import thread_local
+from utils.llm_scheduler import llm_scheduler
 
 default_client = openai.Client(api_key=openai_api_key, base_url=openai_api_base)
 
@@ -180,19 +181,20 @@ def llm_request(
                 ]
                 # L.debug(f"Prompt:{str(messages)}")
 
-                response = client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    temperature=temperature,
-                    max_tokens=max_tokens,
-                    top_p=top_p,
-                    stream=False,
-                    frequency_penalty=frequency_penalty,
-                    presence_penalty=presence_penalty,
-                    stop=stop,
-                    # api_key=llm_config.get("api_key"),
-                    # base_url=llm_config.get("base_url"),
-                )
+                with llm_scheduler.slot():
+                    response = client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        temperature=temperature,
+                        max_tokens=max_tokens,
+                        top_p=top_p,
+                        stream=False,
+                        frequency_penalty=frequency_penalty,
+                        presence_penalty=presence_penalty,
+                        stop=stop,
+                        # api_key=llm_config.get("api_key"),
+                        # base_url=llm_config.get("base_url"),
+                    )
                 if raw_response:
                     return response
                 result = response.choices[0].message.content
@@ -208,17 +210,18 @@ def llm_request(
             else:
                 # Standard completion mode
                 # L.debug(f"Prompt:{str(sys_prompt + "\n" + usr_prompt)}")
-                response = client.completions.create(
-                    model=model,
-                    prompt=sys_prompt + "\n" + usr_prompt,
-                    temperature=temperature,
-                    max_tokens=max_tokens,
-                    top_p=top_p,
-                    stream=False,
-                    frequency_penalty=frequency_penalty,
-                    presence_penalty=presence_penalty,
-                    stop=stop,
-                )
+                with llm_scheduler.slot():
+                    response = client.completions.create(
+                        model=model,
+                        prompt=sys_prompt + "\n" + usr_prompt,
+                        temperature=temperature,
+                        max_tokens=max_tokens,
+                        top_p=top_p,
+                        stream=False,
+                        frequency_penalty=frequency_penalty,
+                        presence_penalty=presence_penalty,
+                        stop=stop,
+                    )
                 if raw_response:
                     return response
 
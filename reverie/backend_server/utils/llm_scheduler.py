@@ -0,0 +1,91 @@
+"""
+File: llm_scheduler.py
+Description: A process-wide limit on concurrent LLM requests that serves
+waiting requests by priority class, so interactive requests (e.g., interviews
+through /chat) are not stuck behind background simulation traffic.
+"""
+
+import heapq
+import threading
+from contextlib import contextmanager
+
+from utils import thread_local
+from utils.config import max_concurrent_llm_requests
+
+# Priority classes, most urgent first.
+LLM_PRIORITIES = {"interactive": 0, "step": 1, "batch": 2}
+
+
+class LLMScheduler:
+    """
+    Lets at most <max_concurrent> requests through at a time. When a request
+    finishes, its slot goes to the waiting request with the most urgent
+    priority class, first come, first served within a class. Requests that
+    are already running are not interrupted.
+    """
+
+    def __init__(self, max_concurrent):
+        self.max_concurrent = max_concurrent
+        self.active = 0
+        # <waiting> is a heap of (priority, seq, event).
+        self.waiting = []
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, priority):
+        with self.lock:
+            if self.active < self.max_concurrent and not self.waiting:
+                self.active += 1
+                return
+            event = threading.Event()
+            heapq.heappush(self.waiting, (priority, self.seq, event))
+            self.seq += 1
+        event.wait()
+
+    def release(self):
+        with self.lock:
+            if self.waiting:
+                # Hand the slot over; <active> stays the same.
+                _, _, event = heapq.heappop(self.waiting)
+                event.set()
+            else:
+                self.active -= 1
+
+    @contextmanager
+    def slot(self):
+        """
+        Holds a slot for the priority class of the calling thread (see
+        llm_priority) while the block runs.
+        """
+        priority_class = getattr(thread_local, "llm_priority", "step")
+        self.acquire(LLM_PRIORITIES[priority_class])
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        with self.lock:
+            waiting = {priority_class: 0 for priority_class in LLM_PRIORITIES}
+            names = {value: key for key, value in LLM_PRIORITIES.items()}
+            for priority, _, _ in self.waiting:
+                waiting[names[priority]] += 1
+            return {"active": self.active, "waiting": waiting}
+
+
+@contextmanager
+def llm_priority(priority_class):
+    """
+    Runs the block with the LLM requests of the calling thread (and of the
+    workers it hands thread_local to, see bind_thread_local) in the given
+    priority class: "interactive", "step" (the default) or "batch".
+    """
+    previous = getattr(thread_local, "llm_priority", "step")
+    thread_local.llm_priority = priority_class
+    try:
+        yield
+    finally:
+        thread_local.llm_priority = previous
+
+
+llm_scheduler = LLMScheduler(max_concurrent_llm_requests)
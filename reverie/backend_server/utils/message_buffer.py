@@ -0,0 +1,159 @@
+"""
+File: message_buffer.py
+Description: Bounded, per-class buffering of the messages a simulation sends to
+its websocket clients.
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class MessageChannel:
+    """
+    A ring buffer for one class of messages (e.g., "chat" or "log").
+    Every message carries the buffer-wide sequence number it was posted with,
+    and a per-channel ordinal so that readers can tell how many messages they
+    missed when the buffer wrapped around them.
+    """
+
+    def __init__(self, name, capacity, coalesce=False):
+        self.name = name
+        self.capacity = capacity
+        # If <coalesce> is True, a message replaces the buffered message with
+        # the same key instead of being appended (e.g., only the latest
+        # movement matters).
+        self.coalesce = coalesce
+        # <entries> maps a key to (seq, ordinal, message), oldest first.
+        self.entries = OrderedDict()
+
+        self.posted = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def append(self, seq, message, key=None):
+        self.posted += 1
+        if self.coalesce:
+            if key in self.entries:
+                del self.entries[key]
+                self.coalesced += 1
+        else:
+            key = seq
+        self.entries[key] = (seq, self.posted, message)
+
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.dropped += 1
+
+    def oldest_ordinal(self):
+        if not self.entries:
+            return self.posted + 1
+        return next(iter(self.entries.values()))[1]
+
+    def newer_than(self, seq):
+        """
+        Returns the buffered (seq, ordinal, message) entries posted after seq,
+        oldest first.
+        """
+        newer = []
+        for entry in reversed(self.entries.values()):
+            if entry[0] <= seq:
+                break
+            newer.append(entry)
+        newer.reverse()
+        return newer
+
+    def stats(self):
+        return {
+            "posted": self.posted,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "buffered": len(self.entries),
+        }
+
+
+class MessageBuffer:
+    """
+    Holds one MessageChannel per message class. Messages are posted from the
+    simulation thread and read by the websocket senders, each of which keeps
+    its own cursor, so a slow client only falls behind (and is replayed what is
+    still buffered) instead of growing the buffer.
+    """
+
+    def __init__(self, channel_configs, on_post=None):
+        """
+        ARGS:
+          channel_configs: a dict of message type to {"capacity", "coalesce"}.
+            Messages of other types get a channel with the "log" settings.
+          on_post: an optional callable invoked (without arguments) after each
+            post, e.g., to wake up the senders.
+        """
+        self.channel_configs = channel_configs
+        self.channels = dict()
+        for name, channel_config in channel_configs.items():
+            self.channels[name] = MessageChannel(name, **channel_config)
+        self.on_post = on_post
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def post(self, message_type, message, key=None):
+        """
+        Buffers a JSON encoded message. Safe to call from any thread.
+        ARGS:
+          message_type: the message class, e.g., "chat", "log" or "movement".
+          message: the JSON encoded message.
+          key: for coalescing channels, the key of the message to replace.
+        """
+        with self.lock:
+            channel = self.channels.get(message_type)
+            if not channel:
+                channel_config = self.channel_configs.get("log", {"capacity": 200})
+                channel = MessageChannel(message_type, **channel_config)
+                self.channels[message_type] = channel
+            self.seq += 1
+            channel.append(self.seq, message, key)
+        if self.on_post:
+            self.on_post()
+
+    def new_cursor(self):
+        """
+        Returns a cursor for a client that just joined. It starts at the oldest
+        buffered message of every channel, so the client is replayed what is
+        still buffered, and earlier drops are not counted against it.
+        """
+        with self.lock:
+            return {
+                name: (0, channel.oldest_ordinal() - 1) for name, channel in self.channels.items()
+            }
+
+    def read(self, cursor, limit):
+        """
+        Reads the messages after cursor, in the order they were posted, and
+        advances cursor past them.
+        ARGS:
+          cursor: a cursor from new_cursor, updated in place.
+          limit: the maximum number of messages to return.
+        RETURNS:
+          A tuple of (list of messages, number of messages the client missed
+          because they were dropped before it read them).
+        """
+        entries = []
+        missed = 0
+        with self.lock:
+            for name, channel in self.channels.items():
+                seq, ordinal = cursor.get(name, (0, channel.oldest_ordinal() - 1))
+                if not channel.coalesce:
+                    oldest = channel.oldest_ordinal()
+                    if ordinal < oldest - 1:
+                        missed += oldest - 1 - ordinal
+                        cursor[name] = (seq, oldest - 1)
+                entries += [(entry, name) for entry in channel.newer_than(seq)]
+
+        entries.sort(key=lambda x: x[0][0])
+        entries = entries[:limit]
+        for (seq, ordinal, message), name in entries:
+            cursor[name] = (seq, ordinal)
+        return [entry[0][2] for entry in entries], missed
+
+    def stats(self):
+        with self.lock:
+            return {name: channel.stats() for name, channel in self.channels.items()}
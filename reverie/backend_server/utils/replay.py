@@ -0,0 +1,138 @@
+"""
+File: replay.py
+Description: The delta-encoded, chunked replay format of compressed
+simulations, which the demo streams chunk by chunk as playback advances.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+
+from utils.config import replay_keyframe_steps
+
+# The fields of a persona's state at a step. A delta holds the changed ones.
+REPLAY_FIELDS = ["movement", "pronunciatio", "description", "chat"]
+
+
+class ReplayWriter:
+    """
+    Writes a replay into a folder, step by step:
+      index.json: {"keyframe_steps", "last_step", "persona_names"}.
+      <first>.json: the chunk of the steps from <first> (a multiple of
+        keyframe_steps) to the next keyframe: {"first", "keyframe", "deltas"}.
+        <keyframe> is the full state of every persona before step <first>,
+        and <deltas> maps each step that changed anything to the changed
+        fields of each persona that changed.
+    So any step is decoded from the keyframe of its chunk alone.
+    """
+
+    def __init__(self, folder, keyframe_steps=replay_keyframe_steps):
+        self.folder = folder
+        self.keyframe_steps = keyframe_steps
+        self.state = dict()
+        self.chunk = None
+        self.last_step = None
+        os.makedirs(folder, exist_ok=True)
+
+    def add(self, step, personas):
+        """
+        ARGS:
+          step: the step, following the previous one.
+          personas: a dict mapping persona names to their state at step (the
+            REPLAY_FIELDS); personas that are left out did not change.
+        RETURNS:
+          None
+        """
+        if self.chunk is None or step >= self.chunk["first"] + self.keyframe_steps:
+            self.write_chunk()
+            first = step - step % self.keyframe_steps
+            keyframe = {name: dict(fields) for name, fields in self.state.items()}
+            self.chunk = {"first": first, "keyframe": keyframe, "deltas": dict()}
+
+        deltas = dict()
+        for name, fields in personas.items():
+            prev = self.state.setdefault(name, dict())
+            delta = {
+                field: fields[field]
+                for field in REPLAY_FIELDS
+                if field not in prev or prev[field] != fields[field]
+            }
+            if delta:
+                deltas[name] = delta
+                prev.update(delta)
+        if deltas:
+            self.chunk["deltas"][step] = deltas
+        self.last_step = step
+
+    def write_chunk(self):
+        if self.chunk:
+            with open(f"{self.folder}/{self.chunk['first']}.json", "w") as outfile:
+                json.dump(self.chunk, outfile, separators=(",", ":"))
+
+    def close(self):
+        self.write_chunk()
+        index = {
+            "keyframe_steps": self.keyframe_steps,
+            "last_step": self.last_step,
+            "persona_names": list(self.state),
+        }
+        with open(f"{self.folder}/index.json", "w") as outfile:
+            json.dump(index, outfile, indent=2)
+
+
+def read_index(folder):
+    with open(f"{folder}/index.json") as infile:
+        return json.load(infile)
+
+
+def chunk_file(folder, first):
+    return f"{folder}/{int(first)}.json"
+
+
+def decode_step(folder, index, step):
+    """
+    Decodes the state of every persona at step, from the keyframe before it.
+    RETURNS:
+      A dict mapping persona names to their REPLAY_FIELDS.
+    """
+    first = step - step % index["keyframe_steps"]
+    with open(chunk_file(folder, first)) as infile:
+        chunk = json.load(infile)
+    state = chunk["keyframe"]
+    for delta_step in sorted(chunk["deltas"], key=int):
+        if int(delta_step) > step:
+            break
+        for name, delta in chunk["deltas"][delta_step].items():
+            state.setdefault(name, dict()).update(delta)
+    return state
+
+
+def convert_master_movement(move_file, folder):
+    """
+    Converts the master_movement.json of a simulation compressed before the
+    replay format existed (see compress_sim_storage.py). The replay is written
+    into a temporary folder that is renamed to folder once complete, so
+    concurrent readers (and converters) never see a half-written one.
+    """
+    with open(move_file) as infile:
+        master_move = json.load(infile)
+    parent = os.path.dirname(os.path.abspath(folder))
+    staging = tempfile.mkdtemp(prefix=".replay-", dir=parent)
+    try:
+        writer = ReplayWriter(staging)
+        for step in range(len(master_move)):
+            writer.add(step, master_move[str(step)])
+        writer.close()
+        if os.path.exists(f"{folder}/index.json"):
+            # Another request converted it first.
+            return
+        # What is left of a conversion that did not finish.
+        shutil.rmtree(folder, ignore_errors=True)
+        try:
+            os.rename(staging, folder)
+        except OSError:
+            if not os.path.exists(f"{folder}/index.json"):
+                raise
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
@@ -0,0 +1,121 @@
+"""
+File: run_scheduler.py
+Description: Admission control for simulation runs, so that only a bounded
+number of simulations step (and call the LLM) at the same time.
+"""
+
+import threading
+from collections import OrderedDict, deque
+
+
+class RunScheduler:
+    """
+    Hands out <max_active> run slots. Simulations waiting for one are queued
+    per tenant: first come, first served within a tenant, and round-robin
+    across tenants, so one tenant starting many runs does not starve the
+    others. Meant to be called from the simulation threads.
+    """
+
+    def __init__(self, max_active):
+        self.max_active = max_active
+        # <active> holds the tickets that have a slot.
+        self.active = set()
+        # <queues> maps a tenant to its waiting tickets. The tenant to be
+        # served next comes first.
+        self.queues = OrderedDict()
+        self.cond = threading.Condition()
+
+    def acquire(self, tenant, ticket):
+        """
+        Blocks until ticket gets a slot.
+        """
+        with self.cond:
+            if ticket in self.active:
+                return
+            self.queues.setdefault(tenant, deque()).append(ticket)
+            while len(self.active) >= self.max_active or self.next_ticket() != ticket:
+                self.cond.wait()
+
+            queue = self.queues[tenant]
+            queue.popleft()
+            if queue:
+                # The tenant is served again after everybody else.
+                self.queues.move_to_end(tenant)
+            else:
+                del self.queues[tenant]
+            self.active.add(ticket)
+            # The next ticket in line may also fit.
+            self.cond.notify_all()
+
+    def release(self, ticket):
+        with self.cond:
+            if ticket in self.active:
+                self.active.remove(ticket)
+                self.cond.notify_all()
+
+    def next_ticket(self):
+        for queue in self.queues.values():
+            return queue[0]
+        return None
+
+    def has_waiting(self):
+        with self.cond:
+            return bool(self.queues)
+
+    def position(self, ticket):
+        """
+        RETURNS:
+          The 1-based position in which ticket would be admitted if no new
+          runs came in, or None if it is not waiting.
+        """
+        with self.cond:
+            queues = [list(queue) for queue in self.queues.values()]
+        position = 0
+        for i in range(max((len(queue) for queue in queues), default=0)):
+            for queue in queues:
+                if i < len(queue):
+                    position += 1
+                    if queue[i] == ticket:
+                        return position
+        return None
+
+    def stats(self):
+        with self.cond:
+            return {
+                "max_active": self.max_active,
+                "active": len(self.active),
+                "waiting": sum(len(queue) for queue in self.queues.values()),
+            }
+
+
+class RunTicket:
+    """
+    A simulation's handle on a RunScheduler. The simulation calls step before
+    every step of a run and release when the run is over. It keeps its slot
+    for <quantum> steps at a time and then, if others are waiting, lines up
+    again, so long runs take turns instead of holding a slot to the end.
+    """
+
+    def __init__(self, scheduler, tenant, quantum=1):
+        self.scheduler = scheduler
+        self.tenant = tenant
+        self.quantum = quantum
+        self.holding = False
+        self.steps = 0
+
+    def step(self):
+        if self.holding and self.steps >= self.quantum and self.scheduler.has_waiting():
+            self.release()
+        if not self.holding:
+            self.scheduler.acquire(self.tenant, self)
+            self.holding = True
+            self.steps = 0
+        self.steps += 1
+
+    def release(self):
+        if self.holding:
+            self.holding = False
+            self.scheduler.release(self)
+
+    def position(self):
+        return self.scheduler.position(self)
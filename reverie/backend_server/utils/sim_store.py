@@ -0,0 +1,913 @@
+"""
+File: sim_store.py
+Description: Where simulations are persisted (see sim_store in
+utils/config.py): either the folders of JSON files in the storage folder
+(JsonSimStore), or one SQLite database shared by every simulation
+(SqliteSimStore). The folder layout stays the export/import format between
+the two (see transfer_simulation).
+"""
+
+import array
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from utils import linkanything, parallel_map, removeanything
+from utils.atomic_write import AtomicWriteBatch
+from utils.embedding_store import dump_embeddings, embedding_digest, load_embeddings
+from utils.config import (
+    max_parallel_saves,
+    memory_page_size,
+    sim_store,
+    sim_store_db,
+    storage_path,
+)
+from utils.step_log import list_steps, read_step, step_log
+from persona.memory_structures import memory_index
+
+# The kinds of per-step records of a simulation, each a folder of the
+# simulation (e.g., "movement/") and a table of the database.
+STEP_KINDS = ("movement", "environment")
+# The parts of a persona's memory, with the file each one is saved in under
+# personas/<name>/bootstrap_memory.
+PERSONA_FILES = {
+    "scratch": "scratch.json",
+    "spatial": "spatial_memory.json",
+    "nodes": "associative_memory/nodes.json",
+    "kw_strength": "associative_memory/kw_strength.json",
+    "embeddings": "associative_memory/embeddings.json",
+}
+# The scratch fields that are stored as rows of the schedules table.
+SCHEDULES = ("f_daily_schedule", "f_daily_schedule_hourly_org")
+# The fields of a node record (see AssociativeMemory.node_record), which are
+# the columns of the nodes table.
+NODE_FIELDS = (
+    "node_count",
+    "type_count",
+    "type",
+    "depth",
+    "created",
+    "expiration",
+    "subject",
+    "predicate",
+    "object",
+    "description",
+    "embedding_key",
+    "poignancy",
+    "keywords",
+    "filling",
+)
+
+
+class SimStore:
+    """
+    The interface of the stores. Reads are methods of the store; writes go
+    through a SimTransaction, and are all committed or none.
+    """
+
+    # Whether a commit costs in proportion to what changed, so that the
+    # simulation can commit every step, personas included (see
+    # Reverie.commit_step). Otherwise, personas are only written by save.
+    incremental = False
+
+    def transaction(self):
+        """
+        A context manager yielding a SimTransaction, committed when the block
+        ends and rolled back if it raises.
+        """
+        raise NotImplementedError
+
+    def exists(self, sim_code):
+        raise NotImplementedError
+
+    def list_simulations(self):
+        raise NotImplementedError
+
+    def read_meta(self, sim_code):
+        """
+        RETURNS:
+          The content of the simulation's meta.json, or None.
+        """
+        raise NotImplementedError
+
+    def read_events(self, sim_code):
+        raise NotImplementedError
+
+    def read_positions(self, sim_code):
+        """
+        RETURNS:
+          The positions the simulation continues from (see Reverie.save), or
+          None.
+        """
+        raise NotImplementedError
+
+    def read_step(self, sim_code, kind, step):
+        """
+        RETURNS:
+          The record of step of the given kind (see STEP_KINDS), or None.
+        """
+        raise NotImplementedError
+
+    def list_steps(self, sim_code, kind):
+        raise NotImplementedError
+
+    def last_step(self, sim_code, kind):
+        steps = self.list_steps(sim_code, kind)
+        return steps[-1] if steps else None
+
+    def read_persona(self, sim_code, persona_name, parts=tuple(PERSONA_FILES)):
+        """
+        RETURNS:
+          A dict mapping each of the given parts (see PERSONA_FILES) that the
+          persona has to its content, as in its file.
+        """
+        raise NotImplementedError
+
+    def query_memory(self, sim_code, persona_name, **filters):
+        """
+        Finds a page of the persona's memory nodes (see MemoryIndex.query for
+        the filters).
+        RETURNS:
+          A tuple of (the records of the nodes of the page, the next cursor).
+        """
+        raise NotImplementedError
+
+    def copy_simulation(self, sim_code, new_sim_code):
+        raise NotImplementedError
+
+    def delete_simulation(self, sim_code):
+        raise NotImplementedError
+
+
+class SimTransaction:
+    def write_meta(self, sim_code, meta):
+        raise NotImplementedError
+
+    def write_events(self, sim_code, events):
+        raise NotImplementedError
+
+    def write_positions(self, sim_code, positions):
+        raise NotImplementedError
+
+    def write_steps(self, sim_code, kind, records):
+        """
+        Writes a list of (step, data) records of the given kind.
+        """
+        raise NotImplementedError
+
+    def write_step(self, sim_code, kind, step, data):
+        self.write_steps(sim_code, kind, [(step, data)])
+
+    def write_personas(self, sim_code, personas):
+        """
+        Writes the memories of the personas (a dict of names to Persona) that
+        changed since they were last written.
+        """
+        raise NotImplementedError
+
+    def write_persona_data(self, sim_code, persona_name, data):
+        """
+        Writes the parts of a persona's memory in data, as returned by
+        SimStore.read_persona.
+        """
+        raise NotImplementedError
+
+
+class JsonSimStore(SimStore):
+    """
+    The folders of the simulations in storage_path, as the rest of the code
+    reads them. Steps go to their step logs right away; the other files are
+    written through an AtomicWriteBatch.
+    """
+
+    def __init__(self, storage_path):
+        self.storage_path = storage_path
+
+    def folder(self, sim_code):
+        return f"{self.storage_path}/{sim_code}"
+
+    def persona_folder(self, sim_code, persona_name):
+        return f"{self.folder(sim_code)}/personas/{persona_name}/bootstrap_memory"
+
+    @contextmanager
+    def transaction(self):
+        batch = AtomicWriteBatch()
+        try:
+            yield JsonTransaction(self, batch)
+        except BaseException:
+            batch.abort()
+            raise
+        batch.commit()
+
+    def read_json(self, path, default=None):
+        if not os.path.exists(path):
+            return default
+        with open(path) as infile:
+            return json.load(infile)
+
+    def exists(self, sim_code):
+        return os.path.isdir(self.folder(sim_code))
+
+    def list_simulations(self):
+        return sorted(
+            sim_code
+            for sim_code in os.listdir(self.storage_path)
+            if os.path.exists(f"{self.folder(sim_code)}/reverie/meta.json")
+        )
+
+    def read_meta(self, sim_code):
+        return self.read_json(f"{self.folder(sim_code)}/reverie/meta.json")
+
+    def read_events(self, sim_code):
+        return self.read_json(f"{self.folder(sim_code)}/reverie/events.json", [])
+
+    def read_positions(self, sim_code):
+        return self.read_json(f"{self.folder(sim_code)}/positions.json")
+
+    def read_step(self, sim_code, kind, step):
+        return read_step(f"{self.folder(sim_code)}/{kind}", step)
+
+    def list_steps(self, sim_code, kind):
+        return list_steps(f"{self.folder(sim_code)}/{kind}")
+
+    def read_persona(self, sim_code, persona_name, parts=tuple(PERSONA_FILES)):
+        folder = self.persona_folder(sim_code, persona_name)
+        data = dict()
+        for part in parts:
+            content = self.read_json(f"{folder}/{PERSONA_FILES[part]}")
+            if content is not None:
+                # Embeddings may be saved as the digests of their vectors.
+                data[part] = load_embeddings(content) if part == "embeddings" else content
+        return data
+
+    def query_memory(self, sim_code, persona_name, **filters):
+        return memory_index.query_memory(
+            f"{self.persona_folder(sim_code, persona_name)}/associative_memory", **filters
+        )
+
+    def copy_simulation(self, sim_code, new_sim_code):
+        linkanything(self.folder(sim_code), self.folder(new_sim_code))
+
+    def delete_simulation(self, sim_code):
+        removeanything(self.folder(sim_code))
+
+
+class JsonTransaction(SimTransaction):
+    def __init__(self, store, batch):
+        self.store = store
+        self.batch = batch
+
+    def write_file(self, path, data, indent=None):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.batch.write(path, json.dumps(data, indent=indent))
+
+    def write_meta(self, sim_code, meta):
+        self.write_file(f"{self.store.folder(sim_code)}/reverie/meta.json", meta, indent=2)
+
+    def write_events(self, sim_code, events):
+        self.write_file(f"{self.store.folder(sim_code)}/reverie/events.json", events, indent=2)
+
+    def write_positions(self, sim_code, positions):
+        self.write_file(f"{self.store.folder(sim_code)}/positions.json", positions, indent=2)
+
+    def write_steps(self, sim_code, kind, records):
+        step_log(f"{self.store.folder(sim_code)}/{kind}").extend(records)
+
+    def write_personas(self, sim_code, personas):
+        def save_persona(item):
+            persona_name, persona = item
+            persona.save(self.store.persona_folder(sim_code, persona_name), self.batch)
+
+        parallel_map(save_persona, personas.items(), max_workers=max_parallel_saves)
+
+    def write_persona_data(self, sim_code, persona_name, data):
+        folder = self.store.persona_folder(sim_code, persona_name)
+        for part, content in data.items():
+            indent = 2 if part == "scratch" else None
+            if part == "embeddings":
+                content = dump_embeddings(content)
+            self.write_file(f"{folder}/{PERSONA_FILES[part]}", content, indent)
+        if "nodes" in data:
+            # The index and the node log of the old nodes (see memory_index.py)
+            # no longer match. They are rebuilt by the next save.
+            removeanything(f"{folder}/associative_memory/{memory_index.NODE_LOG}")
+            index_file = f"{folder}/associative_memory/{memory_index.INDEX_FILE}"
+            if os.path.exists(index_file):
+                os.remove(index_file)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS simulations (
+    sim_code TEXT PRIMARY KEY,
+    meta TEXT,
+    events TEXT,
+    positions TEXT
+);
+CREATE TABLE IF NOT EXISTS movement (
+    sim_code TEXT NOT NULL,
+    step INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (sim_code, step)
+);
+CREATE TABLE IF NOT EXISTS environment (
+    sim_code TEXT NOT NULL,
+    step INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (sim_code, step)
+);
+CREATE TABLE IF NOT EXISTS personas (
+    sim_code TEXT NOT NULL,
+    persona TEXT NOT NULL,
+    scratch TEXT,
+    spatial TEXT,
+    kw_strength TEXT,
+    PRIMARY KEY (sim_code, persona)
+);
+CREATE TABLE IF NOT EXISTS schedules (
+    sim_code TEXT NOT NULL,
+    persona TEXT NOT NULL,
+    schedule TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    task TEXT,
+    duration INTEGER,
+    PRIMARY KEY (sim_code, persona, schedule, seq)
+);
+CREATE TABLE IF NOT EXISTS nodes (
+    sim_code TEXT NOT NULL,
+    persona TEXT NOT NULL,
+    node_count INTEGER NOT NULL,
+    type_count INTEGER,
+    type TEXT,
+    depth INTEGER,
+    created TEXT,
+    expiration TEXT,
+    subject TEXT,
+    predicate TEXT,
+    object TEXT,
+    description TEXT,
+    embedding_key TEXT,
+    poignancy, -- untyped, so ints stay ints
+    keywords TEXT,
+    filling TEXT,
+    PRIMARY KEY (sim_code, persona, node_count)
+);
+CREATE INDEX IF NOT EXISTS nodes_by_type ON nodes (sim_code, persona, type, node_count);
+-- The vectors are keyed by the digest of their text (see embedding_store.py)
+-- and shared by every persona and simulation embedding it.
+CREATE TABLE IF NOT EXISTS vectors (
+    digest TEXT PRIMARY KEY,
+    vector BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS embeddings (
+    sim_code TEXT NOT NULL,
+    persona TEXT NOT NULL,
+    key TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (sim_code, persona, key)
+);
+CREATE INDEX IF NOT EXISTS embeddings_by_digest ON embeddings (digest);
+"""
+# The tables holding the rows of a simulation, in the order they are copied.
+SIM_TABLES = (
+    "simulations",
+    "movement",
+    "environment",
+    "personas",
+    "schedules",
+    "nodes",
+    "embeddings",
+)
+
+
+def pack_vector(vector):
+    return array.array("d", vector).tobytes()
+
+
+def unpack_vector(blob):
+    vector = array.array("d")
+    vector.frombytes(blob)
+    return vector.tolist()
+
+
+def digest(text):
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def persona_parts(persona):
+    """
+    Returns (memory, part, stamp) for each part of the memories of persona,
+    where stamp tells what the part holds now: digests of the scratch and the
+    spatial memory, and the numbers of nodes and embeddings (which are only
+    ever added) with the revision of the associative memory. An associative
+    memory that is not loaded (see Persona.a_mem) has not changed, and is left
+    out.
+    """
+    parts = [(persona.scratch, "scratch", digest(json.dumps(persona.scratch.to_dict())))]
+    if getattr(persona, "s_mem", None) is not None:
+        parts.append((persona.s_mem, "spatial", digest(json.dumps(persona.s_mem.tree))))
+    if persona.memories_loaded():
+        a_mem = persona.a_mem
+        parts.append((a_mem, "nodes", (len(a_mem.id_to_node), a_mem.revision)))
+        parts.append((a_mem, "embeddings", len(a_mem.embeddings)))
+    return parts
+
+
+class SqliteSimStore(SimStore):
+    """
+    Every simulation in one SQLite database, in WAL mode so that readers (e.g.,
+    the replay views) never wait for the simulations writing to it. The
+    memories are stored one row per node, schedule entry and embedding (whose
+    vector, a BLOB of doubles, is in the shared vectors table), so a step only
+    writes the rows that changed: what a persona has in the database is
+    tracked in the <saved> dict of its memories (see memory.py), under keys of
+    the form "<db_file>#<sim_code>/<persona>".
+    """
+
+    incremental = True
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        # Connections cannot be shared between threads, so each thread (e.g.,
+        # each running simulation) gets its own.
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(db_file)), exist_ok=True)
+        self.migrate(self.connection())
+
+    @staticmethod
+    def migrate(conn):
+        columns = [column for _, column, *_ in conn.execute("PRAGMA table_info(embeddings)")]
+        if "vector" not in columns:
+            conn.executescript(SCHEMA)
+            return
+        # The embeddings of older databases hold their vectors: move them to
+        # the vectors table.
+        conn.create_function("embedding_digest", 1, embedding_digest, deterministic=True)
+        conn.executescript(
+            "BEGIN IMMEDIATE;"
+            "ALTER TABLE embeddings RENAME TO legacy_embeddings;"
+            + SCHEMA
+            + "INSERT OR IGNORE INTO vectors (digest, vector)"
+            " SELECT embedding_digest(key), vector FROM legacy_embeddings;"
+            "INSERT INTO embeddings (sim_code, persona, key, digest)"
+            " SELECT sim_code, persona, key, embedding_digest(key) FROM legacy_embeddings;"
+            "DROP TABLE legacy_embeddings;"
+            "COMMIT;"
+        )
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            # We manage transactions ourselves (see transaction).
+            conn = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # In WAL mode, a commit is atomic without syncing; syncing at each
+            # checkpoint is enough for it to survive a crash of the process.
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self.connection()
+        # Takes the write lock at once, so concurrent transactions wait for
+        # each other (up to the timeout) instead of failing halfway.
+        conn.execute("BEGIN IMMEDIATE")
+        tx = SqliteTransaction(self, conn)
+        try:
+            yield tx
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        for on_commit in tx.on_commit:
+            on_commit()
+
+    def fetch_one(self, query, args):
+        row = self.connection().execute(query, args).fetchone()
+        return row[0] if row else None
+
+    def persona_key(self, sim_code, persona_name):
+        return f"{self.db_file}#{sim_code}/{persona_name}"
+
+    def exists(self, sim_code):
+        row = self.fetch_one("SELECT 1 FROM simulations WHERE sim_code = ?", (sim_code,))
+        return row is not None
+
+    def list_simulations(self):
+        rows = self.connection().execute("SELECT sim_code FROM simulations ORDER BY sim_code")
+        return [sim_code for sim_code, in rows]
+
+    def read_column(self, sim_code, column, default=None):
+        text = self.fetch_one(f"SELECT {column} FROM simulations WHERE sim_code = ?", (sim_code,))
+        return json.loads(text) if text is not None else default
+
+    def read_meta(self, sim_code):
+        return self.read_column(sim_code, "meta")
+
+    def read_events(self, sim_code):
+        return self.read_column(sim_code, "events", [])
+
+    def read_positions(self, sim_code):
+        return self.read_column(sim_code, "positions")
+
+    def read_step(self, sim_code, kind, step):
+        assert kind in STEP_KINDS
+        text = self.fetch_one(
+            f"SELECT data FROM {kind} WHERE sim_code = ? AND step = ?", (sim_code, step)
+        )
+        return json.loads(text) if text is not None else None
+
+    def list_steps(self, sim_code, kind):
+        assert kind in STEP_KINDS
+        rows = self.connection().execute(
+            f"SELECT step FROM {kind} WHERE sim_code = ? ORDER BY step", (sim_code,)
+        )
+        return [step for step, in rows]
+
+    def last_step(self, sim_code, kind):
+        assert kind in STEP_KINDS
+        return self.fetch_one(f"SELECT MAX(step) FROM {kind} WHERE sim_code = ?", (sim_code,))
+
+    def read_persona(self, sim_code, persona_name, parts=tuple(PERSONA_FILES)):
+        conn = self.connection()
+        args = (sim_code, persona_name)
+        row = conn.execute(
+            "SELECT scratch, spatial, kw_strength FROM personas WHERE sim_code = ? AND persona = ?",
+            args,
+        ).fetchone()
+        if row is None:
+            return dict()
+        scratch, spatial, kw_strength = row
+
+        data = dict()
+        if "scratch" in parts and scratch is not None:
+            data["scratch"] = json.loads(scratch)
+            for schedule in SCHEDULES:
+                data["scratch"][schedule] = [
+                    [task, duration]
+                    for task, duration in conn.execute(
+                        "SELECT task, duration FROM schedules"
+                        " WHERE sim_code = ? AND persona = ? AND schedule = ? ORDER BY seq",
+                        args + (schedule,),
+                    )
+                ]
+        if "spatial" in parts and spatial is not None:
+            data["spatial"] = json.loads(spatial)
+        if "kw_strength" in parts and kw_strength is not None:
+            data["kw_strength"] = json.loads(kw_strength)
+        if "nodes" in parts:
+            rows = conn.execute(
+                f"SELECT {', '.join(NODE_FIELDS)} FROM nodes WHERE sim_code = ? AND persona = ?",
+                args,
+            )
+            data["nodes"] = {
+                f"node_{record['node_count']}": record for record in map(self.node_record, rows)
+            }
+        if "embeddings" in parts:
+            rows = conn.execute(
+                "SELECT key, vector FROM embeddings NATURAL JOIN vectors"
+                " WHERE sim_code = ? AND persona = ?",
+                args,
+            )
+            data["embeddings"] = {key: unpack_vector(vector) for key, vector in rows}
+        return data
+
+    @staticmethod
+    def node_record(row):
+        record = dict(zip(NODE_FIELDS, row))
+        record["keywords"] = json.loads(record["keywords"])
+        record["filling"] = json.loads(record["filling"])
+        return record
+
+    def query_memory(
+        self,
+        sim_code,
+        persona_name,
+        node_type=None,
+        since=None,
+        until=None,
+        keyword=None,
+        cursor=None,
+        limit=memory_page_size,
+    ):
+        # The same query as MemoryIndex.query, on the nodes table.
+        since, until = [
+            t.strftime("%Y-%m-%d %H:%M:%S") if hasattr(t, "strftime") else t
+            for t in (since, until)
+        ]
+        limit = max(int(limit), 1)
+        conditions, args = ["sim_code = ?", "persona = ?"], [sim_code, persona_name]
+        for condition, value in [
+            ("type = ?", node_type),
+            ("created >= ?", since),
+            ("created <= ?", until),
+            ("node_count < ?", cursor and int(cursor)),
+            (
+                "EXISTS (SELECT 1 FROM json_each(nodes.keywords) WHERE lower(value) = lower(?))",
+                keyword,
+            ),
+        ]:
+            if value:
+                conditions.append(condition)
+                args.append(value)
+        rows = self.connection().execute(
+            f"SELECT {', '.join(NODE_FIELDS)} FROM nodes WHERE {' AND '.join(conditions)}"
+            " ORDER BY node_count DESC LIMIT ?",
+            args + [limit + 1],
+        )
+        records = list(map(self.node_record, rows))
+        if len(records) > limit:
+            return records[:limit], records[limit - 1]["node_count"]
+        return records, None
+
+    def copy_simulation(self, sim_code, new_sim_code):
+        with self.transaction() as tx:
+            for table in SIM_TABLES:
+                columns = [
+                    column
+                    for _, column, *_ in tx.conn.execute(f"PRAGMA table_info({table})")
+                    if column != "sim_code"
+                ]
+                tx.conn.execute(
+                    f"INSERT OR REPLACE INTO {table} (sim_code, {', '.join(columns)})"
+                    f" SELECT ?, {', '.join(columns)} FROM {table} WHERE sim_code = ?",
+                    (new_sim_code, sim_code),
+                )
+
+    def delete_simulation(self, sim_code):
+        with self.transaction() as tx:
+            tx.delete_rows(SIM_TABLES, sim_code)
+            # Vectors no other simulation embeds.
+            tx.conn.execute(
+                "DELETE FROM vectors WHERE digest NOT IN (SELECT digest FROM embeddings)"
+            )
+
+
+class SqliteTransaction(SimTransaction):
+    def __init__(self, store, conn):
+        self.store = store
+        self.conn = conn
+        # Callables to call once the transaction is committed, e.g., to mark
+        # what was written as saved.
+        self.on_commit = []
+
+    def delete_rows(self, tables, sim_code, persona_name=None):
+        for table in tables:
+            if persona_name is None:
+                self.conn.execute(f"DELETE FROM {table} WHERE sim_code = ?", (sim_code,))
+            else:
+                self.conn.execute(
+                    f"DELETE FROM {table} WHERE sim_code = ? AND persona = ?",
+                    (sim_code, persona_name),
+                )
+
+    def write_column(self, sim_code, column, data):
+        self.conn.execute(
+            f"INSERT INTO simulations (sim_code, {column}) VALUES (?, ?)"
+            f" ON CONFLICT (sim_code) DO UPDATE SET {column} = excluded.{column}",
+            (sim_code, json.dumps(data)),
+        )
+
+    def write_meta(self, sim_code, meta):
+        self.write_column(sim_code, "meta", meta)
+
+    def write_events(self, sim_code, events):
+        self.write_column(sim_code, "events", events)
+
+    def write_positions(self, sim_code, positions):
+        self.write_column(sim_code, "positions", positions)
+
+    def write_steps(self, sim_code, kind, records):
+        assert kind in STEP_KINDS
+        self.conn.executemany(
+            f"INSERT OR REPLACE INTO {kind} (sim_code, step, data) VALUES (?, ?, ?)",
+            [(sim_code, step, json.dumps(data, separators=(",", ":"))) for step, data in records],
+        )
+
+    def write_persona_column(self, sim_code, persona_name, column, text):
+        self.conn.execute(
+            f"INSERT INTO personas (sim_code, persona, {column}) VALUES (?, ?, ?)"
+            f" ON CONFLICT (sim_code, persona) DO UPDATE SET {column} = excluded.{column}",
+            (sim_code, persona_name, text),
+        )
+
+    def write_scratch(self, sim_code, persona_name, scratch):
+        scratch = dict(scratch)
+        schedules = {schedule: scratch.pop(schedule, None) or [] for schedule in SCHEDULES}
+        self.write_persona_column(sim_code, persona_name, "scratch", json.dumps(scratch))
+        self.delete_rows(["schedules"], sim_code, persona_name)
+        self.conn.executemany(
+            "INSERT INTO schedules (sim_code, persona, schedule, seq, task, duration)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (sim_code, persona_name, schedule, seq, task, duration)
+                for schedule, entries in schedules.items()
+                for seq, (task, duration) in enumerate(entries)
+            ],
+        )
+
+    def insert_nodes(self, sim_code, persona_name, records):
+        self.conn.executemany(
+            f"INSERT OR REPLACE INTO nodes (sim_code, persona, {', '.join(NODE_FIELDS)})"
+            f" VALUES (?, ?{', ?' * len(NODE_FIELDS)})",
+            [
+                (sim_code, persona_name)
+                + tuple(
+                    json.dumps(record[field]) if field in ("keywords", "filling") else record[field]
+                    for field in NODE_FIELDS
+                )
+                for record in records
+            ],
+        )
+
+    def insert_embeddings(self, sim_code, persona_name, embeddings):
+        rows = [(key, embedding_digest(key), vector) for key, vector in embeddings]
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO vectors (digest, vector) VALUES (?, ?)",
+            [(digest, pack_vector(vector)) for _, digest, vector in rows],
+        )
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (sim_code, persona, key, digest)"
+            " VALUES (?, ?, ?, ?)",
+            [(sim_code, persona_name, key, digest) for key, digest, _ in rows],
+        )
+
+    def write_personas(self, sim_code, personas):
+        for persona_name, persona in personas.items():
+            self.write_persona(sim_code, persona_name, persona)
+
+    def write_persona(self, sim_code, persona_name, persona):
+        key = self.store.persona_key(sim_code, persona_name)
+        args = (sim_code, persona_name)
+        for memory, part, stamp in persona_parts(persona):
+            saved = memory.saved.get(f"{key}/{part}")
+            if saved == stamp:
+                continue
+            if part == "scratch":
+                self.write_scratch(sim_code, persona_name, memory.to_dict())
+            elif part == "spatial":
+                text = json.dumps(memory.tree)
+                self.write_persona_column(sim_code, persona_name, "spatial", text)
+            elif part == "nodes":
+                # Nodes are only added, and node_<count> is the same node in
+                # every branch of a simulation's history, so we only insert
+                # the nodes past the ones written. Until we know how many
+                # those are, we count them, after dropping any nodes past ours
+                # (e.g., once a checkpoint is restored). kw_strength is small
+                # and goes along.
+                if saved is None:
+                    self.conn.execute(
+                        "DELETE FROM nodes WHERE sim_code = ? AND persona = ? AND node_count > ?",
+                        args + (stamp[0],),
+                    )
+                    written = self.conn.execute(
+                        "SELECT COUNT(*) FROM nodes WHERE sim_code = ? AND persona = ?", args
+                    ).fetchone()[0]
+                else:
+                    written = saved[0]
+                self.insert_nodes(
+                    sim_code,
+                    persona_name,
+                    [
+                        memory.node_record(memory.id_to_node[f"node_{count}"])
+                        for count in range(written + 1, stamp[0] + 1)
+                    ],
+                )
+                self.write_persona_column(
+                    sim_code, persona_name, "kw_strength", memory.dump_kw_strength()
+                )
+            elif part == "embeddings":
+                # Likewise, embeddings are only added. Dicts keep their
+                # insertion order, so the new ones are last.
+                if saved is None:
+                    keys = {
+                        key
+                        for key, in self.conn.execute(
+                            "SELECT key FROM embeddings WHERE sim_code = ? AND persona = ?", args
+                        )
+                    }
+                    self.conn.executemany(
+                        "DELETE FROM embeddings WHERE sim_code = ? AND persona = ? AND key = ?",
+                        [args + (key,) for key in keys - memory.embeddings.keys()],
+                    )
+                    embeddings = [
+                        (key, vector)
+                        for key, vector in memory.embeddings.items()
+                        if key not in keys
+                    ]
+                else:
+                    embeddings = list(memory.embeddings.items())[saved:]
+                self.insert_embeddings(sim_code, persona_name, embeddings)
+            self.on_commit.append(
+                lambda memory=memory, part=part, stamp=stamp: memory.saved.__setitem__(
+                    f"{key}/{part}", stamp
+                )
+            )
+
+    def write_persona_data(self, sim_code, persona_name, data):
+        if "scratch" in data:
+            self.write_scratch(sim_code, persona_name, data["scratch"])
+        if "spatial" in data:
+            text = json.dumps(data["spatial"])
+            self.write_persona_column(sim_code, persona_name, "spatial", text)
+        if "kw_strength" in data:
+            self.write_persona_column(
+                sim_code, persona_name, "kw_strength", json.dumps(data["kw_strength"])
+            )
+        if "nodes" in data:
+            self.delete_rows(["nodes"], sim_code, persona_name)
+            self.insert_nodes(sim_code, persona_name, data["nodes"].values())
+        if "embeddings" in data:
+            self.delete_rows(["embeddings"], sim_code, persona_name)
+            self.insert_embeddings(sim_code, persona_name, data["embeddings"].items())
+
+
+def transfer_simulation(src, dst, sim_code, steps=True):
+    """
+    Copies a simulation from the store src to the store dst, replacing it
+    there. Between a JsonSimStore and a SqliteSimStore, this is the export
+    (to the folder layout) or the import (from it).
+    ARGS:
+      src, dst: SimStores.
+      sim_code: the simulation.
+      steps: whether to copy the per-step records (movement and
+        environment) as well.
+    RETURNS:
+      None
+    """
+    meta = src.read_meta(sim_code)
+    if meta is None:
+        raise ValueError(f"Simulation {sim_code} not found")
+    with dst.transaction() as tx:
+        if isinstance(tx, SqliteTransaction):
+            # Rows left by an earlier simulation of the same code (e.g., steps
+            # past ours) would otherwise remain.
+            tx.delete_rows(
+                [table for table in SIM_TABLES if steps or table not in STEP_KINDS], sim_code
+            )
+        tx.write_meta(sim_code, meta)
+        tx.write_events(sim_code, src.read_events(sim_code))
+        positions = src.read_positions(sim_code)
+        if positions is not None:
+            tx.write_positions(sim_code, positions)
+        if steps:
+            for kind in STEP_KINDS:
+                records = [
+                    (step, src.read_step(sim_code, kind, step))
+                    for step in src.list_steps(sim_code, kind)
+                ]
+                tx.write_steps(sim_code, kind, records)
+        for persona_name in meta["persona_names"]:
+            tx.write_persona_data(sim_code, persona_name, src.read_persona(sim_code, persona_name))
+
+
+sim_stores = dict()
+sim_stores_lock = threading.Lock()
+
+
+def open_sim_store(path=storage_path):
+    """
+    Returns the SimStore set up in utils/config.py for the simulations stored
+    in path, shared by every caller in this process.
+    """
+    key = sim_store_db if sim_store == "sqlite" else os.path.abspath(path)
+    with sim_stores_lock:
+        if key not in sim_stores:
+            if sim_store == "sqlite":
+                sim_stores[key] = SqliteSimStore(sim_store_db)
+            else:
+                sim_stores[key] = JsonSimStore(path)
+        return sim_stores[key]
+
+
+def remove_simulation(path, sim_code):
+    """
+    Removes a simulation: its folder in path and, with an incremental store,
+    its copy in the store.
+    """
+    removeanything(f"{path}/{sim_code}")
+    store = open_sim_store(path)
+    if store.incremental:
+        store.delete_simulation(sim_code)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Imports a simulation folder into the SQLite store, or exports it back."
+    )
+    parser.add_argument("command", choices=["import", "export"])
+    parser.add_argument("sim_code")
+    parser.add_argument("--db", default=sim_store_db)
+    parser.add_argument("--storage", default=storage_path)
+    args = parser.parse_args()
+
+    folders, db = JsonSimStore(args.storage), SqliteSimStore(args.db)
+    if args.command == "import":
+        transfer_simulation(folders, db, args.sim_code)
+    else:
+        transfer_simulation(db, folders, args.sim_code)
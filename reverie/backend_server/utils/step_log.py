@@ -0,0 +1,198 @@
+"""
+File: step_log.py
+Description: A segmented, append-only log holding one JSON record per step of
+a simulation (e.g., its movements), in place of a folder of <step>.json files.
+"""
+
+import json
+import os
+import struct
+import threading
+
+from utils import open_private
+from utils.config import step_log_segment_steps
+
+# A record is its length followed by its JSON.
+RECORD_HEADER = struct.Struct("<I")
+# An index slot is the offset and length of the record of a step. A length of
+# 0 means that the step has no record.
+INDEX_SLOT = struct.Struct("<QI")
+
+
+class StepLog:
+    """
+    The steps are grouped into segments of <segment_steps> steps. The segment
+    starting at step <first> is made of two files in the folder:
+      <first>.log: the records, in the order they were appended.
+      <first>.idx: one slot per step of the segment, pointing to its record.
+    So reading a step takes one seek into the index and one into the log,
+    however long the simulation. Appending a step again adds a new record and
+    points its slot to it.
+    One writer at a time; readers may run concurrently, since a record is
+    written before its slot.
+    """
+
+    def __init__(self, folder, segment_steps=step_log_segment_steps):
+        self.folder = folder
+        self.meta_file = f"{folder}/steplog.json"
+        self.segment_steps = None
+        self.default_segment_steps = segment_steps
+        self.lock = threading.Lock()
+
+    def get_segment_steps(self):
+        # The segment size is fixed when the log is created, so changing the
+        # config does not break existing logs.
+        if self.segment_steps is None and os.path.exists(self.meta_file):
+            with open(self.meta_file) as infile:
+                self.segment_steps = json.load(infile)["segment_steps"]
+        return self.segment_steps
+
+    def segment_files(self, step):
+        first = step - step % self.segment_steps
+        slot = (step - first) * INDEX_SLOT.size
+        return f"{self.folder}/{first}.log", f"{self.folder}/{first}.idx", slot
+
+    def append(self, step, data):
+        """
+        Appends data (JSON serializable) as the record of step.
+        """
+        self.extend([(step, data)])
+
+    def extend(self, records):
+        """
+        Appends a list of (step, data) records, in order. The files of each
+        segment are opened once, so this is much faster than appending the
+        records one by one.
+        """
+        with self.lock:
+            if self.get_segment_steps() is None:
+                os.makedirs(self.folder, exist_ok=True)
+                with open(self.meta_file, "w") as outfile:
+                    json.dump({"segment_steps": self.default_segment_steps}, outfile)
+                self.segment_steps = self.default_segment_steps
+
+            segments = dict()
+            for step, data in records:
+                payload = json.dumps(data, separators=(",", ":")).encode()
+                log_file, index_file, slot = self.segment_files(step)
+                segments.setdefault((log_file, index_file), []).append((slot, payload))
+
+            for (log_file, index_file), entries in segments.items():
+                slots = []
+                with open_private(log_file, "ab") as log:
+                    offset = log.seek(0, os.SEEK_END)
+                    for slot, payload in entries:
+                        log.write(RECORD_HEADER.pack(len(payload)) + payload)
+                        slots.append((slot, offset, len(payload)))
+                        offset += RECORD_HEADER.size + len(payload)
+                if not os.path.exists(index_file):
+                    open(index_file, "wb").close()
+                with open_private(index_file, "r+b") as index:
+                    for slot, offset, length in slots:
+                        index.seek(slot)
+                        index.write(INDEX_SLOT.pack(offset, length))
+
+    def read(self, step):
+        """
+        RETURNS:
+          The record of step, or None if there is none.
+        """
+        if self.get_segment_steps() is None:
+            return None
+        log_file, index_file, slot = self.segment_files(step)
+        try:
+            with open(index_file, "rb") as index:
+                index.seek(slot)
+                entry = index.read(INDEX_SLOT.size)
+            if len(entry) < INDEX_SLOT.size:
+                return None
+            offset, length = INDEX_SLOT.unpack(entry)
+            if not length:
+                return None
+            with open(log_file, "rb") as log:
+                log.seek(offset)
+                header = log.read(RECORD_HEADER.size)
+                payload = log.read(length)
+        except FileNotFoundError:
+            return None
+        if len(header) < RECORD_HEADER.size or RECORD_HEADER.unpack(header)[0] != length:
+            return None
+        return json.loads(payload)
+
+    def steps(self):
+        """
+        RETURNS:
+          The sorted list of the steps that have a record.
+        """
+        if self.get_segment_steps() is None:
+            return []
+        steps = []
+        for file in os.listdir(self.folder):
+            first, ext = os.path.splitext(file)
+            if ext != ".idx" or not first.isdigit():
+                continue
+            with open(f"{self.folder}/{file}", "rb") as index:
+                slots = index.read()
+            for i in range(len(slots) // INDEX_SLOT.size):
+                if INDEX_SLOT.unpack_from(slots, i * INDEX_SLOT.size)[1]:
+                    steps.append(int(first) + i)
+        return sorted(steps)
+
+
+step_logs = dict()
+step_logs_lock = threading.Lock()
+
+
+def step_log(folder):
+    """
+    Returns the StepLog of folder, shared by every caller in this process so
+    that their appends do not interleave.
+    """
+    key = os.path.abspath(folder)
+    with step_logs_lock:
+        if key not in step_logs:
+            step_logs[key] = StepLog(folder)
+        return step_logs[key]
+
+
+# The functions below read a folder of steps whatever its format: the log, or
+# the legacy <step>.json files of older simulations and templates.
+
+
+def legacy_steps(folder):
+    if not os.path.isdir(folder):
+        return []
+    return [
+        int(file[: -len(".json")])
+        for file in os.listdir(folder)
+        if file.endswith(".json") and file[: -len(".json")].isdigit()
+    ]
+
+
+def read_step(folder, step):
+    """
+    RETURNS:
+      The record of step in folder, or None if there is none.
+    """
+    record = step_log(folder).read(step)
+    if record is None and os.path.exists(f"{folder}/{step}.json"):
+        with open(f"{folder}/{step}.json") as infile:
+            record = json.load(infile)
+    return record
+
+
+def list_steps(folder):
+    """
+    RETURNS:
+      The sorted list of the steps that have a record in folder.
+    """
+    return sorted(set(step_log(folder).steps()) | set(legacy_steps(folder)))
+
+
+def last_step(folder):
+    """
+    RETURNS:
+      The last step that has a record in folder, or None if there is none.
+    """
+    steps = list_steps(folder)
+    return steps[-1] if steps else None
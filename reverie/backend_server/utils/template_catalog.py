@@ -0,0 +1,177 @@
+"""
+File: template_catalog.py
+Description: An in-memory catalog of the simulation templates in the storage
+folder, backing /fetch_templates and /fetch_template.
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+
+def file_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def etag_of(data):
+    encoded = json.dumps(data, sort_keys=True, default=str).encode()
+    return '"' + hashlib.sha1(encoded).hexdigest() + '"'
+
+
+class TemplateCatalog:
+    """
+    Caches the meta.json of every folder in the storage folder and, on demand,
+    the details of single templates. Entries are invalidated by the mtimes of
+    the files they were read from, so a refresh only re-reads what changed.
+    Every cached response carries an ETag.
+    All methods do blocking file I/O; the server calls them off the event loop.
+    """
+
+    def __init__(self, storage_path, load_json, is_listed):
+        """
+        ARGS:
+          storage_path: the folder holding the templates and simulations.
+          load_json: a callable returning the parsed content of a JSON file
+            ({} if it is missing or invalid).
+          is_listed: a callable telling whether a folder name is a template
+            that /fetch_templates lists.
+        """
+        self.storage_path = storage_path
+        self.load_json = load_json
+        self.is_listed = is_listed
+        # <metas> maps a folder name to (meta.json mtime, meta).
+        self.metas = dict()
+        # <details> maps a folder name to (file mtimes, details, etag).
+        self.details = dict()
+        self.listing = None
+        self.listing_etag = None
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """
+        Rescans the storage folder and re-reads the meta.json files whose mtime
+        changed. The listing (and its ETag) is only rebuilt if anything did.
+        """
+        with self.lock:
+            envs = [
+                dir
+                for dir in os.listdir(self.storage_path)
+                if os.path.isdir(os.path.join(self.storage_path, dir))
+            ]
+            changed = self.listing is None or set(envs) != set(self.listing["all_templates"])
+            metas = dict()
+            for dir in envs:
+                if not self.is_listed(dir):
+                    continue
+                meta_file = os.path.join(self.storage_path, dir, "reverie", "meta.json")
+                mtime = file_mtime(meta_file)
+                cached = self.metas.get(dir)
+                if cached and cached[0] == mtime:
+                    metas[dir] = cached
+                else:
+                    metas[dir] = (mtime, self.load_json(meta_file) if mtime else {})
+                    changed = True
+            changed = changed or set(metas) != set(self.metas)
+            self.metas = metas
+            for dir in list(self.details):
+                if dir not in envs:
+                    del self.details[dir]
+
+            if changed:
+                self.listing = {"envs": self.build_envs(), "all_templates": envs}
+                self.listing_etag = etag_of(self.listing)
+
+    def build_envs(self):
+        result_envs = [
+            meta for _, meta in self.metas.values() if meta and not meta.get("hidden", True)
+        ]
+
+        # Sort result_envs based on template_sim_code
+        def sort_key(env):
+            sim_code = env.get("template_sim_code", "")
+            return (0 if "online" in sim_code.lower() else 1, sim_code)
+
+        result_envs.sort(key=sort_key)
+        return result_envs
+
+    def get_listing(self):
+        """
+        RETURNS:
+          A tuple of ({"envs", "all_templates"}, etag). The catalog is built on
+          first use.
+        """
+        if self.listing is None:
+            self.refresh()
+        return self.listing, self.listing_etag
+
+    def template_files(self, env_path, meta):
+        files = [
+            os.path.join(env_path, "reverie", "meta.json"),
+            os.path.join(env_path, "reverie", "events.json"),
+        ]
+        for persona in meta.get("persona_names", []):
+            files.append(
+                os.path.join(env_path, "personas", persona, "bootstrap_memory", "scratch.json")
+            )
+        return files
+
+    def get_template(self, sim_code):
+        """
+        Returns the details of one template, re-reading them only if one of the
+        files they were built from changed.
+        RETURNS:
+          A tuple of ({"meta", "personas", "events"}, etag), or None if the
+          template does not exist.
+        """
+        env_path = os.path.join(self.storage_path, sim_code)
+        if not os.path.exists(env_path):
+            return None
+
+        with self.lock:
+            cached = self.details.get(sim_code)
+        if cached:
+            files, mtimes = cached[0]
+            if [file_mtime(file) for file in files] == mtimes:
+                return cached[1], cached[2]
+
+        details = self.load_template(env_path)
+        files = self.template_files(env_path, details["meta"])
+        # The mtimes are taken after reading, so a concurrent write only makes
+        # the next request read the files again.
+        mtimes = [file_mtime(file) for file in files]
+        etag = etag_of(details)
+        with self.lock:
+            self.details[sim_code] = ((files, mtimes), details, etag)
+        return details, etag
+
+    def load_template(self, env_path):
+        env_meta = self.load_json(os.path.join(env_path, "reverie", "meta.json"))
+
+        persona_names = env_meta.get("persona_names", [])
+        persona_info = {}
+        for persona in persona_names:
+            scratch_file = os.path.join(
+                env_path, "personas", persona, "bootstrap_memory", "scratch.json"
+            )
+            scratch_data = self.load_json(scratch_file)
+            persona_info[persona] = {
+                "name": scratch_data.get("name", ""),
+                "first_name": scratch_data.get("first_name", ""),
+                "last_name": scratch_data.get("last_name", ""),
+                "age": scratch_data.get("age", 0),
+                "daily_plan_req": scratch_data.get("daily_plan_req", ""),
+                "innate": scratch_data.get("innate", ""),
+                "learned": scratch_data.get("learned", ""),
+                "currently": scratch_data.get("currently", ""),
+                "lifestyle": scratch_data.get("lifestyle", ""),
+                "living_area": scratch_data.get("living_area", ""),
+                "bibliography": "",  # WIP
+            }
+
+        events = self.load_json(os.path.join(env_path, "reverie", "events.json"))
+
+        return {"meta": env_meta, "personas": persona_info, "events": events}